@@ -1,64 +1,205 @@
 import os
 
-import qdrant_client
-
 from dotenv import load_dotenv
-from langfuse.llama_index import LlamaIndexCallbackHandler
-from llama_index.core import Settings
-from llama_index.core.callbacks import CallbackManager
-from llama_index.embeddings.fastembed import FastEmbedEmbedding
-from llama_index.llms.ollama import Ollama
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from sqlalchemy import create_engine
 
 load_dotenv()
 
+# Only settings live here; clients and models are built on first use by the
+# providers in backend.resources
+
+# Style guides that ingestion reads and that queries can name as their guide
+STYLE_GUIDE_DIR = os.environ.get("STYLE_GUIDE_DIR", "data/style")
+
 # Vector Store Settings ################################
+# "qdrant" uses the Qdrant service; "local" searches an index kept in the API
+# process, which suits corpora of a few documents on a single node
+VECTOR_STORE_BACKEND = os.environ.get("VECTOR_STORE_BACKEND", "qdrant")
 QDRANT_HOST = os.environ.get("QDRANT_HOST", "localhost")
 QDRANT_PORT = os.environ.get("PORT", 6333)
-
-QDRANT_CLIENT = qdrant_client.QdrantClient(
-    # you can use :memory: mode for fast and light-weight experiments,
-    # it does not require to have Qdrant deployed anywhere
-    # but requires qdrant-client >= 1.1.1
-    # location=":memory:"
-    # otherwise set Qdrant instance address with:
-    # url="http://<host>:<port>"
-    # otherwise set Qdrant instance with host and port:
-    host=QDRANT_HOST,
-    port=QDRANT_PORT,
-    # set API KEY for Qdrant Cloud
-    # api_key="<qdrant-api-key>",
+QDRANT_COLLECTION_NAME = os.environ.get("QDRANT_COLLECTION_NAME", "style_python")
+QDRANT_UPSERT_BATCH_SIZE = int(os.environ.get("QDRANT_UPSERT_BATCH_SIZE", 256))
+QDRANT_UPSERT_PARALLEL = int(os.environ.get("QDRANT_UPSERT_PARALLEL", 1))
+# Collection settings, applied when ingestion creates or updates a collection.
+# Quantization ("scalar", "binary" or "none") keeps compressed vectors in RAM
+# while QDRANT_ON_DISK leaves the originals memory-mapped on disk; searches take
+# QDRANT_QUANTIZATION_OVERSAMPLING times the requested candidates from the
+# compressed vectors and, with rescoring, reorder them with the originals
+QDRANT_QUANTIZATION = os.environ.get("QDRANT_QUANTIZATION", "scalar")
+QDRANT_QUANTIZATION_RESCORE = (
+    os.environ.get("QDRANT_QUANTIZATION_RESCORE", "true").lower() == "true"
 )
-
-VECTOR_STORE = QdrantVectorStore(
-    client=QDRANT_CLIENT, enable_hybrid=True, collection_name="style_python"
+QDRANT_QUANTIZATION_OVERSAMPLING = float(
+    os.environ.get("QDRANT_QUANTIZATION_OVERSAMPLING", 2.0)
+)
+QDRANT_ON_DISK = os.environ.get("QDRANT_ON_DISK", "true").lower() == "true"
+# HNSW graph links per node and build-time beam width, and the query-time beam
+# width; Qdrant only builds the graph once a segment holds more than
+# QDRANT_INDEXING_THRESHOLD kilobytes of vectors and scans smaller ones exactly
+QDRANT_HNSW_M = int(os.environ.get("QDRANT_HNSW_M", 16))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.environ.get("QDRANT_HNSW_EF_CONSTRUCT", 100))
+QDRANT_HNSW_EF = int(os.environ.get("QDRANT_HNSW_EF", 128))
+QDRANT_INDEXING_THRESHOLD = int(os.environ.get("QDRANT_INDEXING_THRESHOLD", 20000))
+# Payload fields indexed for filtered search, as "field[:schema],..."
+QDRANT_PAYLOAD_INDEXES = os.environ.get("QDRANT_PAYLOAD_INDEXES", "file_name")
+# Also ingest each style guide into a collection of its own, which queries for
+# that guide then search instead of filtering the shared collection
+QDRANT_COLLECTION_PER_GUIDE = (
+    os.environ.get("QDRANT_COLLECTION_PER_GUIDE", "false").lower() == "true"
 )
 
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "localhost")
 
 # Generation and Embedding Model Seetings ##############
 GENERATIVE_MODEL_NAME = os.environ.get("GENERATIVE_MODEL_NAME", "gemma:2b")
-LLM = Ollama(
-    model=GENERATIVE_MODEL_NAME,
-    request_timeout=36000,
-    base_url=f"http://{OLLAMA_HOST}:11434",
-)
+# Requests also stop at their latency budget; this only bounds a stuck call
+OLLAMA_REQUEST_TIMEOUT = float(os.environ.get("OLLAMA_REQUEST_TIMEOUT", 120))
 
 EMBED_MODEL_NAME = os.environ.get("EMBED_MODEL_NAME", "BAAI/bge-base-en-v1.5")
 
+# Content hashes and cached transformations from earlier ingestion runs
+INGESTION_STORAGE_DIR = os.environ.get(
+    "INGESTION_STORAGE_DIR", "data/ingestion_storage"
+)
 
-# Monitoring ###########################################
-langfuse_callback_handler = LlamaIndexCallbackHandler()
+# Embeddings and BM25 index of the "local" vector store backend
+LOCAL_INDEX_DIR = os.environ.get(
+    "LOCAL_INDEX_DIR", os.path.join(INGESTION_STORAGE_DIR, "local_index")
+)
+# Replaced index versions are kept this many seconds for readers still loading them
+LOCAL_INDEX_VERSION_GRACE = float(os.environ.get("LOCAL_INDEX_VERSION_GRACE", 300))
+
+# Metadata extraction makes one LLM call per chunk; keep concurrency at or below
+# the number of requests the Ollama server handles in parallel (OLLAMA_NUM_PARALLEL)
+EXTRACTION_CONCURRENCY = int(
+    os.environ.get("EXTRACTION_CONCURRENCY", os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+)
+EXTRACTION_MAX_RETRIES = int(os.environ.get("EXTRACTION_MAX_RETRIES", 5))
+EXTRACTION_BACKOFF = float(os.environ.get("EXTRACTION_BACKOFF", 1.0))
+EXTRACTION_REPORT_INTERVAL = int(os.environ.get("EXTRACTION_REPORT_INTERVAL", 10))
+
+# Ingestion streams documents through in batches, so memory use stays flat
+INGESTION_BATCH_SIZE = int(os.environ.get("INGESTION_BATCH_SIZE", 16))
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 64))
+EMBED_THREADS = os.environ.get("EMBED_THREADS")
 
+# Query embeddings and cross-encoder scores of concurrent requests are computed
+# together; a batch closes after MICRO_BATCH_MAX_WAIT_MS or MICRO_BATCH_MAX_SIZE items
+MICRO_BATCHING = os.environ.get("MICRO_BATCHING", "true").lower() == "true"
+MICRO_BATCH_MAX_SIZE = int(os.environ.get("MICRO_BATCH_MAX_SIZE", 64))
+MICRO_BATCH_MAX_WAIT = float(os.environ.get("MICRO_BATCH_MAX_WAIT_MS", 5)) / 1000
 
-# Configure LlamaIndex and API logic
-Settings.embed_model = FastEmbedEmbedding(model_name=EMBED_MODEL_NAME)
-Settings.llm = LLM
-Settings.callback_manager = CallbackManager([langfuse_callback_handler])
 
-BASE_CONFIG = {"multistep": False, "hyde": True, "rerank": True}
+# Monitoring ###########################################
+LANGFUSE_ENABLED = bool(
+    os.environ.get("LANGFUSE_PUBLIC_KEY") and os.environ.get("LANGFUSE_SECRET_KEY")
+)
+
+# hyde is True to write the hypothetical passage before retrieving, or "speculative"
+# to retrieve on the raw query meanwhile and merge in the passage's candidates if it
+# arrives within hyde_deadline seconds.
+# rerank is False to keep the retrieval order, "sentence_transformers" (True) for
+# torch or "onnx" for the FastEmbed cross-encoder (int8 weights with
+# rerank_quantized); the ONNX backend becomes the default once
+# experiments/benchmark_rerank.py shows it ranks as well.
+# At most rerank_max_candidates nodes are scored, each pair cut to rerank_max_length
+# tokens.
+# relevance_gate picks how answers are checked before they are returned:
+# "llm" asks the generative model (a second LLM call), "score" reuses the reranker
+# and retrieval scores of the sources, "cross_encoder" scores the query/answer pair.
+# The score and cross-encoder thresholds are not calibrated yet (see
+# experiments/benchmark_relevance_gate.py), so only "fast" mode and the planner,
+# when the budget is at risk, use the score gate
+BASE_CONFIG = {
+    "multistep": False,
+    "hyde": "speculative",
+    "hyde_deadline": 2.0,
+    "rerank": "sentence_transformers",
+    "rerank_quantized": False,
+    "rerank_max_candidates": 8,
+    "rerank_max_length": 256,
+    "relevance_gate": "llm",
+    "min_rerank_score": 0.1,
+    "min_retrieval_score": 0.0,
+    "min_answer_score": 0.0,
+}
+RERANK_MODEL_NAME = os.environ.get("RERANK_MODEL_NAME", "BAAI/bge-reranker-base")
+RERANK_QUANTIZED_MODEL_SOURCE = os.environ.get(
+    "RERANK_QUANTIZED_MODEL_SOURCE", "Xenova/bge-reranker-base"
+)
+RERANK_QUANTIZED_MODEL_FILE = os.environ.get(
+    "RERANK_QUANTIZED_MODEL_FILE", "onnx/model_quantized.onnx"
+)
+ANSWER_SCORER_MODEL_NAME = os.environ.get(
+    "ANSWER_SCORER_MODEL_NAME", "cross-encoder/ms-marco-MiniLM-L-6-v2"
+)
+# Named query modes override BASE_CONFIG and come with a default latency budget
+# in seconds; the planner trims stages when live timings say the budget is at risk
+QUERY_MODES = {
+    "fast": {"hyde": False, "rerank_max_candidates": 4, "relevance_gate": "score"},
+    "balanced": {},
+    "thorough": {
+        "multistep": "parallel",
+        "hyde_deadline": 5.0,
+        "rerank_max_candidates": 16,
+        "relevance_gate": "llm",
+    },
+}
+QUERY_MODE_BUDGETS = {
+    "fast": float(os.environ.get("FAST_MODE_BUDGET", 10)),
+    "balanced": float(os.environ.get("BALANCED_MODE_BUDGET", 30)),
+    "thorough": float(os.environ.get("THOROUGH_MODE_BUDGET", 90)),
+}
+# Weight of the newest observation in the stage timing estimates
+STAGE_ESTIMATE_SMOOTHING = float(os.environ.get("STAGE_ESTIMATE_SMOOTHING", 0.2))
+# Sub-questions of a parallel multistep query answered at the same time
+MULTISTEP_CONCURRENCY = int(os.environ.get("MULTISTEP_CONCURRENCY", 4))
+# Query pipeline runs at once across /queries, /queries/stream and every batch;
+# like extraction, size it to the requests Ollama serves in parallel. Batch
+# queries leave PIPELINE_INTERACTIVE_RESERVE of them free for interactive requests
+PIPELINE_CONCURRENCY = int(
+    os.environ.get("PIPELINE_CONCURRENCY", os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+)
+PIPELINE_INTERACTIVE_RESERVE = int(os.environ.get("PIPELINE_INTERACTIVE_RESERVE", 1))
+# Queries of one POST /queries/batch answered at once, unless the batch sets it
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", PIPELINE_CONCURRENCY))
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", 1000))
+# Query engines kept built, one per vector store and planned config; the least
+# recently used ones are rebuilt on their next query
+QUERY_ENGINES_MAX_ENTRIES = int(os.environ.get("QUERY_ENGINES_MAX_ENTRIES", 64))
+HYDE_CACHE_MAX_ENTRIES = int(os.environ.get("HYDE_CACHE_MAX_ENTRIES", 1000))
+WARM_UP_RETRY_INTERVAL = float(os.environ.get("WARM_UP_RETRY_INTERVAL", 5))
 FALLBACK_RESPONSE = "Sorry, I was not able to find an answer for that."
+# Opens the list of sources sent when an answer could not be written in time
+DEGRADED_RESPONSE = (
+    "I could not write a full answer in time, but these sources look relevant:"
+)
+API_URL = os.environ.get("API_URL", "http://localhost:7860")
+# Bearer token that POST /index/refresh requires; without one, only clients on
+# the API's own host may call it
+INDEX_REFRESH_TOKEN = os.environ.get("INDEX_REFRESH_TOKEN")
+
+# Semantic Answer Cache ################################
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.92))
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", 24 * 60 * 60))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 1000))
+SEMANTIC_CACHE_MAX_BYTES = int(
+    os.environ.get("SEMANTIC_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
-DB_ENGINE = create_engine(DATABASE_URL)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+
+# Interaction logs are queued and written in bulk by a background task
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 100))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 2.0))
+LOG_SPOOL_PATH = os.environ.get("LOG_SPOOL_PATH", "data/interaction_log_spool.jsonl")
+# The oldest spooled rows are dropped beyond this, so a long outage cannot fill the disk
+LOG_SPOOL_MAX_ROWS = int(os.environ.get("LOG_SPOOL_MAX_ROWS", 100000))
+# Rows the database rejects on their own are moved here instead of being retried
+LOG_DEAD_LETTER_PATH = os.environ.get(
+    "LOG_DEAD_LETTER_PATH", "data/interaction_log_dead_letter.jsonl"
+)
+# Bits 12-21 of the generated ids; set a distinct value per host when several
+# hosts write to one database, otherwise it is derived from the host and process
+LOG_ID_NODE = os.environ.get("LOG_ID_NODE")
@@ -1,24 +1,360 @@
-from fastapi import FastAPI
+import asyncio
+import json
+import logging
+import secrets
+from contextlib import asynccontextmanager
+from typing import Annotated, Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette import status
 from starlette.requests import Request
 
-from backend.schemas import QueryMessage, QueryResponseModel, UserQueryFeedback
-from backend.utils.message_logging import log_message, log_answer, log_feedback
-from backend.utils.query import query_vector_store
+from backend.constants import (
+    BASE_CONFIG,
+    BATCH_CONCURRENCY,
+    FALLBACK_RESPONSE,
+    INDEX_REFRESH_TOKEN,
+    QUERY_MODES,
+    WARM_UP_RETRY_INTERVAL,
+)
+from backend.resources import get_async_db_engine
+from backend.schemas import (
+    BatchQueryMessage,
+    BatchQueryResult,
+    QueryMessage,
+    QueryOptions,
+    QueryResponseModel,
+    UserQueryFeedback,
+)
+from backend.utils.admission import BATCH, INTERACTIVE, PIPELINE_LIMITER
+from backend.utils.message_logging import (
+    INTERACTION_LOGGER,
+    log_message,
+    log_messages,
+    log_answer,
+    log_feedback,
+)
+from backend.utils.ingest import available_guides, run_ingestion_hooks
+from backend.utils.metrics import start_request_stages, timed_stage
+from backend.utils.planner import QueryPlan, mode_config, plan_query
+from backend.utils.query import (
+    query_vector_store,
+    stream_vector_store,
+    warm_up_query_engines,
+)
+from backend.utils.semantic_cache import SEMANTIC_CACHE
+
+logger = logging.getLogger(__name__)
+
+
+async def warm_up(app: FastAPI):
+    """Builds clients, models and query engines in the background, retrying until
+    the services they need are reachable, then marks the API ready
+    """
+    while True:
+        try:
+            await asyncio.to_thread(
+                warm_up_query_engines,
+                configs=tuple(mode_config(mode) for mode in QUERY_MODES),
+            )
+        except Exception:
+            logger.exception(
+                "Warm-up failed, retrying in %s seconds", WARM_UP_RETRY_INTERVAL
+            )
+            await asyncio.sleep(WARM_UP_RETRY_INTERVAL)
+        else:
+            app.state.ready = True
+            return
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The API starts answering health checks at once; /health/ready reports when
+    # the models are warm
+    app.state.ready = False
+    warm_up_task = asyncio.create_task(warm_up(app))
+    await INTERACTION_LOGGER.start()
+    yield
+    warm_up_task.cancel()
+    await INTERACTION_LOGGER.stop()
+    if get_async_db_engine.is_built():
+        await get_async_db_engine().dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/health/live")
+async def check_liveness():
+    """The process is up and serving requests"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def check_readiness(response: Response):
+    """The models and query engines are loaded, so queries are answered quickly"""
+    if not app.state.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "warming up"}
+    return {"status": "ready"}
 
-app = FastAPI()
+
+def require_ready(request: Request):
+    """Queries get a 503 until the warm-up has built the query engines, instead
+    of waiting on it
+    """
+    if not getattr(request.app.state, "ready", False):
+        raise HTTPException(
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            "Warming up, retry shortly",
+            headers={"Retry-After": str(int(WARM_UP_RETRY_INTERVAL))},
+        )
+
+
+LOOPBACK_HOSTS = ("127.0.0.1", "::1")
+
+
+@app.post("/index/refresh", status_code=status.HTTP_204_NO_CONTENT)
+def refresh_index(
+    request: Request, authorization: Annotated[Optional[str], Header()] = None
+):
+    """Called after an ingestion run so cached engines pick up the new content"""
+    if INDEX_REFRESH_TOKEN:
+        if not secrets.compare_digest(
+            authorization or "", f"Bearer {INDEX_REFRESH_TOKEN}"
+        ):
+            raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Invalid refresh token")
+    elif request.client is None or request.client.host not in LOOPBACK_HOSTS:
+        raise HTTPException(
+            status.HTTP_403_FORBIDDEN,
+            "Set INDEX_REFRESH_TOKEN to refresh the index from another host",
+        )
+    run_ingestion_hooks()
 
 
 @app.post("/queries/{query_id}/feedback", status_code=status.HTTP_201_CREATED)
-def send_feedback(query_id: int, request: Request, payload: UserQueryFeedback):
+async def send_feedback(query_id: int, request: Request, payload: UserQueryFeedback):
     rating = payload.rating
     log_feedback(query_id, rating)
 
 
-@app.post("/queries", response_model=QueryResponseModel)
-def answer_question(request: Request, payload: QueryMessage):
+def query_config(payload: QueryOptions) -> dict:
+    """The base config, scoped to one guide when the query names it; cached
+    answers are kept apart per guide as well
+    """
+    if payload.guide:
+        if payload.guide not in available_guides():
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_CONTENT,
+                f"Unknown guide {payload.guide!r}, expected one of "
+                f"{sorted(available_guides())}",
+            )
+        return {**BASE_CONFIG, "guide": payload.guide}
+    return BASE_CONFIG
+
+
+async def answer_query(query: str, plan: QueryPlan, priority: str = INTERACTIVE) -> str:
+    """Answers from the semantic cache, or runs the query pipeline once the
+    limiter admits it and caches the answer under the plan's mode
+
+    Batch queries wait behind interactive requests, so their latency budget
+    starts once they are admitted.
+    """
+    with timed_stage("semantic_cache"):
+        query_embedding = await SEMANTIC_CACHE.aembed(query)
+        answer = SEMANTIC_CACHE.lookup(query_embedding, plan.mode_config)
+    if answer is not None:
+        plan.degraded_stages.clear()
+        return answer
+
+    async with PIPELINE_LIMITER.slot(priority):
+        if priority == BATCH:
+            plan.restart()
+        answer = str(await query_vector_store(query, plan=plan))
+    # A degraded answer is not cached, so a later query with more time gets the
+    # full pipeline
+    if answer != FALLBACK_RESPONSE and not plan.degraded:
+        SEMANTIC_CACHE.store(query_embedding, query, answer, plan.mode_config)
+    return answer
+
+
+@app.post(
+    "/queries",
+    response_model=QueryResponseModel,
+    response_model_exclude_none=True,
+    dependencies=[Depends(require_ready)],
+)
+async def answer_question(
+    request: Request,
+    payload: QueryMessage,
+    x_debug_timings: Annotated[bool, Header()] = False,
+):
+    query = payload.query
+    # An unknown guide is rejected before the query is logged
+    config = query_config(payload)
+    query_id = log_message(query)
+    stages = start_request_stages()
+    plan = plan_query(payload.mode, payload.latency_budget, config)
+
+    with timed_stage("total"):
+        answer = await answer_query(query, plan)
+
+    log_answer(query_id, answer)
+    return {
+        "answer": answer,
+        "query_id": query_id,
+        "stages": stages if x_debug_timings else None,
+        "degraded": plan.degraded,
+        "degraded_stages": plan.degraded_stages or None,
+    }
+
+
+async def answer_batch_query(
+    query: str, query_id: int, payload: BatchQueryMessage, config: dict, semaphore
+) -> dict:
+    """Answers one distinct query of a batch; its latency budget starts once it
+    is admitted, not when the batch arrives
+    """
+    async with semaphore:
+        start_request_stages()
+        plan = plan_query(payload.mode, payload.latency_budget, config)
+        try:
+            with timed_stage("total"):
+                answer = await answer_query(query, plan, BATCH)
+        except Exception as error:
+            logger.exception("Batch query %s failed", query_id)
+            return {"query": query, "query_id": query_id, "error": repr(error)}
+    log_answer(query_id, answer)
+    return {
+        "query": query,
+        "query_id": query_id,
+        "answer": answer,
+        "degraded": plan.degraded,
+        "degraded_stages": plan.degraded_stages or None,
+    }
+
+
+async def stream_batch_results(payload: BatchQueryMessage, config: dict):
+    """Runs each distinct query once and writes a JSON line for every position
+    it holds in the batch as soon as its answer is ready
+    """
+    positions = {}
+    for index, query in enumerate(payload.queries):
+        positions.setdefault(query.strip(), []).append(index)
+    queries = list(positions)
+    query_ids = log_messages(queries)
+
+    semaphore = asyncio.Semaphore(payload.concurrency or BATCH_CONCURRENCY)
+    tasks = [
+        asyncio.create_task(
+            answer_batch_query(query, query_id, payload, config, semaphore)
+        )
+        for query, query_id in zip(queries, query_ids)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            for index in positions[result["query"]]:
+                yield BatchQueryResult(index=index, **result).model_dump_json(
+                    exclude_none=True
+                ) + "\n"
+    finally:
+        # Queries still running when the client goes away are cancelled
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/queries/batch", dependencies=[Depends(require_ready)])
+async def answer_batch(payload: BatchQueryMessage):
+    # An unknown guide is rejected before any query of the batch is logged or
+    # started
+    config = query_config(payload)
+    return StreamingResponse(
+        stream_batch_results(payload, config), media_type="application/x-ndjson"
+    )
+
+
+def format_server_sent_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_answer_events(query: str, query_id: int, plan: QueryPlan):
+    """Sends the sources and the answer tokens as they arrive, then a final
+    event carrying the query_id, whether the answer passed the relevance check
+    and whether stages were skipped to meet the latency budget
+
+    If the pipeline fails part way, an error event is sent instead, so the
+    client can drop the tokens it has shown
+    """
+    try:
+        query_embedding = await SEMANTIC_CACHE.aembed(query)
+        answer = SEMANTIC_CACHE.lookup(query_embedding, plan.mode_config)
+        if answer is not None:
+            yield format_server_sent_event("token", {"token": answer})
+            is_relevant = True
+            plan.degraded_stages.clear()
+        else:
+            async with PIPELINE_LIMITER.slot(INTERACTIVE):
+                async for event, data in stream_vector_store(query, plan=plan):
+                    if event == "token":
+                        yield format_server_sent_event("token", {"token": data})
+                        continue
+                    if event == "sources":
+                        yield format_server_sent_event("sources", {"sources": data})
+                        continue
+                    answer, is_relevant = data["answer"], data["is_relevant"]
+                    if not is_relevant:
+                        answer = FALLBACK_RESPONSE
+                    elif not plan.degraded:
+                        SEMANTIC_CACHE.store(
+                            query_embedding, query, answer, plan.mode_config
+                        )
+    except Exception as error:
+        logger.exception("Streaming query %s failed", query_id)
+        yield format_server_sent_event(
+            "error", {"query_id": query_id, "error": repr(error)}
+        )
+        return
+
+    log_answer(query_id, answer)
+    yield format_server_sent_event(
+        "done",
+        {
+            "query_id": query_id,
+            "is_relevant": is_relevant,
+            "answer": answer,
+            "degraded": plan.degraded,
+            "degraded_stages": plan.degraded_stages,
+        },
+    )
+
+
+@app.post("/queries/stream", dependencies=[Depends(require_ready)])
+async def stream_answer(request: Request, payload: QueryMessage):
     query = payload.query
+    config = query_config(payload)
     query_id = log_message(query)
-    response = query_vector_store(query)
-    log_answer(query_id, str(response))
-    return {"answer": str(response), "query_id": query_id}
+    plan = plan_query(payload.mode, payload.latency_budget, config)
+    return StreamingResponse(
+        stream_answer_events(query, query_id, plan),
+        media_type="text/event-stream",
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage latencies, token counts and errors in Prometheus format"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return SEMANTIC_CACHE.stats()
+
+
+@app.get("/pipeline/stats")
+async def get_pipeline_stats():
+    """Pipeline runs in progress and waiting, per priority"""
+    return PIPELINE_LIMITER.stats()
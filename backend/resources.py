@@ -0,0 +1,219 @@
+import threading
+from functools import wraps
+
+from backend.constants import (
+    DATABASE_URL,
+    DB_MAX_OVERFLOW,
+    DB_POOL_SIZE,
+    EMBED_BATCH_SIZE,
+    EMBED_MODEL_NAME,
+    EMBED_THREADS,
+    GENERATIVE_MODEL_NAME,
+    LANGFUSE_ENABLED,
+    LOCAL_INDEX_DIR,
+    MICRO_BATCH_MAX_SIZE,
+    MICRO_BATCH_MAX_WAIT,
+    MICRO_BATCHING,
+    OLLAMA_HOST,
+    OLLAMA_REQUEST_TIMEOUT,
+    QDRANT_COLLECTION_NAME,
+    QDRANT_HOST,
+    QDRANT_PORT,
+    QDRANT_UPSERT_BATCH_SIZE,
+    QDRANT_UPSERT_PARALLEL,
+    VECTOR_STORE_BACKEND,
+)
+
+# Clients and models are built on first use rather than at import, so CLIs and
+# tests only pay for the resources they touch. The API builds them up front in
+# its lifespan warm-up.
+
+
+def resource(build):
+    """Turns build into a provider that constructs its resource once, even when
+    several threads ask for it at the same time
+    """
+    lock = threading.Lock()
+    instances = []
+
+    @wraps(build)
+    def get():
+        if not instances:
+            with lock:
+                if not instances:
+                    instances.append(build())
+        return instances[0]
+
+    def override(instance):
+        """Uses instance from now on, e.g. an in-memory client for offline runs"""
+        with lock:
+            instances[:] = [instance]
+
+    get.is_built = lambda: bool(instances)
+    get.override = override
+    return get
+
+
+@resource
+def get_qdrant_client():
+    import qdrant_client
+
+    return qdrant_client.QdrantClient(
+        # you can use :memory: mode for fast and light-weight experiments,
+        # it does not require to have Qdrant deployed anywhere
+        # but requires qdrant-client >= 1.1.1
+        # location=":memory:"
+        # otherwise set Qdrant instance address with:
+        # url="http://<host>:<port>"
+        # otherwise set Qdrant instance with host and port:
+        host=QDRANT_HOST,
+        port=QDRANT_PORT,
+        # set API KEY for Qdrant Cloud
+        # api_key="<qdrant-api-key>",
+    )
+
+
+@resource
+def get_async_qdrant_client():
+    import qdrant_client
+
+    return qdrant_client.AsyncQdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+
+
+@resource
+def get_vector_store():
+    if VECTOR_STORE_BACKEND == "local":
+        from backend.utils.local_store import LocalHybridVectorStore
+
+        return LocalHybridVectorStore(persist_dir=LOCAL_INDEX_DIR)
+    if VECTOR_STORE_BACKEND != "qdrant":
+        raise ValueError(f"Unknown vector store backend {VECTOR_STORE_BACKEND!r}")
+    return get_collection_vector_store(QDRANT_COLLECTION_NAME)
+
+
+COLLECTION_VECTOR_STORES = {}
+COLLECTION_VECTOR_STORES_LOCK = threading.Lock()
+
+
+def get_collection_vector_store(collection_name: str):
+    """The QdrantVectorStore of a named collection, built once per name"""
+    if collection_name not in COLLECTION_VECTOR_STORES:
+        with COLLECTION_VECTOR_STORES_LOCK:
+            if collection_name not in COLLECTION_VECTOR_STORES:
+                from backend.utils.batching import BatchedQdrantVectorStore
+                from backend.utils.qdrant_collections import vector_store_settings
+
+                COLLECTION_VECTOR_STORES[collection_name] = BatchedQdrantVectorStore(
+                    query_batcher=MICRO_BATCHING,
+                    max_batch_size=MICRO_BATCH_MAX_SIZE,
+                    max_wait=MICRO_BATCH_MAX_WAIT,
+                    client=get_qdrant_client(),
+                    aclient=get_async_qdrant_client(),
+                    enable_hybrid=True,
+                    collection_name=collection_name,
+                    batch_size=QDRANT_UPSERT_BATCH_SIZE,
+                    parallel=QDRANT_UPSERT_PARALLEL,
+                    **vector_store_settings(),
+                )
+    return COLLECTION_VECTOR_STORES[collection_name]
+
+
+@resource
+def get_llm():
+    from llama_index.core import Settings
+    from llama_index.llms.ollama import Ollama
+
+    llm = Ollama(
+        model=GENERATIVE_MODEL_NAME,
+        request_timeout=OLLAMA_REQUEST_TIMEOUT,
+        base_url=f"http://{OLLAMA_HOST}:11434",
+    )
+    Settings.llm = llm
+    return llm
+
+
+@resource
+def get_embed_model():
+    from llama_index.core import Settings
+
+    if MICRO_BATCHING:
+        from backend.utils.batching import BatchedFastEmbedEmbedding
+
+        embed_model = BatchedFastEmbedEmbedding(
+            max_batch_size=MICRO_BATCH_MAX_SIZE,
+            max_wait=MICRO_BATCH_MAX_WAIT,
+            model_name=EMBED_MODEL_NAME,
+            threads=int(EMBED_THREADS) if EMBED_THREADS else None,
+        )
+    else:
+        from llama_index.embeddings.fastembed import FastEmbedEmbedding
+
+        embed_model = FastEmbedEmbedding(
+            model_name=EMBED_MODEL_NAME,
+            threads=int(EMBED_THREADS) if EMBED_THREADS else None,
+        )
+    embed_model.embed_batch_size = EMBED_BATCH_SIZE
+    Settings.embed_model = embed_model
+    return embed_model
+
+
+@resource
+def get_callback_manager():
+    from llama_index.core import Settings
+    from llama_index.core.callbacks import CallbackManager
+
+    # Stage latencies are always served locally from /metrics; traces are also
+    # sent to Langfuse when its keys are set
+    callback_handlers = []
+    if LANGFUSE_ENABLED:
+        from langfuse.llama_index import LlamaIndexCallbackHandler
+
+        callback_handlers.append(LlamaIndexCallbackHandler())
+    callback_manager = CallbackManager(callback_handlers)
+    Settings.callback_manager = callback_manager
+    return callback_manager
+
+
+def configure_llama_index():
+    """Points the LlamaIndex Settings at our models before an index or query
+    engine is built from them
+    """
+    get_callback_manager()
+    get_llm()
+    get_embed_model()
+
+
+@resource
+def get_db_engine():
+    from sqlalchemy import create_engine
+
+    if not DATABASE_URL:
+        raise RuntimeError("Set DATABASE_URL to use the interaction database")
+    return create_engine(DATABASE_URL)
+
+
+# The API logs through asyncpg so database round-trips never block the event loop
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+@resource
+def get_async_db_engine():
+    from sqlalchemy import make_url
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    if not DATABASE_URL:
+        raise RuntimeError("Set DATABASE_URL to use the interaction database")
+    database_url = make_url(DATABASE_URL)
+    database_url = database_url.set(
+        drivername=ASYNC_DRIVERS.get(database_url.drivername, database_url.drivername)
+    )
+    return create_async_engine(
+        database_url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+    )
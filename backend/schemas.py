@@ -1,13 +1,51 @@
-from pydantic import BaseModel
+from typing import List, Literal, Optional
 
+from pydantic import BaseModel, Field
 
-class QueryMessage(BaseModel):
+from backend.constants import BATCH_MAX_QUERIES
+
+
+class QueryOptions(BaseModel):
+    # Named modes trade answer quality for latency; latency_budget, in seconds,
+    # overrides the budget that comes with the mode
+    mode: Literal["fast", "balanced", "thorough"] = "balanced"
+    latency_budget: Optional[float] = Field(default=None, gt=0)
+    # File name of one style guide in data/style to answer from, e.g. "pyguide.md";
+    # other names are rejected with 422
+    guide: Optional[str] = None
+
+
+class QueryMessage(QueryOptions):
     query: str
 
 
+class BatchQueryMessage(QueryOptions):
+    # The options apply to every query; each query gets its own latency budget
+    queries: List[str] = Field(min_length=1, max_length=BATCH_MAX_QUERIES)
+    # Queries of this batch answered at once, within the API-wide PIPELINE_CONCURRENCY
+    concurrency: Optional[int] = Field(default=None, gt=0)
+
+
 class QueryResponseModel(BaseModel):
     answer: str
     query_id: int
+    # Per-stage seconds and token counts, only sent with the X-Debug-Timings header
+    stages: Optional[dict] = None
+    # Set when stages were dropped or cut short to meet the latency budget
+    degraded: bool = False
+    degraded_stages: Optional[list] = None
+
+
+class BatchQueryResult(BaseModel):
+    # Position of the query in the batch; repeated queries are answered once and
+    # every position gets its own line
+    index: int
+    query: str
+    query_id: Optional[int] = None
+    answer: Optional[str] = None
+    degraded: bool = False
+    degraded_stages: Optional[list] = None
+    error: Optional[str] = None
 
 
 class UserQueryFeedback(BaseModel):
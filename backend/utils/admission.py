@@ -0,0 +1,84 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+from backend.constants import PIPELINE_CONCURRENCY, PIPELINE_INTERACTIVE_RESERVE
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+
+class PipelineLimiter:
+    """Admits at most `capacity` query pipeline runs at once, across every
+    endpoint, so together they stay within what Ollama serves in parallel
+
+    Waiting interactive requests are admitted before waiting batch queries, and
+    batch queries never hold the last `interactive_reserve` slots, so a large
+    batch cannot keep a user waiting for more than one pipeline run.
+    """
+
+    def __init__(
+        self,
+        capacity: int = PIPELINE_CONCURRENCY,
+        interactive_reserve: int = PIPELINE_INTERACTIVE_RESERVE,
+    ):
+        self.capacity = capacity
+        self.batch_capacity = max(capacity - interactive_reserve, 1)
+        self.running = {INTERACTIVE: 0, BATCH: 0}
+        self.waiting = {INTERACTIVE: deque(), BATCH: deque()}
+
+    def _has_room(self, priority: str) -> bool:
+        if sum(self.running.values()) >= self.capacity:
+            return False
+        return priority == INTERACTIVE or self.running[BATCH] < self.batch_capacity
+
+    def _admit_waiting(self):
+        for priority in (INTERACTIVE, BATCH):
+            waiting = self.waiting[priority]
+            while waiting and self._has_room(priority):
+                admission = waiting.popleft()
+                if not admission.done():
+                    self.running[priority] += 1
+                    admission.set_result(None)
+
+    def _release(self, priority: str):
+        self.running[priority] -= 1
+        self._admit_waiting()
+
+    async def _acquire(self, priority: str):
+        queued_ahead = self.waiting[INTERACTIVE] or (
+            priority == BATCH and self.waiting[BATCH]
+        )
+        if not queued_ahead and self._has_room(priority):
+            self.running[priority] += 1
+            return
+        admission = asyncio.get_running_loop().create_future()
+        self.waiting[priority].append(admission)
+        try:
+            await admission
+        except asyncio.CancelledError:
+            if admission.done() and not admission.cancelled():
+                # Admitted just as the request was cancelled
+                self._release(priority)
+            else:
+                self.waiting[priority].remove(admission)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, priority: str = INTERACTIVE):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    def stats(self) -> dict:
+        return {
+            "running": dict(self.running),
+            "waiting": {
+                priority: len(waiting) for priority, waiting in self.waiting.items()
+            },
+        }
+
+
+PIPELINE_LIMITER = PipelineLimiter()
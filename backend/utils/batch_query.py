@@ -0,0 +1,63 @@
+"""Sends a file of queries to a running API's POST /queries/batch endpoint and
+writes the answers as JSON lines as they arrive, e.g. to pre-warm the semantic
+cache or to compare answers before and after a prompt change:
+    python -m backend.utils.batch_query queries.txt --mode fast > answers.ndjson
+
+The input has one query per line, or is a CSV file whose --column holds them.
+"""
+
+import argparse
+import csv
+import json
+import sys
+import urllib.request
+
+from backend.constants import API_URL
+
+
+def read_queries(path: str, column: str = None) -> list:
+    with open(path, newline="") as file:
+        if column is not None:
+            return [row[column] for row in csv.DictReader(file) if row[column].strip()]
+        return [line.strip() for line in file if line.strip()]
+
+
+def stream_batch(queries: list, options: dict, api_url: str = API_URL):
+    """Yields each result line of the batch as soon as the API sends it"""
+    request = urllib.request.Request(
+        f"{api_url}/queries/batch",
+        data=json.dumps({"queries": queries, **options}).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help="file with one query per line, or a CSV file")
+    parser.add_argument("--column", help="CSV column holding the queries")
+    parser.add_argument("--mode", choices=["fast", "balanced", "thorough"])
+    parser.add_argument("--latency-budget", type=float)
+    parser.add_argument("--guide")
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--api-url", default=API_URL)
+    args = parser.parse_args()
+
+    options = {
+        "mode": args.mode,
+        "latency_budget": args.latency_budget,
+        "guide": args.guide,
+        "concurrency": args.concurrency,
+    }
+    options = {key: value for key, value in options.items() if value is not None}
+    failed = 0
+    for result in stream_batch(
+        read_queries(args.input, args.column), options, args.api_url
+    ):
+        failed += "error" in result
+        print(json.dumps(result), flush=True)
+    sys.exit(1 if failed else 0)
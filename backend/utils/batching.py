@@ -0,0 +1,203 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Callable, List, Optional
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.postprocessor import SentenceTransformerRerank
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import VectorStoreQueryMode
+from llama_index.embeddings.fastembed import FastEmbedEmbedding
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+# Sparse vector of the query the current task is running, encoded before
+# QdrantVectorStore.aquery asks for it
+ENCODED_SPARSE_QUERY = ContextVar("encoded_sparse_query", default=None)
+
+
+class MicroBatcher:
+    """Groups work submitted by concurrent requests into one model call
+
+    The first item waits max_wait seconds for others to join it (unless a full
+    batch is already queued), and a batch never holds more than max_batch_size
+    items. process_batch takes a list
+    of items and returns one result per item; it runs in a worker thread so the
+    event loop keeps accepting requests while a batch is computed.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[list], list],
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    async def submit(self, item):
+        return (await self.submit_many([item]))[0]
+
+    async def submit_many(self, items: list) -> list:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Queues and futures belong to one event loop
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+        futures = []
+        for item in items:
+            future = loop.create_future()
+            self._queue.put_nowait((item, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _collect_batch(self) -> list:
+        batch = [await self._queue.get()]
+        if self._queue.qsize() < self.max_batch_size - 1:
+            await asyncio.sleep(self.max_wait)
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                results = await asyncio.to_thread(
+                    self.process_batch, [item for item, _ in batch]
+                )
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class BatchedFastEmbedEmbedding(FastEmbedEmbedding):
+    """FastEmbed model that embeds the queries of concurrent requests together"""
+
+    _query_batcher: MicroBatcher = PrivateAttr()
+
+    def __init__(self, max_batch_size: int = 64, max_wait: float = 0.005, **kwargs):
+        super().__init__(**kwargs)
+        self._query_batcher = MicroBatcher(
+            self._get_query_embeddings, max_batch_size, max_wait
+        )
+
+    def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        return [embedding.tolist() for embedding in self._model.query_embed(queries)]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._query_batcher.submit(query)
+
+
+class BatchedSentenceTransformerRerank(SentenceTransformerRerank):
+    """Cross-encoder reranker that scores the candidates of concurrent requests
+    in one forward pass
+    """
+
+    _pair_batcher: MicroBatcher = PrivateAttr()
+
+    def __init__(self, max_batch_size: int = 64, max_wait: float = 0.005, **kwargs):
+        super().__init__(**kwargs)
+        self._pair_batcher = MicroBatcher(self._predict_pairs, max_batch_size, max_wait)
+
+    def _predict_pairs(self, pairs: list) -> list:
+        return [float(score) for score in self._model.predict(pairs)]
+
+    async def _apostprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+
+        scores = await self._pair_batcher.submit_many(
+            [
+                (
+                    query_bundle.query_str,
+                    node.node.get_content(metadata_mode=MetadataMode.EMBED),
+                )
+                for node in nodes
+            ]
+        )
+        for node, score in zip(nodes, scores):
+            if self.keep_retrieval_score:
+                node.node.metadata["retrieval_score"] = node.score
+            node.score = score
+        return sorted(nodes, key=lambda node: -node.score)[: self.top_n]
+
+
+class BatchedQdrantVectorStore(QdrantVectorStore):
+    """Qdrant vector store that encodes the sparse query vectors of hybrid
+    searches in a worker thread, together with those of concurrent requests when
+    query_batcher is set
+
+    QdrantVectorStore.aquery calls the sparse model synchronously, which would
+    stall the event loop for every query.
+    """
+
+    _sparse_query_encoder: Optional[Callable] = PrivateAttr(default=None)
+    _sparse_query_batcher: Optional[MicroBatcher] = PrivateAttr(default=None)
+
+    def __init__(
+        self,
+        *args,
+        query_batcher: bool = False,
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        if self._sparse_query_fn is None:
+            return
+        self._sparse_query_encoder = self._sparse_query_fn
+        self._sparse_query_fn = self._encode_sparse_query
+        if query_batcher:
+            self._sparse_query_batcher = MicroBatcher(
+                self._encode_sparse_queries, max_batch_size, max_wait
+            )
+
+    def _encode_sparse_queries(self, texts: list) -> list:
+        return list(zip(*self._sparse_query_encoder(texts)))
+
+    def _encode_sparse_query(self, texts: list) -> tuple:
+        encoded = ENCODED_SPARSE_QUERY.get()
+        if encoded is not None and texts == [encoded[0]]:
+            indices, values = encoded[1]
+            return [indices], [values]
+        return self._sparse_query_encoder(texts)
+
+    async def aquery(self, query, **kwargs):
+        if (
+            self._sparse_query_encoder is None
+            or query.query_str is None
+            or query.mode
+            not in (VectorStoreQueryMode.HYBRID, VectorStoreQueryMode.SPARSE)
+        ):
+            return await super().aquery(query, **kwargs)
+
+        if self._sparse_query_batcher is not None:
+            encoded = await self._sparse_query_batcher.submit(query.query_str)
+        else:
+            encoded = (
+                await asyncio.to_thread(self._encode_sparse_queries, [query.query_str])
+            )[0]
+        token = ENCODED_SPARSE_QUERY.set((query.query_str, encoded))
+        try:
+            return await super().aquery(query, **kwargs)
+        finally:
+            ENCODED_SPARSE_QUERY.reset(token)
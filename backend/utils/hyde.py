@@ -0,0 +1,253 @@
+import asyncio
+import contextvars
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import QueryBundle
+
+from backend.constants import HYDE_CACHE_MAX_ENTRIES
+from backend.resources import get_llm
+from backend.utils.metrics import InstrumentedQueryEngine, timed_stage
+from backend.utils.planner import remember_nodes
+from backend.utils.prompts import CUSTOM_HYDE_PROMPT
+
+logger = logging.getLogger(__name__)
+
+HYDE_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="hyde")
+# Generations that outlived their query's deadline, kept referenced until they
+# finish and fill the passage cache
+BACKGROUND_GENERATIONS = set()
+
+
+def finish_in_background(task: asyncio.Task):
+    BACKGROUND_GENERATIONS.add(task)
+    task.add_done_callback(BACKGROUND_GENERATIONS.discard)
+    task.add_done_callback(log_generation_failure)
+
+
+def log_generation_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("HyDE generation failed: %r", task.exception())
+
+
+def normalize_query(query: str) -> str:
+    """Folds case, punctuation and whitespace so rephrasings of the same text share
+    a cache entry
+    """
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
+class HyDEPassageCache:
+    """Least recently used cache of hypothetical passages keyed by normalized query"""
+
+    def __init__(self, max_entries: int = HYDE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.passages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, query: str):
+        key = normalize_query(query)
+        with self.lock:
+            passage = self.passages.get(key)
+            if passage is not None:
+                self.passages.move_to_end(key)
+            return passage
+
+    def put(self, query: str, passage: str):
+        key = normalize_query(query)
+        with self.lock:
+            self.passages[key] = passage
+            self.passages.move_to_end(key)
+            while len(self.passages) > self.max_entries:
+                self.passages.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.passages.clear()
+
+
+HYDE_PASSAGE_CACHE = HyDEPassageCache()
+
+
+def merge_candidates(*candidate_sets) -> list:
+    """Combines retrieved nodes, keeping the best score of any duplicate"""
+    merged = {}
+    for candidates in candidate_sets:
+        for node in candidates:
+            best = merged.get(node.node.node_id)
+            if best is None or (node.score or 0.0) > (best.score or 0.0):
+                merged[node.node.node_id] = node
+    return sorted(merged.values(), key=lambda node: node.score or 0.0, reverse=True)
+
+
+class SpeculativeHyDEQueryEngine(InstrumentedQueryEngine):
+    """HyDE without putting the passage generation in front of retrieval
+
+    Retrieval on the raw query starts straight away while the LLM writes the
+    hypothetical passage. Once the passage arrives, a second retrieval on its
+    embedding is merged into the candidates; if it is not ready by the deadline
+    (seconds from the start of the query) the engine continues without it while
+    the generation finishes in the background. Passages are cached, so repeated
+    questions skip generation. Stage timings are returned in
+    response.metadata["timings"].
+    """
+
+    def __init__(
+        self,
+        query_engine: RetrieverQueryEngine,
+        deadline: float,
+        passage_cache: HyDEPassageCache = HYDE_PASSAGE_CACHE,
+        hyde_prompt=CUSTOM_HYDE_PROMPT,
+    ):
+        super().__init__(query_engine)
+        self._deadline = deadline
+        self._passage_cache = passage_cache
+        self._hyde_prompt = hyde_prompt
+
+    def _generate_passage(self, query_str: str, timings: dict) -> str:
+        with timed_stage("hyde", timings):
+            passage = get_llm().predict(self._hyde_prompt, context_str=query_str)
+        self._passage_cache.put(query_str, passage)
+        return passage
+
+    async def _agenerate_passage(self, query_str: str, timings: dict) -> str:
+        with timed_stage("hyde", timings):
+            passage = await get_llm().apredict(self._hyde_prompt, context_str=query_str)
+        self._passage_cache.put(query_str, passage)
+        return passage
+
+    def _hyde_query_bundle(self, query_bundle: QueryBundle, passage: str):
+        return QueryBundle(
+            query_str=query_bundle.query_str, custom_embedding_strs=[passage]
+        )
+
+    def _query(self, query_bundle):
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            response = self._speculative_query(query_bundle)
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    def _speculative_query(self, query_bundle):
+        timings = {}
+        start = time.perf_counter()
+        passage = self._passage_cache.get(query_bundle.query_str)
+        timings["hyde_cache_hit"] = passage is not None
+        future = None
+        if passage is None:
+            future = HYDE_EXECUTOR.submit(
+                contextvars.copy_context().run,
+                self._generate_passage,
+                query_bundle.query_str,
+                timings,
+            )
+
+        with timed_stage("retrieval", timings):
+            nodes = self._retriever.retrieve(query_bundle)
+
+        if future is not None:
+            with timed_stage("hyde_wait", timings):
+                remaining = self._deadline - (time.perf_counter() - start)
+                try:
+                    passage = future.result(timeout=max(remaining, 0.0))
+                except FutureTimeoutError:
+                    # A generation already running in its thread finishes and is cached
+                    future.cancel()
+                except Exception:
+                    logger.exception("HyDE generation failed, using the raw query only")
+
+        if passage is not None:
+            with timed_stage("hyde_retrieval", timings):
+                hyde_nodes = self._retriever.retrieve(
+                    self._hyde_query_bundle(query_bundle, passage)
+                )
+            nodes = merge_candidates(nodes, hyde_nodes)
+        timings["hyde_used"] = passage is not None
+        remember_nodes(nodes)
+
+        with timed_stage("rerank", timings):
+            nodes = self._apply_node_postprocessors(nodes, query_bundle=query_bundle)
+        remember_nodes(nodes)
+
+        with timed_stage("synthesis", timings, estimate=not self.streaming):
+            response = self._response_synthesizer.synthesize(
+                query=query_bundle, nodes=nodes
+            )
+        timings["total"] = time.perf_counter() - start
+        response.metadata = {**(response.metadata or {}), "timings": timings}
+        return response
+
+    async def _aquery(self, query_bundle):
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            response = await self._aspeculative_query(query_bundle)
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    async def _aspeculative_query(self, query_bundle):
+        timings = {}
+        start = time.perf_counter()
+        passage = self._passage_cache.get(query_bundle.query_str)
+        timings["hyde_cache_hit"] = passage is not None
+        task = None
+        if passage is None:
+            task = asyncio.create_task(
+                self._agenerate_passage(query_bundle.query_str, timings)
+            )
+
+        try:
+            with timed_stage("retrieval", timings):
+                nodes = await self._retriever.aretrieve(query_bundle)
+        except BaseException:
+            if task is not None:
+                task.cancel()
+            raise
+
+        if task is not None:
+            with timed_stage("hyde_wait", timings):
+                remaining = self._deadline - (time.perf_counter() - start)
+                try:
+                    # Shielded, so a generation that misses the deadline still
+                    # finishes and is cached for the next time the question comes
+                    passage = await asyncio.wait_for(
+                        asyncio.shield(task), timeout=max(remaining, 0.0)
+                    )
+                except asyncio.TimeoutError:
+                    finish_in_background(task)
+                except asyncio.CancelledError:
+                    finish_in_background(task)
+                    raise
+                except Exception:
+                    logger.exception("HyDE generation failed, using the raw query only")
+
+        if passage is not None:
+            with timed_stage("hyde_retrieval", timings):
+                hyde_nodes = await self._retriever.aretrieve(
+                    self._hyde_query_bundle(query_bundle, passage)
+                )
+            nodes = merge_candidates(nodes, hyde_nodes)
+        timings["hyde_used"] = passage is not None
+        remember_nodes(nodes)
+
+        with timed_stage("rerank", timings):
+            nodes = await self._async_apply_node_postprocessors(
+                nodes, query_bundle=query_bundle
+            )
+        remember_nodes(nodes)
+
+        with timed_stage("synthesis", timings, estimate=not self.streaming):
+            response = await self._response_synthesizer.asynthesize(
+                query=query_bundle, nodes=nodes
+            )
+        timings["total"] = time.perf_counter() - start
+        response.metadata = {**(response.metadata or {}), "timings": timings}
+        return response
@@ -1,39 +1,314 @@
+import asyncio
+import os
+import random
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from hashlib import sha256
+from itertools import islice
+
 from llama_index.core import (
     SimpleDirectoryReader,
     StorageContext,
     VectorStoreIndex,
 )
 from llama_index.core.extractors import QuestionsAnsweredExtractor
-from llama_index.core.ingestion import IngestionPipeline
-from llama_index.core.node_parser import TokenTextSplitter
+from llama_index.core.ingestion import IngestionCache
+from llama_index.core.ingestion.pipeline import remove_unstable_values
+from llama_index.core.node_parser import MarkdownNodeParser, TokenTextSplitter
+from llama_index.core.schema import MetadataMode, NodeRelationship
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+
+from backend.constants import (
+    API_URL,
+    EXTRACTION_BACKOFF,
+    EXTRACTION_CONCURRENCY,
+    EXTRACTION_MAX_RETRIES,
+    EXTRACTION_REPORT_INTERVAL,
+    INDEX_REFRESH_TOKEN,
+    INGESTION_BATCH_SIZE,
+    INGESTION_STORAGE_DIR,
+    QDRANT_COLLECTION_PER_GUIDE,
+    STYLE_GUIDE_DIR,
+    VECTOR_STORE_BACKEND,
+)
+from backend.resources import (
+    configure_llama_index,
+    get_collection_vector_store,
+    get_embed_model,
+    get_llm,
+    get_vector_store,
+)
+from backend.utils.sqlite_kvstore import SQLiteKVStore
+
+INGESTION_STORAGE_FILE = "ingestion.sqlite"
+# Chunks whose extraction still failed after every retry, kept in the ingestion
+# storage file until a later run extracts them
+DEAD_LETTER_COLLECTION = "dead_letters"
+# Each vector store backend keeps its own record of ingested chunks, while the
+# transformation cache is shared so switching backends does not redo extraction
+DOCSTORE_NAMESPACE = None if VECTOR_STORE_BACKEND == "qdrant" else VECTOR_STORE_BACKEND
+
+INGESTION_HOOKS = []
 
-from backend.constants import VECTOR_STORE, Settings
+
+def register_ingestion_hook(hook):
+    """Registers a callable to run whenever new content is written to a vector store"""
+    INGESTION_HOOKS.append(hook)
+
+
+def run_ingestion_hooks():
+    """Lets long-lived consumers (query engines, caches) drop stale state"""
+    for hook in INGESTION_HOOKS:
+        hook()
+
+
+def set_text_splitter() -> TokenTextSplitter:
+    """Configures how a document is broken into chunks"""
+    return TokenTextSplitter(separator=" ", chunk_size=350, chunk_overlap=50)
 
 
 def set_transformations() -> list:
-    """Configures how a document should be changed for the vector store"""
-    text_splitter = TokenTextSplitter(separator=" ", chunk_size=350, chunk_overlap=50)
+    """Configures how new chunks are enriched with metadata before embedding"""
     extractors = [
-        QuestionsAnsweredExtractor(questions=2),
+        QuestionsAnsweredExtractor(llm=get_llm(), questions=2, show_progress=False),
     ]
-    transformations = [text_splitter] + extractors
-    return transformations
+    return extractors
 
 
-def transform_document_to_nodes(documents, transformations):
-    """Applies transformations to document to break it into nodes"""
-    pipeline = IngestionPipeline(transformations=transformations)
+def hash_text(text: str) -> str:
+    return sha256(text.encode("utf-8")).hexdigest()
 
-    nodes = pipeline.run(
-        documents=documents, in_place=True, show_progress=True, num_workers=8
-    )
+
+def load_ingestion_storage(
+    storage_dir=INGESTION_STORAGE_DIR, docstore_namespace=DOCSTORE_NAMESPACE
+):
+    """Opens the docstore of ingested content hashes and the transformation cache
+
+    Both live in one SQLite file and every write is committed immediately, so an
+    interrupted run keeps everything it finished and memory use stays flat
+    """
+    kvstore = SQLiteKVStore(os.path.join(storage_dir, INGESTION_STORAGE_FILE))
+    docstore = KVDocumentStore(kvstore, namespace=docstore_namespace)
+    cache = IngestionCache(cache=kvstore)
+    return docstore, cache
+
+
+class IngestionStats:
+    """Collects the time spent and items handled by each ingestion stage"""
+
+    UNITS = {
+        "read": "docs",
+        "split": "nodes",
+        "extract": "nodes",
+        "embed": "vectors",
+        "upsert": "vectors",
+    }
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def count(self, stage: str, items: int):
+        self.counts[stage] += items
+
+    def report(self):
+        for stage, unit in self.UNITS.items():
+            seconds, items = self.seconds[stage], self.counts[stage]
+            print(
+                f"{stage:>8}: {items} {unit} in {seconds:.2f}s "
+                f"({items / seconds if seconds else 0:.1f} {unit}/s)"
+            )
+
+
+def iter_directory_documents(input_dir: str):
+    """Reads files one at a time instead of loading the whole directory"""
+    reader = SimpleDirectoryReader(input_dir, filename_as_id=True)
+    for documents in reader.iter_data():
+        yield from documents
+
+
+def iter_guide_files(input_dir: str) -> list:
+    """The style guide files directly inside input_dir, as the reader sees them"""
+    return [
+        os.path.join(input_dir, file_name)
+        for file_name in sorted(os.listdir(input_dir))
+        if not file_name.startswith(".")
+        and os.path.isfile(os.path.join(input_dir, file_name))
+    ]
+
+
+@lru_cache(maxsize=None)
+def available_guides(input_dir: str = STYLE_GUIDE_DIR) -> frozenset:
+    """Names of the guides in input_dir that a query can be scoped to"""
+    from backend.utils.qdrant_collections import guide_name
+
+    if not os.path.isdir(input_dir):
+        return frozenset()
+    return frozenset(guide_name(file_path) for file_path in iter_guide_files(input_dir))
+
+
+register_ingestion_hook(available_guides.cache_clear)
+
+
+def iter_file_documents(file_path: str):
+    reader = SimpleDirectoryReader(input_files=[file_path], filename_as_id=True)
+    for documents in reader.iter_data():
+        yield from documents
+
+
+def read_document_batches(documents, stats: IngestionStats, batch_size: int):
+    iterator = iter(documents)
+    while True:
+        with stats.measure("read"):
+            batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        stats.count("read", len(batch))
+        yield batch
+
+
+def split_documents_into_chunks(documents, text_splitter) -> list:
+    """Splits documents into chunks whose ids are derived from their content,
+    so an unchanged chunk keeps its id (and its vector) across ingestion runs
+
+    Documents are cut at markdown headers before token splitting, so an edit only
+    shifts the chunk boundaries inside its own section
+    """
+    section_parser = MarkdownNodeParser()
+    chunks = {}
+    for document in documents:
+        sections = section_parser.get_nodes_from_documents([document])
+        for chunk in text_splitter(sections):
+            chunk.relationships[NodeRelationship.SOURCE] = (
+                document.as_related_node_info()
+            )
+            chunk.id_ = str(
+                uuid.uuid5(
+                    uuid.NAMESPACE_URL, f"{document.doc_id}:{hash_text(chunk.text)}"
+                )
+            )
+            chunks.setdefault(chunk.id_, chunk)
+    return list(chunks.values())
+
+
+def apply_cached_transformation(nodes, transformation, cache: IngestionCache):
+    """Copies earlier results onto any chunk whose content and transformation
+    settings have been seen before, and returns the (key, chunk) pairs still to do
+    """
+    transform_string = remove_unstable_values(str(transformation.to_dict()))
+    pending = []
+    for node in nodes:
+        key = hash_text(
+            node.get_content(metadata_mode=MetadataMode.EMBED) + transform_string
+        )
+        cached_nodes = cache.get(key)
+        if cached_nodes is None:
+            pending.append((key, node))
+            continue
+        node.metadata.update(cached_nodes[0].metadata)
+        node.embedding = cached_nodes[0].embedding
+    return pending
+
+
+def run_cached_transformation(nodes, transformation, cache: IngestionCache) -> list:
+    """Applies a transformation to the chunks that are not in the cache yet"""
+    pending = apply_cached_transformation(nodes, transformation, cache)
+    if pending:
+        transformed_nodes = transformation(
+            [node for _, node in pending], show_progress=True
+        )
+        for (key, _), node in zip(pending, transformed_nodes):
+            cache.put(key, [node])
     return nodes
 
 
+async def extract_with_retries(extractor, node, max_retries=EXTRACTION_MAX_RETRIES):
+    """Runs one extractor LLM call, backing off exponentially when Ollama fails"""
+    for attempt in range(max_retries + 1):
+        try:
+            metadata_list = await extractor.aextract([node])
+            return metadata_list[0]
+        except Exception as error:
+            if attempt == max_retries:
+                raise
+            delay = EXTRACTION_BACKOFF * 2**attempt * (1 + random.random())
+            print(f"Extraction failed ({error!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def arun_cached_extraction(
+    nodes,
+    extractor,
+    cache: IngestionCache,
+    concurrency: int = EXTRACTION_CONCURRENCY,
+) -> list:
+    """Extracts metadata for uncached chunks with at most `concurrency` LLM calls
+    in flight, matching the number of requests Ollama serves in parallel
+
+    Each result is committed to the transformation cache as soon as it arrives,
+    so a crashed run resumes where it stopped. Chunks that still fail after every
+    retry are recorded as dead letters instead of stopping the run, and their ids
+    are returned
+    """
+    pending = apply_cached_transformation(nodes, extractor, cache)
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = {"done": 0}
+    failed_chunk_ids = []
+    start = time.perf_counter()
+
+    def report():
+        elapsed = time.perf_counter() - start
+        print(
+            f"Extracted {progress['done']}/{len(pending)} chunks "
+            f"({progress['done'] / max(elapsed, 1e-9):.2f} chunks/s)"
+        )
+
+    async def extract(key, node):
+        async with semaphore:
+            try:
+                metadata = await extract_with_retries(extractor, node)
+            except Exception as error:
+                print(f"Giving up on chunk {node.id_} of {node.ref_doc_id}: {error!r}")
+                cache.cache.put(
+                    node.id_,
+                    {"ref_doc_id": node.ref_doc_id, "error": repr(error)},
+                    collection=DEAD_LETTER_COLLECTION,
+                )
+                failed_chunk_ids.append(node.id_)
+                return
+        node.metadata.update(metadata)
+        cache.put(key, [node])
+        cache.cache.delete(node.id_, collection=DEAD_LETTER_COLLECTION)
+        progress["done"] += 1
+        if progress["done"] % EXTRACTION_REPORT_INTERVAL == 0:
+            report()
+
+    try:
+        await asyncio.gather(*[extract(key, node) for key, node in pending])
+    finally:
+        if pending:
+            report()
+    return failed_chunk_ids
+
+
 def retrieve_index(vector_store, nodes=None):
     """Returns updated index with new content nodes, or
     returns existing index
     """
+    configure_llama_index()
     if nodes:
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
         index = VectorStoreIndex(
@@ -44,16 +319,196 @@ def retrieve_index(vector_store, nodes=None):
     return index
 
 
-def create_vector_store_from_nodes(vector_store, documents):
-    """Creates and adds new content to a vector store
-    If vector store table already exists, adds content to it
+def ingest_document_batch(
+    vector_store,
+    documents,
+    docstore: KVDocumentStore,
+    cache,
+    stats: IngestionStats,
+    runner: asyncio.Runner,
+):
+    """Splits, enriches, embeds and upserts the new or changed chunks of a batch
+    of documents, and deletes the vectors of chunks those documents no longer have
+
+    Extraction runs on the event loop of runner, shared by every batch of the
+    run, since the LLM's async HTTP client is bound to the loop it first used.
+    Chunks whose extraction failed are left out, and their documents keep their
+    old content hash so the next run tries them again
     """
-    transformations = set_transformations()
-    nodes = transform_document_to_nodes(documents, transformations)
-    index = retrieve_index(vector_store, nodes)
-    return index
+    changed_documents = [
+        document
+        for document in documents
+        if docstore.get_document_hash(document.doc_id) != hash_text(document.text)
+    ]
+    with stats.measure("split"):
+        chunks = split_documents_into_chunks(changed_documents, set_text_splitter())
+    stats.count("split", len(chunks))
+
+    stale_chunk_ids = []
+    for document in changed_documents:
+        ref_doc_info = docstore.get_ref_doc_info(document.doc_id)
+        if ref_doc_info is not None:
+            stale_chunk_ids.extend(ref_doc_info.node_ids)
+    current_chunk_ids = {chunk.id_ for chunk in chunks}
+    stale_chunk_ids = [id_ for id_ in stale_chunk_ids if id_ not in current_chunk_ids]
+    new_chunks = [chunk for chunk in chunks if not docstore.document_exists(chunk.id_)]
+    delete_chunks(vector_store, docstore, stale_chunk_ids)
+
+    failed_chunk_ids = set()
+    with stats.measure("extract"):
+        for extractor in set_transformations():
+            failed_chunk_ids.update(
+                runner.run(arun_cached_extraction(new_chunks, extractor, cache))
+            )
+    new_chunks = [chunk for chunk in new_chunks if chunk.id_ not in failed_chunk_ids]
+    stats.count("extract", len(new_chunks))
+
+    with stats.measure("embed"):
+        new_chunks = run_cached_transformation(new_chunks, get_embed_model(), cache)
+    stats.count("embed", len(new_chunks))
+
+    if new_chunks:
+        with stats.measure("upsert"):
+            vector_store.add(new_chunks)
+        stats.count("upsert", len(new_chunks))
+        docstore.add_documents(
+            [chunk.model_copy(update={"embedding": None}) for chunk in new_chunks]
+        )
+
+    failed_document_ids = {
+        chunk.ref_doc_id for chunk in chunks if chunk.id_ in failed_chunk_ids
+    }
+    docstore.set_document_hashes(
+        {
+            document.doc_id: hash_text(document.text)
+            for document in changed_documents
+            if document.doc_id not in failed_document_ids
+        }
+    )
+    return len(new_chunks), len(stale_chunk_ids)
+
+
+def delete_chunks(vector_store, docstore: KVDocumentStore, chunk_ids: list):
+    if not chunk_ids:
+        return
+    vector_store.delete_nodes(chunk_ids)
+    for chunk_id in chunk_ids:
+        docstore.delete_document(chunk_id, raise_error=False)
+
+
+def create_vector_store_from_nodes(
+    vector_store,
+    documents,
+    storage_dir=INGESTION_STORAGE_DIR,
+    batch_size: int = INGESTION_BATCH_SIZE,
+    docstore_namespace=DOCSTORE_NAMESPACE,
+):
+    """Brings a vector store in line with the given documents
+
+    Documents can be any iterable and are consumed in batches of `batch_size`, so
+    memory use depends on the batch size rather than the size of the corpus.
+    Only new or changed chunks are enriched, embedded and written, and vectors of
+    chunks that were changed or removed since the last run are deleted.
+    Stores with deferred_writes(), like the local store, save the whole run at once
+    """
+    docstore, cache = load_ingestion_storage(storage_dir, docstore_namespace)
+    stored_document_ids = set(docstore.get_all_ref_doc_info() or {})
+    stats = IngestionStats()
+    seen_document_ids = set()
+    new_chunk_count, stale_chunk_count = 0, 0
+    with getattr(vector_store, "deferred_writes", nullcontext)():
+        if not stored_document_ids:
+            # Without a record of earlier runs the collection contents are unknown,
+            # so it is rebuilt rather than filled with duplicates
+            vector_store.clear()
+
+        with asyncio.Runner() as runner:
+            for batch in read_document_batches(documents, stats, batch_size):
+                seen_document_ids.update(document.doc_id for document in batch)
+                new_chunks, stale_chunks = ingest_document_batch(
+                    vector_store, batch, docstore, cache, stats, runner
+                )
+                new_chunk_count += new_chunks
+                stale_chunk_count += stale_chunks
+
+        for document_id in stored_document_ids - seen_document_ids:
+            ref_doc_info = docstore.get_ref_doc_info(document_id)
+            delete_chunks(vector_store, docstore, ref_doc_info.node_ids)
+            stale_chunk_count += len(ref_doc_info.node_ids)
+            docstore.delete_ref_doc(document_id, raise_error=False)
+
+    stats.report()
+    print(
+        f"Ingested {new_chunk_count} new chunks, removed {stale_chunk_count} stale chunks"
+    )
+    if new_chunk_count or stale_chunk_count:
+        run_ingestion_hooks()
+    return retrieve_index(vector_store)
+
+
+def notify_api_of_ingestion(api_url=API_URL):
+    """Asks a running API to refresh its query engines and caches
+    Ingestion usually runs as a separate process, so in-process hooks never reach the API
+    """
+    headers = {}
+    if INDEX_REFRESH_TOKEN:
+        headers["Authorization"] = f"Bearer {INDEX_REFRESH_TOKEN}"
+    request = urllib.request.Request(
+        f"{api_url}/index/refresh", headers=headers, method="POST"
+    )
+    try:
+        urllib.request.urlopen(request, timeout=5)
+    except urllib.error.HTTPError as error:
+        if error.code in (401, 403):
+            print(
+                f"The API at {api_url} refused the index refresh ({error.code}); "
+                "set the same INDEX_REFRESH_TOKEN for ingestion and the API, or "
+                "restart the API to pick up new content"
+            )
+        else:
+            print(
+                f"The API at {api_url} failed to refresh its index ({error.code}); "
+                "restart it to pick up new content"
+            )
+    except (urllib.error.URLError, OSError):
+        print(
+            f"Could not reach the API at {api_url}; restart it to pick up new content"
+        )
+
+
+def ingest_guide_collections(input_dir: str):
+    """Ingests every style guide into a Qdrant collection of its own, each with
+    its own record of ingested chunks
+    """
+    from backend.utils.qdrant_collections import (
+        ensure_collection,
+        guide_collection_name,
+        guide_name,
+    )
+
+    for file_path in iter_guide_files(input_dir):
+        vector_store = get_collection_vector_store(
+            guide_collection_name(guide_name(file_path))
+        )
+        create_vector_store_from_nodes(
+            vector_store,
+            iter_file_documents(file_path),
+            docstore_namespace=vector_store.collection_name,
+        )
+        ensure_collection(vector_store)
 
 
 if __name__ == "__main__":
-    documents = SimpleDirectoryReader("data/style").load_data()
-    create_vector_store_from_nodes(VECTOR_STORE, documents)
+    vector_store = get_vector_store()
+    create_vector_store_from_nodes(
+        vector_store, iter_directory_documents(STYLE_GUIDE_DIR)
+    )
+    if VECTOR_STORE_BACKEND == "qdrant":
+        from backend.utils.qdrant_collections import ensure_collection
+
+        # Collections a run creates already get the configured settings; this
+        # also applies changed settings to collections from earlier runs
+        ensure_collection(vector_store)
+        if QDRANT_COLLECTION_PER_GUIDE:
+            ingest_guide_collections(STYLE_GUIDE_DIR)
+    notify_api_of_ingestion()
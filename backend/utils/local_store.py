@@ -0,0 +1,396 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, List, Optional
+
+import bm25s
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterOperator,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from llama_index.retrievers.bm25 import BM25Retriever
+from llama_index.vector_stores.qdrant.utils import relative_score_fusion
+
+from backend.constants import LOCAL_INDEX_VERSION_GRACE
+
+EMBEDDINGS_FILE = "embeddings.npy"
+BM25_DIR = "bm25"
+CURRENT_FILE = "CURRENT"
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting them all"""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=int)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class LocalIndex:
+    """One saved version of the local store: the embedding matrix and the BM25
+    index, whose corpus holds the nodes in the same row order
+    """
+
+    def __init__(self, embeddings: np.ndarray, bm25: BM25Retriever):
+        self.embeddings = embeddings
+        self.bm25 = bm25
+
+    @classmethod
+    def load(cls, version_dir: str) -> "LocalIndex":
+        return cls(
+            np.load(os.path.join(version_dir, EMBEDDINGS_FILE), mmap_mode="r"),
+            BM25Retriever.from_persist_dir(
+                os.path.join(version_dir, BM25_DIR), show_progress=False
+            ),
+        )
+
+    @staticmethod
+    def save(version_dir: str, nodes: List[BaseNode], embeddings: np.ndarray):
+        os.makedirs(version_dir)
+        np.save(
+            os.path.join(version_dir, EMBEDDINGS_FILE), embeddings.astype(np.float32)
+        )
+        # Queries pass their own top-k, so the retriever's default is unused
+        BM25Retriever.from_defaults(nodes=nodes, similarity_top_k=1).persist(
+            os.path.join(version_dir, BM25_DIR), show_progress=False
+        )
+
+    @property
+    def corpus(self) -> list:
+        return self.bm25.corpus
+
+    def nodes(self) -> List[BaseNode]:
+        """Fresh copies of the stored nodes, which callers are free to modify"""
+        return [metadata_dict_to_node(entry) for entry in self.corpus]
+
+    def dense_query(self, query_embedding: list, top_k: int, mask) -> tuple:
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1.0
+        scores = self.embeddings @ query_vector
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        rows = top_k_indices(scores, min(top_k, int(np.sum(np.isfinite(scores)))))
+        return rows, scores[rows]
+
+    def sparse_query(self, query_str: str, top_k: int, mask) -> tuple:
+        tokens = bm25s.tokenize(
+            query_str,
+            stemmer=self.bm25.stemmer,
+            token_pattern=self.bm25.token_pattern,
+            show_progress=False,
+        )
+        rows, scores = self.bm25.bm25.retrieve(
+            tokens,
+            k=min(top_k, len(self.corpus)),
+            weight_mask=None if mask is None else mask.astype(int),
+            show_progress=False,
+        )
+        # Like a sparse vector search, documents sharing no term are not returned
+        matched = scores[0] > 0
+        return rows[0][matched], scores[0][matched]
+
+    def result(self, rows, scores) -> VectorStoreQueryResult:
+        # BM25 returns the corpus entries themselves, dense search their rows
+        nodes = [
+            metadata_dict_to_node(row if isinstance(row, dict) else self.corpus[row])
+            for row in rows
+        ]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=[float(score) for score in scores],
+            ids=[node.node_id for node in nodes],
+        )
+
+
+class StagedIndex:
+    """The nodes and embeddings of the next version, keyed by node id in row
+    order, while writes are applied to them
+    """
+
+    def __init__(self, rows: dict):
+        self.rows = rows
+        self.changed = False
+
+    @classmethod
+    def from_index(cls, index: Optional[LocalIndex]) -> "StagedIndex":
+        if index is None:
+            return cls({})
+        embeddings = np.asarray(index.embeddings)
+        return cls(
+            {
+                node.node_id: (node, np.array(embeddings[row]))
+                for row, node in enumerate(index.nodes())
+            }
+        )
+
+    def add(self, nodes: List[BaseNode]):
+        embeddings = normalize_rows(
+            np.array([node.get_embedding() for node in nodes], dtype=np.float32)
+        )
+        for node, embedding in zip(nodes, embeddings):
+            # A re-added node moves to the end, as if it were new
+            self.rows.pop(node.node_id, None)
+            self.rows[node.node_id] = (node, embedding)
+        self.changed = True
+
+    def keep(self, keep):
+        """Drops the nodes for which keep(node) is false"""
+        rows = {node_id: row for node_id, row in self.rows.items() if keep(row[0])}
+        if len(rows) != len(self.rows):
+            self.rows = rows
+            self.changed = True
+
+    def clear(self):
+        self.rows = {}
+        self.changed = True
+
+    def nodes_and_embeddings(self) -> tuple:
+        if not self.rows:
+            return [], None
+        nodes, embeddings = zip(*self.rows.values())
+        return list(nodes), np.vstack(embeddings)
+
+
+class LocalHybridVectorStore(BasePydanticVectorStore):
+    """Dense and BM25 search inside the API process, for corpora small enough
+    that a round-trip to Qdrant costs more than the search itself
+
+    Normalized embeddings are kept in one float32 matrix memory-mapped from
+    persist_dir, so cosine similarity for every chunk is a single matrix-vector
+    product. Sparse search uses the BM25 index of llama-index-retrievers-bm25,
+    and hybrid queries are fused with the same relative score fusion (and the
+    same alpha and top-k defaults) as QdrantVectorStore.
+
+    Every write saves a new version of the index and then switches CURRENT to
+    it, so an API process reading the directory picks up an ingestion run from
+    another process on its next query. Inside deferred_writes() the writes are
+    collected in memory and saved as one version on exit, so an ingestion run
+    builds the BM25 index once rather than once per batch. Replaced versions
+    are removed LOCAL_INDEX_VERSION_GRACE seconds later, once readers that
+    were loading them have finished.
+    """
+
+    stores_text: bool = True
+    persist_dir: str
+
+    _index: Optional[LocalIndex] = PrivateAttr(default=None)
+    _version: Optional[str] = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _deferred: Optional[StagedIndex] = PrivateAttr(default=None)
+
+    def __init__(self, persist_dir: str):
+        super().__init__(persist_dir=persist_dir)
+        os.makedirs(persist_dir, exist_ok=True)
+        self._refresh()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalHybridVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def _current_version(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.persist_dir, CURRENT_FILE)) as file:
+                return file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self) -> Optional[LocalIndex]:
+        """Loads the current version if another writer has replaced it"""
+        version = self._current_version()
+        if version != self._version:
+            with self._lock:
+                while version != self._version:
+                    try:
+                        self._index = (
+                            None
+                            if version is None
+                            else LocalIndex.load(
+                                os.path.join(self.persist_dir, version)
+                            )
+                        )
+                    except FileNotFoundError:
+                        # The version was replaced and removed while it loaded
+                        latest = self._current_version()
+                        if latest == version:
+                            raise
+                        version = latest
+                    else:
+                        self._version = version
+        return self._index
+
+    def _save(self, nodes: List[BaseNode], embeddings: Optional[np.ndarray]):
+        """Writes nodes and their embeddings as a new version and makes it current"""
+        previous = self._version
+        version = ""
+        if nodes:
+            version = uuid.uuid4().hex
+            LocalIndex.save(os.path.join(self.persist_dir, version), nodes, embeddings)
+        current_path = os.path.join(self.persist_dir, CURRENT_FILE)
+        with open(current_path + ".tmp", "w") as file:
+            file.write(version)
+        os.replace(current_path + ".tmp", current_path)
+        self._index = (
+            LocalIndex.load(os.path.join(self.persist_dir, version)) if nodes else None
+        )
+        self._version = version or None
+        if previous and os.path.isdir(os.path.join(self.persist_dir, previous)):
+            # Marks when the version was replaced, which starts its grace period
+            os.utime(os.path.join(self.persist_dir, previous))
+        self._remove_replaced_versions()
+
+    def _remove_replaced_versions(self):
+        """Deletes versions replaced more than LOCAL_INDEX_VERSION_GRACE seconds
+        ago; readers that mapped an old matrix keep it until they reload
+        """
+        expired = time.time() - LOCAL_INDEX_VERSION_GRACE
+        for entry in os.scandir(self.persist_dir):
+            if (
+                entry.is_dir()
+                and entry.name != self._version
+                and entry.stat().st_mtime < expired
+            ):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    @contextmanager
+    def _staged(self):
+        """The staged index that writes apply to: the deferred one, or one
+        saved as a new version as soon as the write is done
+        """
+        if self._deferred is not None:
+            yield self._deferred
+            return
+        index = self._refresh()
+        with self._lock:
+            staged = StagedIndex.from_index(index)
+            yield staged
+            if staged.changed:
+                self._save(*staged.nodes_and_embeddings())
+
+    @contextmanager
+    def deferred_writes(self):
+        """Collects every write made inside the block and saves them as one
+        version when it exits, even if it raises
+        """
+        if self._deferred is not None:
+            yield self
+            return
+        self._deferred = StagedIndex.from_index(self._refresh())
+        try:
+            yield self
+        finally:
+            staged, self._deferred = self._deferred, None
+            if staged.changed:
+                with self._lock:
+                    self._save(*staged.nodes_and_embeddings())
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        with self._staged() as staged:
+            staged.add(nodes)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._staged() as staged:
+            staged.keep(lambda node: node.ref_doc_id != ref_doc_id)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        if not node_ids and filters is None:
+            return
+        node_ids = set(node_ids or [])
+
+        def is_deleted(node: BaseNode) -> bool:
+            if node_ids and node.node_id not in node_ids:
+                return False
+            return filters is None or matches_filters(node.metadata, filters)
+
+        with self._staged() as staged:
+            staged.keep(lambda node: not is_deleted(node))
+
+    def clear(self) -> None:
+        with self._staged() as staged:
+            staged.clear()
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        index = self._refresh()
+        if index is None:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        mask = None
+        if query.filters is not None:
+            # Corpus entries hold the metadata at their top level, like a Qdrant
+            # payload, so only the returned hits are turned into nodes
+            mask = np.array(
+                [matches_filters(entry, query.filters) for entry in index.corpus]
+            )
+        sparse_top_k = query.sparse_top_k or query.similarity_top_k
+
+        if query.mode == VectorStoreQueryMode.SPARSE:
+            return index.result(
+                *index.sparse_query(query.query_str, sparse_top_k, mask)
+            )
+        dense_result = index.result(
+            *index.dense_query(query.query_embedding, query.similarity_top_k, mask)
+        )
+        if query.mode != VectorStoreQueryMode.HYBRID or query.query_str is None:
+            return dense_result
+        return relative_score_fusion(
+            dense_result,
+            index.result(*index.sparse_query(query.query_str, sparse_top_k, mask)),
+            alpha=query.alpha if query.alpha is not None else 0.5,
+            top_k=query.hybrid_top_k or query.similarity_top_k,
+        )
+
+    async def aquery(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> VectorStoreQueryResult:
+        """Runs the search in a worker thread, off the event loop"""
+        return await asyncio.to_thread(self.query, query, **kwargs)
+
+
+def matches_filters(metadata: dict, filters: MetadataFilters) -> bool:
+    """Equality filters on node metadata, combined with AND or OR"""
+    results = []
+    for metadata_filter in filters.filters:
+        if isinstance(metadata_filter, MetadataFilters):
+            results.append(matches_filters(metadata, metadata_filter))
+            continue
+        value = metadata.get(metadata_filter.key)
+        if metadata_filter.operator == FilterOperator.EQ:
+            results.append(value == metadata_filter.value)
+        elif metadata_filter.operator == FilterOperator.IN:
+            results.append(value in metadata_filter.value)
+        else:
+            raise ValueError(
+                f"Filter operator {metadata_filter.operator} is not supported"
+            )
+    if filters.condition is not None and filters.condition.value == "or":
+        return any(results)
+    return all(results)
@@ -1,32 +1,381 @@
-from sqlalchemy.orm import Session
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import socket
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
 
-from backend.constants import DB_ENGINE
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+from backend.constants import (
+    LOG_BATCH_SIZE,
+    LOG_DEAD_LETTER_PATH,
+    LOG_FLUSH_INTERVAL,
+    LOG_ID_NODE,
+    LOG_SPOOL_MAX_ROWS,
+    LOG_SPOOL_PATH,
+)
+from backend.resources import get_async_db_engine
+from backend.utils.metrics import timed_stage
 from backend.utils.models import Query, Answer, Feedback
 
+logger = logging.getLogger(__name__)
+
+
+def default_id_node() -> int:
+    """Node bits for this process: the workers of one host have consecutive
+    process ids, so they never share a node, and the host name spreads hosts
+    apart
+    """
+    return (zlib.crc32(socket.gethostname().encode()) + os.getpid()) % 1024
+
+
+# Milliseconds since 2024-01-01 shifted left by 22 bits fit a signed 64-bit column
+# for about 69 years
+ID_EPOCH_MS = 1704067200000
+ID_NODE = int(LOG_ID_NODE) % 1024 if LOG_ID_NODE else default_id_node()
+ID_SEQUENCE = itertools.count()
+
+TABLES = {"queries": Query, "answers": Answer, "feedback": Feedback}
+# Dialects whose insert can skip rows that already exist
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def generate_id() -> int:
+    """Returns a time-ordered id that is unique across API workers,
+    so rows can be written later without a round-trip to fetch their id
+    """
+    milliseconds = int(time.time() * 1000) - ID_EPOCH_MS
+    return (milliseconds << 22) | (ID_NODE << 12) | (next(ID_SEQUENCE) % 4096)
+
+
+def is_unavailable(error: Exception) -> bool:
+    """Whether the error says the database could not be reached, rather than
+    that it rejected the rows
+    """
+    if isinstance(error, (OperationalError, InterfaceError)):
+        return True
+    if isinstance(error, DBAPIError):
+        return error.connection_invalidated
+    return isinstance(error, (OSError, asyncio.TimeoutError))
+
+
+def empty_rows() -> dict:
+    return {table: [] for table in TABLES}
+
+
+class InteractionLogger:
+    """Queues query, answer and feedback rows in memory and writes them in bulk
+
+    A flush happens every flush_interval seconds or as soon as batch_size rows are
+    waiting. While the database cannot be reached, rows are spooled to a local
+    file, at most spool_max_rows of them, and retried on the next flush; spooled
+    rows that were already written are skipped. When the database rejects a
+    batch, its rows are written one at a time and those it still rejects go to
+    the dead-letter file, so one bad row cannot hold back the others. Without an
+    engine, the shared async engine is created on the first flush.
+    """
+
+    def __init__(
+        self,
+        engine=None,
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval: float = LOG_FLUSH_INTERVAL,
+        spool_path: str = LOG_SPOOL_PATH,
+        spool_max_rows: int = LOG_SPOOL_MAX_ROWS,
+        dead_letter_path: str = LOG_DEAD_LETTER_PATH,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.spool_max_rows = spool_max_rows
+        self.dead_letter_path = dead_letter_path
+        self.pending = empty_rows()
+        # Lets feedback reference its answer without looking it up in the database
+        self.answer_ids = OrderedDict()
+        self._flush_requested = None
+        self._worker = None
+
+    def log_message(self, content) -> int:
+        return self._enqueue("queries", {"content": content})
+
+    def log_messages(self, contents) -> list:
+        """Queues a batch of queries together, so they are written in one insert"""
+        return [self._enqueue("queries", {"content": content}) for content in contents]
+
+    def log_answer(self, query_id, content) -> int:
+        answer_id = self._enqueue("answers", {"query_id": query_id, "content": content})
+        self.answer_ids[query_id] = answer_id
+        if len(self.answer_ids) > 10 * self.batch_size:
+            self.answer_ids.popitem(last=False)
+        return answer_id
+
+    def log_feedback(self, query_id, rating) -> int:
+        return self._enqueue(
+            "feedback",
+            {
+                "query_id": query_id,
+                "answer_id": self.answer_ids.get(query_id),
+                "rating": rating,
+            },
+        )
+
+    async def start(self):
+        self._flush_requested = asyncio.Event()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._worker
+            self._worker = None
+        await self.flush()
+
+    async def flush(self):
+        rows = self._take_pending()
+        spooled_rows = self._read_spool()
+        if not any(rows.values()) and not any(spooled_rows.values()):
+            return
+
+        # Spooled rows are part of this batch, so the spool is rewritten as a whole
+        try:
+            with timed_stage("db_logging"):
+                unwritten = await self._write_batch(rows, spooled_rows)
+        except asyncio.CancelledError:
+            self._write_spool(self._merge(spooled_rows, rows))
+            raise
+        self._write_spool(unwritten)
+
+    @staticmethod
+    def _merge(*row_sets) -> dict:
+        return {
+            table: [row for rows in row_sets for row in rows[table]] for table in TABLES
+        }
+
+    async def _write_batch(self, rows: dict, spooled_rows: dict) -> dict:
+        """Writes the batch in one transaction, or row by row if the database
+        rejects it; returns the rows to spool because it could not be reached
+        """
+        try:
+            engine = self.engine or get_async_db_engine()
+        except Exception as error:
+            logger.warning("No interaction database, spooling logs: %r", error)
+            return self._merge(spooled_rows, rows)
+        try:
+            await self._write(engine, rows, spooled_rows)
+            return empty_rows()
+        except Exception as error:
+            if is_unavailable(error):
+                logger.warning(
+                    "Could not reach the interaction database, spooling logs: %r",
+                    error,
+                )
+                return self._merge(spooled_rows, rows)
+            logger.exception(
+                "The database rejected the interaction logs, writing them one row "
+                "at a time"
+            )
+
+        # Parents are written before the rows that reference them
+        items = [
+            (table, row, spooled)
+            for table in TABLES
+            for spooled, table_rows in ((True, spooled_rows), (False, rows))
+            for row in table_rows[table]
+        ]
+        unwritten = empty_rows()
+        for index, (table, row, spooled) in enumerate(items):
+            single = {**empty_rows(), table: [row]}
+            try:
+                if spooled:
+                    await self._write(engine, empty_rows(), single)
+                else:
+                    await self._write(engine, single, empty_rows())
+            except Exception as error:
+                if is_unavailable(error):
+                    for table, row, _ in items[index:]:
+                        unwritten[table].append(row)
+                    return unwritten
+                self._write_dead_letter(table, row, error)
+        return unwritten
+
+    def _enqueue(self, table: str, row: dict) -> int:
+        row["id"] = generate_id()
+        row["timestamp"] = datetime.now()
+        self.pending[table].append(row)
+        if (
+            self._flush_requested is not None
+            and sum(len(rows) for rows in self.pending.values()) >= self.batch_size
+        ):
+            self._flush_requested.set()
+        return row["id"]
+
+    def _take_pending(self) -> dict:
+        rows = self.pending
+        self.pending = empty_rows()
+        return rows
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_requested.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            # One failed flush must not stop logging for the life of the process
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Interaction log flush failed")
+
+    async def _write(self, engine, rows: dict, spooled_rows: dict):
+        """Inserts rows, and spooled_rows unless they exist already: a flush
+        can fail after its transaction committed and spool rows that were written
+        """
+        upsert_insert = UPSERT_INSERTS.get(engine.dialect.name)
+        async with engine.begin() as connection:
+
+            async def write(model, table_rows, spooled):
+                if not table_rows:
+                    return
+                if spooled and upsert_insert is not None:
+                    statement = upsert_insert(model).on_conflict_do_nothing(
+                        index_elements=["id"]
+                    )
+                else:
+                    statement = insert(model)
+                await connection.execute(statement, table_rows)
+
+            await write(Query, rows["queries"], False)
+            await write(Query, spooled_rows["queries"], True)
+            await write(Answer, rows["answers"], False)
+            await write(Answer, spooled_rows["answers"], True)
+
+            feedback_rows = spooled_rows["feedback"] + rows["feedback"]
+            unresolved = {
+                row["query_id"] for row in feedback_rows if row["answer_id"] is None
+            }
+            if unresolved:
+                result = await connection.execute(
+                    select(Answer.query_id, Answer.id).where(
+                        Answer.query_id.in_(unresolved)
+                    )
+                )
+                answer_ids = dict(result.all())
+                for row in feedback_rows:
+                    row["answer_id"] = row["answer_id"] or answer_ids.get(
+                        row["query_id"]
+                    )
+
+            def resolved(table_rows):
+                feedback = []
+                for row in table_rows:
+                    if row["answer_id"] is None:
+                        logger.warning(
+                            "Dropping feedback for unknown query %s", row["query_id"]
+                        )
+                        continue
+                    feedback.append(
+                        {key: value for key, value in row.items() if key != "query_id"}
+                    )
+                return feedback
+
+            await write(Feedback, resolved(rows["feedback"]), False)
+            await write(Feedback, resolved(spooled_rows["feedback"]), True)
+
+    @staticmethod
+    def _serialize(table: str, row: dict, **extra) -> str:
+        row = {**row, "timestamp": row["timestamp"].isoformat()}
+        return json.dumps({"table": table, "row": row, **extra}, default=str)
+
+    def _write_spool(self, rows: dict):
+        """Replaces the spool with rows, keeping the newest spool_max_rows, or
+        removes it when there are none
+        """
+        records = [
+            (row["timestamp"], table, row)
+            for table, table_rows in rows.items()
+            for row in table_rows
+        ]
+        try:
+            if not records:
+                if os.path.exists(self.spool_path):
+                    os.remove(self.spool_path)
+                return
+            if len(records) > self.spool_max_rows:
+                records.sort(key=lambda record: record[0])
+                logger.error(
+                    "Interaction log spool is full, dropping the %s oldest rows",
+                    len(records) - self.spool_max_rows,
+                )
+                records = records[-self.spool_max_rows :]
+            # Written aside and renamed, so a full disk cannot leave half a spool
+            temporary_path = f"{self.spool_path}.tmp"
+            with open(temporary_path, "w") as spool:
+                for _, table, row in records:
+                    spool.write(self._serialize(table, row) + "\n")
+            os.replace(temporary_path, self.spool_path)
+        except Exception:
+            logger.exception("Could not spool %s interaction log rows", len(records))
+
+    def _read_spool(self) -> dict:
+        rows = empty_rows()
+        if not os.path.exists(self.spool_path):
+            return rows
+        with open(self.spool_path) as spool:
+            for line in spool:
+                try:
+                    record = json.loads(line)
+                    row = record["row"]
+                    row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+                    rows[record["table"]].append(row)
+                except (ValueError, KeyError, TypeError) as error:
+                    self._write_dead_letter(None, line.rstrip("\n"), error)
+        return rows
+
+    def _write_dead_letter(self, table, row, error: Exception):
+        logger.error(
+            "Moving a %s row the database rejected to %s: %r",
+            table or "spooled",
+            self.dead_letter_path,
+            error,
+        )
+        try:
+            with open(self.dead_letter_path, "a") as dead_letter:
+                if table is None:
+                    record = json.dumps({"line": row, "error": repr(error)})
+                else:
+                    record = self._serialize(table, row, error=repr(error))
+                dead_letter.write(record + "\n")
+        except Exception:
+            logger.exception("Could not write to %s", self.dead_letter_path)
+
+
+INTERACTION_LOGGER = InteractionLogger()
+
 
 def log_message(content):
-    with Session(DB_ENGINE) as session:
-        db_message = Query(content=content)
-        session.add(db_message)
-        session.commit()
-        session.refresh(db_message)
-    return db_message.id
+    return INTERACTION_LOGGER.log_message(content)
+
+
+def log_messages(contents):
+    return INTERACTION_LOGGER.log_messages(contents)
 
 
 def log_answer(query_id, content):
-    with Session(DB_ENGINE) as session:
-        db_message = Answer(query_id=query_id, content=content)
-        session.add(db_message)
-        session.commit()
-        session.refresh(db_message)
-    return db_message.id
+    return INTERACTION_LOGGER.log_answer(query_id, content)
 
 
 def log_feedback(query_id, rating):
-    with Session(DB_ENGINE) as session:
-        answer_record = session.query(Answer).filter_by(query_id=query_id).first()
-        db_message = Feedback(answer_id=answer_record.id, rating=rating)
-        session.add(db_message)
-        session.commit()
-        session.refresh(db_message)
-    return db_message.id
+    return INTERACTION_LOGGER.log_feedback(query_id, rating)
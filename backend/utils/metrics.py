@@ -0,0 +1,200 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.embedding import (
+    EmbeddingEndEvent,
+    EmbeddingStartEvent,
+)
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatEndEvent,
+    LLMCompletionEndEvent,
+)
+from llama_index.core.query_engine import RetrieverQueryEngine
+from prometheus_client import Counter, Histogram
+
+from backend.utils.planner import STAGE_ESTIMATES, remember_nodes
+
+STAGE_DURATION = Histogram(
+    "rag_stage_duration_seconds",
+    "Time spent in each stage of answering a query",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+STAGE_ERRORS = Counter(
+    "rag_stage_errors_total", "Exceptions raised in each stage", ["stage"]
+)
+LLM_TOKENS = Counter(
+    "rag_llm_tokens_total",
+    "Prompt and completion tokens counted by Ollama for each stage",
+    ["stage", "kind"],
+)
+
+# The stage running in the current request or task, so LLM token counts and
+# embeddings can be attributed to it
+CURRENT_STAGE = ContextVar("current_stage", default="unknown")
+# Per-request breakdown returned with the debug header, None outside a request
+REQUEST_STAGES = ContextVar("request_stages", default=None)
+
+
+def start_request_stages() -> dict:
+    """Collects the stages of the current request into the returned dict"""
+    stages = {}
+    REQUEST_STAGES.set(stages)
+    return stages
+
+
+def record_stage(
+    stage: str, seconds: float, timings: dict = None, estimate: bool = True
+):
+    """Records a stage duration; estimate=False keeps it out of the timing
+    estimates the planner uses, for samples that do not cover the whole stage
+    """
+    STAGE_DURATION.labels(stage).observe(seconds)
+    if estimate:
+        STAGE_ESTIMATES.observe(stage, seconds)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+    stages = REQUEST_STAGES.get()
+    if stages is not None:
+        entry = stages.setdefault(stage, {"seconds": 0.0})
+        entry["seconds"] += seconds
+
+
+def record_tokens(stage: str, prompt_tokens: int, completion_tokens: int):
+    LLM_TOKENS.labels(stage, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(stage, "completion").inc(completion_tokens)
+    stages = REQUEST_STAGES.get()
+    if stages is not None:
+        entry = stages.setdefault(stage, {"seconds": 0.0})
+        entry["prompt_tokens"] = entry.get("prompt_tokens", 0) + prompt_tokens
+        entry["completion_tokens"] = (
+            entry.get("completion_tokens", 0) + completion_tokens
+        )
+
+
+@contextmanager
+def timed_stage(stage: str, timings: dict = None, estimate: bool = True):
+    """Times the enclosed block as one stage, counting any exception it raises
+
+    The duration goes to the Prometheus histogram, to the request breakdown if
+    one was started and, when given, to timings. It also feeds the planner's
+    estimates unless estimate is False or the block was cancelled part way.
+    """
+    token = CURRENT_STAGE.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        estimate = False
+        raise
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start, timings, estimate)
+        CURRENT_STAGE.reset(token)
+
+
+class StageEventHandler(BaseEventHandler):
+    """Records query embeddings as a stage and the Ollama token counts of every
+    LLM call under the stage that made it
+
+    Embeddings run inside the retrieval (or semantic cache) stage that needs
+    them and are already part of its time, so they are kept out of the
+    planner's estimates.
+    """
+
+    embedding_starts: dict = {}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StageEventHandler"
+
+    def handle(self, event, **kwargs):
+        if isinstance(event, EmbeddingStartEvent):
+            self.embedding_starts[event.span_id] = time.perf_counter()
+        elif isinstance(event, EmbeddingEndEvent):
+            start = self.embedding_starts.pop(event.span_id, None)
+            if start is not None:
+                record_stage("embedding", time.perf_counter() - start, estimate=False)
+        elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            raw = getattr(event.response, "raw", None) or {}
+            record_tokens(
+                CURRENT_STAGE.get(),
+                raw.get("prompt_eval_count") or 0,
+                raw.get("eval_count") or 0,
+            )
+
+
+get_dispatcher().add_event_handler(StageEventHandler())
+
+
+class InstrumentedQueryEngine(RetrieverQueryEngine):
+    """Query engine that records retrieval, rerank and synthesis as stages
+
+    Dense and sparse search go to Qdrant in one request, so they are timed
+    together as retrieval, which also covers embedding the query. A
+    streaming synthesizer returns before the answer is written, so its
+    synthesis time is kept out of the planner's estimates.
+    """
+
+    def __init__(self, query_engine: RetrieverQueryEngine):
+        super().__init__(
+            retriever=query_engine.retriever,
+            response_synthesizer=query_engine._response_synthesizer,
+            node_postprocessors=query_engine._node_postprocessors,
+            callback_manager=query_engine.callback_manager,
+        )
+
+    @property
+    def streaming(self) -> bool:
+        return getattr(self._response_synthesizer, "_streaming", False)
+
+    def retrieve(self, query_bundle):
+        with timed_stage("retrieval"):
+            nodes = self._retriever.retrieve(query_bundle)
+        remember_nodes(nodes)
+        with timed_stage("rerank"):
+            nodes = self._apply_node_postprocessors(nodes, query_bundle=query_bundle)
+        remember_nodes(nodes)
+        return nodes
+
+    async def aretrieve(self, query_bundle):
+        with timed_stage("retrieval"):
+            nodes = await self._retriever.aretrieve(query_bundle)
+        remember_nodes(nodes)
+        with timed_stage("rerank"):
+            nodes = await self._async_apply_node_postprocessors(
+                nodes, query_bundle=query_bundle
+            )
+        remember_nodes(nodes)
+        return nodes
+
+    def _query(self, query_bundle):
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            nodes = self.retrieve(query_bundle)
+            with timed_stage("synthesis", estimate=not self.streaming):
+                response = self._response_synthesizer.synthesize(
+                    query=query_bundle, nodes=nodes
+                )
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    async def _aquery(self, query_bundle):
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            nodes = await self.aretrieve(query_bundle)
+            with timed_stage("synthesis", estimate=not self.streaming):
+                response = await self._response_synthesizer.asynthesize(
+                    query=query_bundle, nodes=nodes
+                )
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
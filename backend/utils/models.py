@@ -1,8 +1,8 @@
-from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey
+from sqlalchemy import BigInteger, Column, Integer, Text, DateTime, ForeignKey, text
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
-from backend.constants import DB_ENGINE
+from backend.resources import get_db_engine
 
 Base = declarative_base()
 
@@ -10,31 +10,55 @@ Base = declarative_base()
 class Query(Base):
     __tablename__ = "queries"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
     content = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.now())
+    timestamp = Column(DateTime, default=datetime.now)
 
 
 class Answer(Base):
     __tablename__ = "answers"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    query_id = Column(Integer, ForeignKey("queries.id"), nullable=False)
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    query_id = Column(BigInteger, ForeignKey("queries.id"), nullable=False, index=True)
     content = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.now())
+    timestamp = Column(DateTime, default=datetime.now)
 
 
 class Feedback(Base):
     __tablename__ = "feedback"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    answer_id = Column(Integer, ForeignKey("answers.id"), nullable=False)
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    answer_id = Column(BigInteger, ForeignKey("answers.id"), nullable=False, index=True)
     rating = Column(Integer)
     timestamp = Column(
         DateTime,
-        default=datetime.now(),
+        default=datetime.now,
     )
 
 
+# Ids are generated by the API, so they no longer fit the original 32-bit serial columns
+BIGINT_COLUMNS = [
+    ("queries", "id"),
+    ("answers", "id"),
+    ("answers", "query_id"),
+    ("feedback", "id"),
+    ("feedback", "answer_id"),
+]
+
+
+def migrate(engine):
+    """Creates missing tables and brings tables from earlier versions up to date"""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            for table, column in BIGINT_COLUMNS:
+                connection.execute(
+                    text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT")
+                )
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+
 if __name__ == "__main__":
-    Base.metadata.create_all(bind=DB_ENGINE)
+    migrate(get_db_engine())
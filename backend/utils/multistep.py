@@ -0,0 +1,209 @@
+import asyncio
+import contextvars
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.response_synthesizers import (
+    ResponseMode,
+    get_response_synthesizer,
+)
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from backend.constants import MULTISTEP_CONCURRENCY
+from backend.resources import get_llm
+from backend.utils.hyde import merge_candidates
+from backend.utils.metrics import timed_stage
+from backend.utils.prompts import SUB_QUESTION_PROMPT
+
+logger = logging.getLogger(__name__)
+
+
+def parse_sub_questions(text: str, max_questions: int) -> Optional[tuple]:
+    """Reads (questions, independent) from the decomposition output, or None if
+    the model did not answer in the expected form; independent is None when the
+    model did not say whether the sub-questions depend on each other
+    """
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if match is None:
+        return None
+    try:
+        decomposition = json.loads(match.group())
+    except json.JSONDecodeError:
+        return None
+    questions = decomposition.get("questions")
+    if not isinstance(questions, list):
+        return None
+    questions = [
+        question.strip()
+        for question in questions
+        if isinstance(question, str) and question.strip()
+    ]
+    questions = list(dict.fromkeys(questions))[:max_questions]
+    if not questions:
+        return None
+    independent = decomposition.get("independent")
+    if not isinstance(independent, bool):
+        independent = None
+    return questions, independent
+
+
+class ParallelMultiStepQueryEngine(BaseQueryEngine):
+    """Multistep querying that asks every sub-question at once
+
+    The query is decomposed into sub-questions with one LLM call. When the model
+    reports them as independent, each is retrieved and answered concurrently,
+    at most concurrency at a time; the retrieved nodes are deduplicated and a
+    single synthesis answers the original query from the sub-answers and those
+    nodes. Dependent sub-questions go to sequential_engine, which asks one step
+    at a time; when the decomposition cannot be read, or does not say whether
+    the sub-questions are independent, query_engine answers the query directly.
+    """
+
+    def __init__(
+        self,
+        query_engine: RetrieverQueryEngine,
+        sequential_engine: BaseQueryEngine,
+        max_sub_questions: int = 4,
+        concurrency: int = MULTISTEP_CONCURRENCY,
+        sub_question_prompt=SUB_QUESTION_PROMPT,
+    ):
+        self._query_engine = query_engine
+        self._sequential_engine = sequential_engine
+        self._max_sub_questions = max_sub_questions
+        self._concurrency = concurrency
+        self._sub_question_prompt = sub_question_prompt
+        # Sub-answers are read whole by the final synthesis, so they never stream
+        self._sub_answer_synthesizer = get_response_synthesizer(
+            response_mode=ResponseMode.COMPACT
+        )
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self):
+        return {}
+
+    def _read_decomposition(self, text: str) -> Optional[tuple]:
+        decomposition = parse_sub_questions(text, self._max_sub_questions)
+        if decomposition is None or decomposition[1] is None:
+            logger.warning("Could not parse sub-questions, answering in one step")
+        return decomposition
+
+    def _single_engine(self, decomposition: Optional[tuple]):
+        """The engine that answers the whole query, or None when the
+        sub-questions are answered in parallel
+        """
+        if decomposition is None or decomposition[1] is None:
+            return self._query_engine
+        questions, independent = decomposition
+        if not independent:
+            return self._sequential_engine
+        if len(questions) == 1:
+            return self._query_engine
+        return None
+
+    def _combine(self, sub_results: list) -> tuple:
+        """Nodes for the final synthesis: the sub-answers, then every retrieved
+        node once; the second item is the deduplicated sources alone
+        """
+        sources = merge_candidates(*(nodes for _, _, nodes in sub_results))
+        sub_answers = [
+            NodeWithScore(node=TextNode(text=f"Question: {question}\nAnswer: {answer}"))
+            for question, answer, _ in sub_results
+        ]
+        return sub_answers + sources, sources
+
+    def _finish(self, response, sub_results: list, sources: list):
+        response.source_nodes = sources
+        response.metadata = {
+            **(response.metadata or {}),
+            "sub_qa": [(question, answer) for question, answer, _ in sub_results],
+        }
+        return response
+
+    def _answer_sub_question(self, question: str) -> tuple:
+        query_bundle = QueryBundle(question)
+        nodes = self._query_engine.retrieve(query_bundle)
+        with timed_stage("sub_question_synthesis"):
+            answer = self._sub_answer_synthesizer.synthesize(
+                query=query_bundle, nodes=nodes
+            )
+        return question, str(answer), nodes
+
+    async def _aanswer_sub_question(
+        self, question: str, semaphore: asyncio.Semaphore
+    ) -> tuple:
+        async with semaphore:
+            query_bundle = QueryBundle(question)
+            nodes = await self._query_engine.aretrieve(query_bundle)
+            with timed_stage("sub_question_synthesis"):
+                answer = await self._sub_answer_synthesizer.asynthesize(
+                    query=query_bundle, nodes=nodes
+                )
+        return question, str(answer), nodes
+
+    def _query(self, query_bundle: QueryBundle):
+        with timed_stage("decomposition"):
+            decomposition = self._read_decomposition(
+                get_llm().predict(
+                    self._sub_question_prompt,
+                    max_questions=self._max_sub_questions,
+                    query_str=query_bundle.query_str,
+                )
+            )
+        engine = self._single_engine(decomposition)
+        if engine is not None:
+            return engine.query(query_bundle)
+        questions = decomposition[0]
+
+        with timed_stage("sub_questions"):
+            with ThreadPoolExecutor(self._concurrency) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self._answer_sub_question,
+                        question,
+                    )
+                    for question in questions
+                ]
+                sub_results = [future.result() for future in futures]
+
+        nodes, sources = self._combine(sub_results)
+        with timed_stage("synthesis", estimate=not self._query_engine.streaming):
+            response = self._query_engine._response_synthesizer.synthesize(
+                query=query_bundle, nodes=nodes
+            )
+        return self._finish(response, sub_results, sources)
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        with timed_stage("decomposition"):
+            decomposition = self._read_decomposition(
+                await get_llm().apredict(
+                    self._sub_question_prompt,
+                    max_questions=self._max_sub_questions,
+                    query_str=query_bundle.query_str,
+                )
+            )
+        engine = self._single_engine(decomposition)
+        if engine is not None:
+            return await engine.aquery(query_bundle)
+        questions = decomposition[0]
+
+        semaphore = asyncio.Semaphore(self._concurrency)
+        with timed_stage("sub_questions"):
+            sub_results = await asyncio.gather(
+                *(
+                    self._aanswer_sub_question(question, semaphore)
+                    for question in questions
+                )
+            )
+
+        nodes, sources = self._combine(sub_results)
+        with timed_stage("synthesis", estimate=not self._query_engine.streaming):
+            response = await self._query_engine._response_synthesizer.asynthesize(
+                query=query_bundle, nodes=nodes
+            )
+        return self._finish(response, sub_results, sources)
@@ -0,0 +1,191 @@
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from backend.constants import (
+    BASE_CONFIG,
+    QUERY_MODE_BUDGETS,
+    QUERY_MODES,
+    STAGE_ESTIMATE_SMOOTHING,
+)
+
+# Seconds assumed for a stage until it has been observed on this machine.
+# Retrieval stages include embedding their query.
+STAGE_PRIORS = {
+    "retrieval": 0.15,
+    "hyde": 3.0,
+    "hyde_retrieval": 0.15,
+    "rerank": 0.3,
+    "synthesis": 8.0,
+    "decomposition": 3.0,
+    "sub_questions": 10.0,
+    "self_reflection:llm": 3.0,
+    "self_reflection:cross_encoder": 0.2,
+    "self_reflection:score": 0.0,
+}
+# Sequential multistep answers a few sub-questions before the final synthesis
+MULTISTEP_COST_FACTOR = 3
+# HyDE deadlines are rounded down to this step so planned configs share engines
+HYDE_DEADLINE_STEP = 0.5
+
+
+class StageEstimates:
+    """Exponentially weighted moving average of how long each stage takes, fed
+    by every recorded stage so plans follow the current load
+    """
+
+    def __init__(self, smoothing: float = STAGE_ESTIMATE_SMOOTHING, priors=None):
+        self.smoothing = smoothing
+        self.estimates = dict(STAGE_PRIORS if priors is None else priors)
+        self.lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            previous = self.estimates.get(stage)
+            if previous is None:
+                self.estimates[stage] = seconds
+            else:
+                self.estimates[stage] = previous + self.smoothing * (seconds - previous)
+
+    def estimate(self, stage: str) -> float:
+        return self.estimates.get(stage, 0.0)
+
+
+STAGE_ESTIMATES = StageEstimates()
+
+# Nodes the current request has retrieved so far, so a query that runs out of
+# time can still answer from its best source
+RETRIEVED_NODES = ContextVar("retrieved_nodes", default=None)
+
+
+def remember_nodes(nodes: list):
+    retrieved_nodes = RETRIEVED_NODES.get()
+    if retrieved_nodes is not None:
+        retrieved_nodes[:] = nodes
+
+
+class QueryPlan:
+    """The config a request runs with, when it must be answered by, and which
+    stages were dropped or cut short to get there
+
+    mode_config is the config of the requested mode before any stage was
+    dropped; answers are cached under it, so each mode keeps its own answers and
+    a rushed request can still reuse a full answer.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        latency_budget: float,
+        degraded_stages: list,
+        mode_config: dict = None,
+    ):
+        self.config = config
+        self.mode_config = config if mode_config is None else mode_config
+        self.latency_budget = latency_budget
+        self.deadline = time.monotonic() + latency_budget
+        self.degraded_stages = degraded_stages
+
+    @property
+    def degraded(self) -> bool:
+        return bool(self.degraded_stages)
+
+    def restart(self):
+        """Starts the budget again, for queries whose wait to be admitted does
+        not count against it
+        """
+        self.deadline = time.monotonic() + self.latency_budget
+
+    def remaining(self) -> float:
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def degrade(self, stage: str):
+        if stage not in self.degraded_stages:
+            self.degraded_stages.append(stage)
+
+
+def estimate_query_seconds(config: dict, estimates: StageEstimates) -> float:
+    """Expected wall time of one query with config, from the stage estimates"""
+    retrieval = estimates.estimate("retrieval")
+    seconds = retrieval + estimates.estimate("synthesis")
+    hyde = config.get("hyde", False)
+    if hyde == "speculative":
+        # Generation overlaps the raw-query retrieval and is capped by the deadline
+        hyde_seconds = min(estimates.estimate("hyde"), config.get("hyde_deadline", 2.0))
+        seconds += max(hyde_seconds - retrieval, 0.0)
+        seconds += estimates.estimate("hyde_retrieval")
+    elif hyde:
+        seconds += estimates.estimate("hyde") + retrieval
+    if config.get("rerank", False):
+        seconds += estimates.estimate("rerank")
+    if config.get("multistep", False) == "parallel":
+        seconds += estimates.estimate("decomposition")
+        seconds += estimates.estimate("sub_questions")
+    elif config.get("multistep", False) == True:
+        seconds *= MULTISTEP_COST_FACTOR
+    gate = config.get("relevance_gate", "llm")
+    return seconds + estimates.estimate(f"self_reflection:{gate}")
+
+
+def mode_config(mode: str, config: dict = BASE_CONFIG) -> dict:
+    return {**config, **QUERY_MODES[mode]}
+
+
+def plan_query(
+    mode: str = "balanced",
+    latency_budget: Optional[float] = None,
+    config: dict = BASE_CONFIG,
+    estimates: StageEstimates = STAGE_ESTIMATES,
+) -> QueryPlan:
+    """Starts from the config of the named mode and drops or shortens optional
+    stages, most expensive first, until the query is expected to fit the budget
+
+    The order is multistep, HyDE (turned speculative, then given a shorter
+    deadline, then dropped), the self-reflection gate (replaced by the score
+    gate) and finally the reranker. Retrieval and synthesis always run.
+    """
+    requested_config = mode_config(mode, config)
+    config = dict(requested_config)
+    if latency_budget is None:
+        latency_budget = QUERY_MODE_BUDGETS[mode]
+    degraded_stages = []
+
+    def over_budget() -> bool:
+        return estimate_query_seconds(config, estimates) > latency_budget
+
+    if over_budget() and config.get("multistep", False):
+        config["multistep"] = False
+        degraded_stages.append("multistep")
+
+    if over_budget() and config.get("hyde", False):
+        hyde = (config["hyde"], config.get("hyde_deadline", 2.0))
+        config["hyde"] = "speculative"
+        config["hyde_deadline"] = hyde[1]
+        if over_budget():
+            without_hyde = estimate_query_seconds({**config, "hyde": False}, estimates)
+            # The deadline counts from the start of the query, so the raw-query
+            # retrieval it overlaps is free
+            slack = (
+                latency_budget
+                - without_hyde
+                - estimates.estimate("hyde_retrieval")
+                + estimates.estimate("retrieval")
+            )
+            hyde_deadline = slack // HYDE_DEADLINE_STEP * HYDE_DEADLINE_STEP
+            if hyde_deadline >= HYDE_DEADLINE_STEP:
+                config["hyde_deadline"] = min(config["hyde_deadline"], hyde_deadline)
+            else:
+                config["hyde"] = False
+        if (config["hyde"], config["hyde_deadline"]) != hyde:
+            degraded_stages.append("hyde")
+
+    if over_budget() and config.get("relevance_gate", "llm") != "score":
+        config["relevance_gate"] = "score"
+        degraded_stages.append("self_reflection")
+
+    if over_budget() and config.get("rerank", False):
+        config["rerank"] = False
+        degraded_stages.append("rerank")
+
+    return QueryPlan(config, latency_budget, degraded_stages, requested_config)
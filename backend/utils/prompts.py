@@ -35,3 +35,20 @@ User Query
 Proposed Answer
 {{response}}
 """
+
+
+SUB_QUESTION_TMPL = (
+    f"The source documents the user expects to use are related to {topic}.\n"
+    "Break the question below into at most {max_questions} simpler questions "
+    "that together answer it.\n"
+    "The questions are independent if each can be answered without knowing "
+    "the answer to another one.\n"
+    "If the question is already simple, return it as the only question.\n"
+    "Respond with JSON only, in this form:\n"
+    '{"independent": true, "questions": ["first question", "second question"]}\n'
+    "\n"
+    "Question: {query_str}\n"
+    "JSON:"
+)
+
+SUB_QUESTION_PROMPT = PromptTemplate(SUB_QUESTION_TMPL)
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import re
+from typing import Optional
+
+from qdrant_client.http import models as rest
+
+from backend.constants import (
+    EMBED_MODEL_NAME,
+    QDRANT_COLLECTION_NAME,
+    QDRANT_HNSW_EF,
+    QDRANT_HNSW_EF_CONSTRUCT,
+    QDRANT_HNSW_M,
+    QDRANT_INDEXING_THRESHOLD,
+    QDRANT_ON_DISK,
+    QDRANT_PAYLOAD_INDEXES,
+    QDRANT_QUANTIZATION,
+    QDRANT_QUANTIZATION_OVERSAMPLING,
+    QDRANT_QUANTIZATION_RESCORE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Metadata key that names the style guide a chunk came from
+GUIDE_KEY = "file_name"
+
+
+def embedding_dimension(model_name: str = EMBED_MODEL_NAME) -> int:
+    """Vector size of the embedding model, read from the FastEmbed model list so
+    the model itself is only loaded when it is not listed there
+    """
+    from fastembed import TextEmbedding
+
+    for model in TextEmbedding.list_supported_models():
+        if model["model"] == model_name:
+            return model["dim"]
+    from backend.resources import get_embed_model
+
+    return len(get_embed_model().get_text_embedding("dimension"))
+
+
+def quantization_config(method: str = QDRANT_QUANTIZATION):
+    """Compressed copies of the dense vectors, kept in RAM even when the
+    originals are on disk
+    """
+    if method == "scalar":
+        return rest.ScalarQuantization(
+            scalar=rest.ScalarQuantizationConfig(
+                type=rest.ScalarType.INT8, quantile=0.99, always_ram=True
+            )
+        )
+    if method == "binary":
+        return rest.BinaryQuantization(
+            binary=rest.BinaryQuantizationConfig(always_ram=True)
+        )
+    if method == "none":
+        return None
+    raise ValueError(f"Unknown quantization method {method!r}")
+
+
+def hnsw_config(
+    m: int = QDRANT_HNSW_M, ef_construct: int = QDRANT_HNSW_EF_CONSTRUCT
+) -> rest.HnswConfigDiff:
+    return rest.HnswConfigDiff(m=m, ef_construct=ef_construct)
+
+
+def dense_vector_config(
+    vector_size: int, on_disk: bool = QDRANT_ON_DISK, hnsw: rest.HnswConfigDiff = None
+) -> rest.VectorParams:
+    return rest.VectorParams(
+        size=vector_size,
+        distance=rest.Distance.COSINE,
+        on_disk=on_disk,
+        hnsw_config=hnsw or hnsw_config(),
+    )
+
+
+def payload_index_configs(fields: str = QDRANT_PAYLOAD_INDEXES) -> list:
+    """Parses "field[:schema],..." into the payload indexes QdrantVectorStore
+    creates; the schema defaults to keyword
+    """
+    indexes = []
+    for field in filter(None, (field.strip() for field in fields.split(","))):
+        field_name, _, schema = field.partition(":")
+        indexes.append(
+            {
+                "field_name": field_name,
+                "field_schema": rest.PayloadSchemaType(schema or "keyword"),
+            }
+        )
+    return indexes
+
+
+def search_params(
+    hnsw_ef: int = QDRANT_HNSW_EF,
+    method: str = QDRANT_QUANTIZATION,
+    rescore: bool = QDRANT_QUANTIZATION_RESCORE,
+    oversampling: float = QDRANT_QUANTIZATION_OVERSAMPLING,
+) -> rest.SearchParams:
+    """Query-time HNSW beam width and, for quantized collections, whether the
+    oversampled candidates are rescored with the original vectors
+    """
+    quantization = None
+    if method != "none":
+        quantization = rest.QuantizationSearchParams(
+            rescore=rescore, oversampling=oversampling
+        )
+    return rest.SearchParams(hnsw_ef=hnsw_ef, quantization=quantization)
+
+
+def vector_store_settings(vector_size: Optional[int] = None) -> dict:
+    """QdrantVectorStore arguments that make any collection it creates, including
+    one recreated after a clear, use the configured settings
+    """
+    return {
+        "dense_config": dense_vector_config(vector_size or embedding_dimension()),
+        "quantization_config": quantization_config(),
+        "payload_indexes": payload_index_configs(),
+    }
+
+
+def ensure_collection(vector_store, vector_size: Optional[int] = None) -> bool:
+    """Creates the vector store's collection with the configured settings, or
+    brings an existing one in line with them; returns whether it was created
+
+    Qdrant rebuilds the HNSW graph and quantized vectors of an existing
+    collection in the background after its settings change.
+    """
+    client = vector_store.client
+    collection_name = vector_store.collection_name
+    vector_size = vector_size or embedding_dimension()
+    created = not client.collection_exists(collection_name)
+    if created:
+        vector_store._create_collection(collection_name, vector_size)
+    else:
+        dense_config = dense_vector_config(vector_size)
+        client.update_collection(
+            collection_name,
+            vectors_config={
+                vector_store.dense_vector_name: rest.VectorParamsDiff(
+                    on_disk=dense_config.on_disk, hnsw_config=dense_config.hnsw_config
+                )
+            },
+            quantization_config=quantization_config() or rest.Disabled.DISABLED,
+        )
+        for payload_index in payload_index_configs():
+            client.create_payload_index(collection_name, **payload_index)
+    client.update_collection(
+        collection_name,
+        optimizers_config=rest.OptimizersConfigDiff(
+            indexing_threshold=QDRANT_INDEXING_THRESHOLD
+        ),
+    )
+    logger.info(
+        "%s collection %s", "Created" if created else "Updated", collection_name
+    )
+    return created
+
+
+def guide_name(file_path: str) -> str:
+    """The guide a file holds, as stored in the GUIDE_KEY metadata of its chunks"""
+    return os.path.basename(file_path)
+
+
+def guide_collection_name(
+    guide: str, base_collection_name: str = QDRANT_COLLECTION_NAME
+) -> str:
+    """A readable collection name for the guide, made unique by a hash of its
+    file name since e.g. "a.b.md" and "a_b.md" read the same
+    """
+    stem = re.sub(r"[^A-Za-z0-9_-]+", "_", os.path.splitext(guide)[0])
+    digest = hashlib.sha256(guide.encode()).hexdigest()[:8]
+    return f"{base_collection_name}_{stem}_{digest}"
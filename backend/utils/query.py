@@ -1,37 +1,148 @@
-from llama_index.core.indices.postprocessor import SentenceTransformerRerank
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from functools import lru_cache
+from textwrap import shorten
+
 from llama_index.core.indices.query.query_transform.base import (
     StepDecomposeQueryTransform,
 )
 from llama_index.core import VectorStoreIndex
 from llama_index.core.indices.query.query_transform import HyDEQueryTransform
 from llama_index.core.query_engine import MultiStepQueryEngine, TransformQueryEngine
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
 from llama_index.vector_stores.qdrant import QdrantVectorStore
 
-from backend.constants import BASE_CONFIG, FALLBACK_RESPONSE, VECTOR_STORE, Settings
-from backend.utils.prompts import CUSTOM_HYDE_PROMPT, SELF_REFLECTION_PROMPT
-from backend.utils.ingest import retrieve_index
+from backend.constants import (
+    BASE_CONFIG,
+    DEGRADED_RESPONSE,
+    FALLBACK_RESPONSE,
+    QUERY_ENGINES_MAX_ENTRIES,
+    VECTOR_STORE_BACKEND,
+)
+from backend.resources import (
+    get_collection_vector_store,
+    get_embed_model,
+    get_llm,
+    get_qdrant_client,
+    get_vector_store,
+)
+from backend.utils.prompts import CUSTOM_HYDE_PROMPT
+from backend.utils.hyde import SpeculativeHyDEQueryEngine
+from backend.utils.multistep import ParallelMultiStepQueryEngine
+from backend.utils.ingest import register_ingestion_hook, retrieve_index
+from backend.utils.metrics import InstrumentedQueryEngine, record_stage, timed_stage
+from backend.utils.planner import RETRIEVED_NODES, STAGE_ESTIMATES, QueryPlan
+from backend.utils.qdrant_collections import (
+    GUIDE_KEY,
+    guide_collection_name,
+    search_params,
+)
+from backend.utils.relevance import (
+    check_response_with_scores,
+    get_answer_scorer,
+    is_relevant_response,
+)
+from backend.utils.rerank import CandidateLimit, get_reranker
+
+QUERY_ENGINES = OrderedDict()
+QUERY_ENGINES_LOCK = threading.Lock()
+# Characters of each source shown when an answer lists its sources
+SOURCE_EXCERPT_LENGTH = 200
+
+
+class ThreadedTransformQueryEngine(TransformQueryEngine):
+    """Runs the blocking query transform (an LLM call for HyDE) off the event loop"""
+
+    async def _aquery(self, query_bundle):
+        with timed_stage("hyde"):
+            query_bundle = await asyncio.to_thread(
+                self._query_transform.run,
+                query_bundle,
+                metadata=self._transform_metadata,
+            )
+        return await self._query_engine.aquery(query_bundle)
+
+
+class QueryCancelled(Exception):
+    """Stops threaded work whose request was cancelled or ran out of time"""
+
+
+# Event of the threaded query running in this thread, set by the event loop
+# when the request waiting for it goes away; checked between LLM calls
+QUERY_CANCELLATION = ContextVar("query_cancellation", default=None)
+
+
+def raise_if_cancelled():
+    cancellation = QUERY_CANCELLATION.get()
+    if cancellation is not None and cancellation.is_set():
+        raise QueryCancelled()
+
+
+class ThreadedMultiStepQueryEngine(MultiStepQueryEngine):
+    """MultiStepQueryEngine only decomposes and answers steps synchronously,
+    so the whole run is moved off the event loop
+
+    A thread cannot be interrupted, so when the request is cancelled (e.g. at
+    its deadline) the run stops before its next step or the final synthesis;
+    the LLM call in flight still runs to the end.
+    """
+
+    async def _aquery(self, query_bundle):
+        cancellation = threading.Event()
+        try:
+            return await asyncio.to_thread(
+                self._cancellable_query, query_bundle, cancellation
+            )
+        except asyncio.CancelledError:
+            cancellation.set()
+            raise
+
+    def _cancellable_query(self, query_bundle, cancellation: threading.Event):
+        QUERY_CANCELLATION.set(cancellation)
+        return self._query(query_bundle)
+
+    def _combine_queries(self, query_bundle, prev_reasoning: str):
+        raise_if_cancelled()
+        return super()._combine_queries(query_bundle, prev_reasoning)
+
+    def _query_multistep(self, query_bundle):
+        nodes, source_nodes, metadata = super()._query_multistep(query_bundle)
+        raise_if_cancelled()
+        return nodes, source_nodes, metadata
 
 
 def set_up_hyde(query_engine) -> TransformQueryEngine:
     hyde = HyDEQueryTransform(include_original=True, hyde_prompt=CUSTOM_HYDE_PROMPT)
-    query_engine_hyde = TransformQueryEngine(query_engine, hyde)
+    query_engine_hyde = ThreadedTransformQueryEngine(query_engine, hyde)
     return query_engine_hyde
 
 
 def set_node_postprocessors(config: dict) -> list:
     node_postprocessors = []
 
-    if config.get("rerank", False) == True:
-        rerank = SentenceTransformerRerank(top_n=2, model="BAAI/bge-reranker-base")
-        node_postprocessors.append(rerank)
+    if config.get("rerank", False):
+        if config.get("rerank_max_candidates"):
+            node_postprocessors.append(
+                CandidateLimit(max_candidates=config["rerank_max_candidates"])
+            )
+        node_postprocessors.append(
+            get_reranker(
+                config["rerank"],
+                config.get("rerank_quantized", False),
+                config.get("rerank_max_length"),
+            )
+        )
     return node_postprocessors
 
 
 def set_up_multistep_query_transformation(query_engine) -> MultiStepQueryEngine:
-    step_decompose_transform = StepDecomposeQueryTransform(
-        llm=Settings.llm, verbose=True
-    )
-    query_engine_multistep = MultiStepQueryEngine(
+    step_decompose_transform = StepDecomposeQueryTransform(llm=get_llm(), verbose=True)
+    query_engine_multistep = ThreadedMultiStepQueryEngine(
         query_engine=query_engine,
         query_transform=step_decompose_transform,
         index_summary="Used to answer questions about Python programming style and best practices",
@@ -41,7 +152,18 @@ def set_up_multistep_query_transformation(query_engine) -> MultiStepQueryEngine:
 
 def add_query_transformations_to_query_engine(query_engine, config: dict):
     """Adds selected query transformation techniques"""
-    if config.get("multistep", False) == True:
+    if config.get("hyde", False) == "speculative":
+        query_engine = SpeculativeHyDEQueryEngine(
+            query_engine, deadline=config.get("hyde_deadline", 2.0)
+        )
+
+    if config.get("multistep", False) == "parallel":
+        query_engine = ParallelMultiStepQueryEngine(
+            query_engine,
+            sequential_engine=set_up_multistep_query_transformation(query_engine),
+            max_sub_questions=config.get("multistep_max_sub_questions", 4),
+        )
+    elif config.get("multistep", False) == True:
         query_engine = set_up_multistep_query_transformation(query_engine)
 
     if config.get("hyde", False) == True:
@@ -49,6 +171,24 @@ def add_query_transformations_to_query_engine(query_engine, config: dict):
     return query_engine
 
 
+def set_retrieval_kwargs(vector_store, config: dict) -> dict:
+    """Qdrant search parameters, and a filter on the guide named in the config
+    unless the vector store is that guide's own collection
+    """
+    retrieval_kwargs = {}
+    is_qdrant = isinstance(vector_store, QdrantVectorStore)
+    if is_qdrant:
+        retrieval_kwargs["vector_store_kwargs"] = {"search_params": search_params()}
+    guide = config.get("guide")
+    if guide and not (
+        is_qdrant and vector_store.collection_name == guide_collection_name(guide)
+    ):
+        retrieval_kwargs["filters"] = MetadataFilters(
+            filters=[MetadataFilter(key=GUIDE_KEY, value=guide)]
+        )
+    return retrieval_kwargs
+
+
 def create_query_engine(
     index: VectorStoreIndex, node_postprocessors: list, config: dict
 ):
@@ -58,39 +198,254 @@ def create_query_engine(
         sparse_top_k=12,
         vector_store_query_mode="hybrid",
         node_postprocessors=node_postprocessors,
+        streaming=config.get("streaming", False),
+        **set_retrieval_kwargs(index.vector_store, config),
     )
+    query_engine = InstrumentedQueryEngine(query_engine)
     query_engine = add_query_transformations_to_query_engine(query_engine, config)
 
     return query_engine
 
 
-def check_response_with_llm(
-    query: str, response: str, self_reflection_prompt=SELF_REFLECTION_PROMPT
+@lru_cache(maxsize=None)
+def collection_exists(collection_name: str) -> bool:
+    """Whether ingestion created the collection, checked once per ingestion run"""
+    return get_qdrant_client().collection_exists(collection_name)
+
+
+def select_vector_store(config: dict):
+    """The collection of the guide named in the config when ingestion created
+    one, otherwise the shared vector store
+    """
+    guide = config.get("guide")
+    if guide and VECTOR_STORE_BACKEND == "qdrant":
+        collection_name = guide_collection_name(guide)
+        if collection_exists(collection_name):
+            return get_collection_vector_store(collection_name)
+    return get_vector_store()
+
+
+def get_query_engine(
+    vector_store: QdrantVectorStore = None, config: dict = BASE_CONFIG
 ):
-    self_reflection_prompt = self_reflection_prompt.replace("\n{query}\n", query)
-    self_reflection_prompt = self_reflection_prompt.replace("\n{response}\n", response)
-    response = Settings.llm.complete(prompt=self_reflection_prompt)
-    if "yes" in str(response).lower():
-        return True
-    return False
+    """Returns the long-lived query engine for a config, building it on first use
+
+    The vector store is picked on every query, so a guide's engine moves to
+    its own collection once ingestion creates it. Beyond
+    QUERY_ENGINES_MAX_ENTRIES the least recently used engine is dropped.
+    """
+    vector_store = vector_store or select_vector_store(config)
+    key = (id(vector_store), json.dumps(config, sort_keys=True))
+    query_engine = QUERY_ENGINES.get(key)
+    if query_engine is not None:
+        try:
+            QUERY_ENGINES.move_to_end(key)
+        except KeyError:
+            # Dropped by a concurrent build; this query still uses it
+            pass
+        return query_engine
+
+    with QUERY_ENGINES_LOCK:
+        if key not in QUERY_ENGINES:
+            index = retrieve_index(vector_store)
+            node_postprocessors = set_node_postprocessors(config)
+            query_engine = create_query_engine(index, node_postprocessors, config)
+            QUERY_ENGINES[key] = query_engine
+            while len(QUERY_ENGINES) > max(QUERY_ENGINES_MAX_ENTRIES, 1):
+                QUERY_ENGINES.popitem(last=False)
+            return query_engine
+        return QUERY_ENGINES[key]
 
 
-def query_vector_store(
+def clear_query_engines():
+    """Drops every cached query engine so the next request rebuilds it"""
+    with QUERY_ENGINES_LOCK:
+        QUERY_ENGINES.clear()
+    collection_exists.cache_clear()
+
+
+def warm_up_query_engines(
+    vector_store: QdrantVectorStore = None, configs: tuple = (BASE_CONFIG,)
+):
+    """Builds the query engines and runs the local models once,
+    so the first user request does not pay for loading weights
+    """
+    for config in configs:
+        get_query_engine(vector_store, config)
+        for node_postprocessor in set_node_postprocessors(config):
+            node_postprocessor.postprocess_nodes(
+                [NodeWithScore(node=TextNode(text="warm up"), score=0.0)],
+                query_str="warm up",
+            )
+        if config.get("relevance_gate") == "cross_encoder":
+            get_answer_scorer()
+    get_embed_model().get_query_embedding("warm up")
+
+
+register_ingestion_hook(clear_query_engines)
+
+
+async def check_relevance(
+    query: str, answer: str, source_nodes: list, config: dict, plan: QueryPlan = None
+) -> bool:
+    """Runs the relevance gate, falling back to the score gate when the gate
+    would not finish within the plan's remaining time
+    """
+    gate = config.get("relevance_gate", "llm")
+    timings = {}
+    with timed_stage("self_reflection", timings):
+        if plan is None or gate == "score":
+            is_relevant = await is_relevant_response(
+                query, answer, source_nodes, config
+            )
+        elif plan.remaining() < STAGE_ESTIMATES.estimate(f"self_reflection:{gate}"):
+            plan.degrade("self_reflection")
+            gate = "score"
+            is_relevant = await check_response_with_scores(
+                query, answer, source_nodes, config
+            )
+        else:
+            try:
+                is_relevant = await asyncio.wait_for(
+                    is_relevant_response(query, answer, source_nodes, config),
+                    plan.remaining(),
+                )
+            except asyncio.TimeoutError:
+                plan.degrade("self_reflection")
+                is_relevant = await check_response_with_scores(
+                    query, answer, source_nodes, config
+                )
+    STAGE_ESTIMATES.observe(f"self_reflection:{gate}", timings["self_reflection"])
+    return is_relevant
+
+
+def describe_sources(source_nodes: list) -> list:
+    """The guide, score and start of each source, best first"""
+    source_nodes = sorted(
+        source_nodes, key=lambda node: node.score or 0.0, reverse=True
+    )
+    return [
+        {
+            "guide": node.node.metadata.get(GUIDE_KEY),
+            "score": node.score,
+            "excerpt": shorten(node.node.get_content(), SOURCE_EXCERPT_LENGTH),
+        }
+        for node in source_nodes
+    ]
+
+
+async def answer_from_sources(query: str, source_nodes: list, config: dict) -> str:
+    """Best answer available without synthesis: DEGRADED_RESPONSE and an
+    excerpt of each source, if the sources pass the score gate
+    """
+    if not await check_response_with_scores(query, "", source_nodes, config):
+        return FALLBACK_RESPONSE
+    lines = [DEGRADED_RESPONSE]
+    for source in describe_sources(source_nodes):
+        lines.append(f"- {source['guide'] or 'style guide'}: {source['excerpt']}")
+    return "\n".join(lines)
+
+
+async def query_vector_store(
     query: str,
-    vector_store: QdrantVectorStore = VECTOR_STORE,
+    vector_store: QdrantVectorStore = None,
     config: dict = BASE_CONFIG,
+    plan: QueryPlan = None,
 ):
     """Attempts to find an answer in the saved documents
     using the query_engine configurations
-    """
-    index = retrieve_index(vector_store)
 
-    node_postprocessors = set_node_postprocessors(config)
-    query_engine = create_query_engine(index, node_postprocessors, config)
+    With a plan, its config is used and the query stops at the plan's deadline;
+    a query cut short answers from the sources retrieved so far and the plan
+    records it as degraded.
+    """
+    if plan is not None:
+        config = plan.config
+    # A first use builds the engine, which must not block the event loop
+    query_engine = await asyncio.to_thread(get_query_engine, vector_store, config)
 
-    response = query_engine.query(query)
+    if plan is None:
+        response = await query_engine.aquery(query)
+    else:
+        retrieved_nodes = []
+        RETRIEVED_NODES.set(retrieved_nodes)
+        try:
+            response = await asyncio.wait_for(
+                query_engine.aquery(query), plan.remaining()
+            )
+        except asyncio.TimeoutError:
+            plan.degrade("synthesis")
+            return await answer_from_sources(query, retrieved_nodes, config)
 
-    is_relevant_response = check_response_with_llm(query, str(response))
-    if is_relevant_response:
+    is_relevant = await check_relevance(
+        query, str(response), response.source_nodes, config, plan
+    )
+    if is_relevant:
         return response
     return FALLBACK_RESPONSE
+
+
+async def start_answer_stream(query_engine, query: str) -> tuple:
+    """Runs the query up to the first answer token; returns the response, the
+    rest of its tokens and the first one
+    """
+    response = await query_engine.aquery(query)
+    if not hasattr(response, "async_response_gen"):
+        # The multistep engine synthesizes its final answer without streaming
+        return response, None, str(response)
+    tokens = response.async_response_gen()
+    return response, tokens, await anext(tokens, "")
+
+
+async def stream_vector_store(
+    query: str,
+    vector_store: QdrantVectorStore = None,
+    config: dict = BASE_CONFIG,
+    plan: QueryPlan = None,
+):
+    """Yields a ("sources", [...]) event once retrieval is done, ("token", text)
+    events as the synthesizer produces them, then a ("done", {...}) event with
+    the full answer and its relevance verdict
+
+    With a plan, its config is used and the first token must arrive by the
+    plan's deadline; otherwise the answer comes from the sources retrieved so far
+    and the plan records it as degraded. The relevance gate is shortened when
+    the deadline is near; tokens already sent are never cut off.
+    """
+    if plan is not None:
+        config = plan.config
+    query_engine = await asyncio.to_thread(
+        get_query_engine, vector_store, {**config, "streaming": True}
+    )
+
+    retrieved_nodes = []
+    RETRIEVED_NODES.set(retrieved_nodes)
+    try:
+        response, tokens, first_token = await asyncio.wait_for(
+            start_answer_stream(query_engine, query),
+            None if plan is None else plan.remaining(),
+        )
+    except asyncio.TimeoutError:
+        plan.degrade("synthesis")
+        answer = await answer_from_sources(query, retrieved_nodes, config)
+        yield "sources", describe_sources(retrieved_nodes)
+        yield "token", answer
+        yield "done", {"answer": answer, "is_relevant": answer != FALLBACK_RESPONSE}
+        return
+
+    yield "sources", describe_sources(response.source_nodes)
+    start = time.perf_counter()
+    answer_tokens = [first_token]
+    yield "token", first_token
+    if tokens is not None:
+        async for token in tokens:
+            answer_tokens.append(token)
+            yield "token", token
+    # Covers only part of synthesis, so it is kept out of the planner's estimates
+    record_stage("streaming", time.perf_counter() - start, estimate=False)
+
+    answer = "".join(answer_tokens)
+    is_relevant = await check_relevance(
+        query, answer, response.source_nodes, config, plan
+    )
+    yield "done", {"answer": answer, "is_relevant": is_relevant}
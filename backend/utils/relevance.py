@@ -0,0 +1,91 @@
+import asyncio
+import re
+from functools import lru_cache
+
+from backend.constants import (
+    ANSWER_SCORER_MODEL_NAME,
+    BASE_CONFIG,
+    MICRO_BATCH_MAX_SIZE,
+    MICRO_BATCH_MAX_WAIT,
+    MICRO_BATCHING,
+)
+from backend.resources import get_llm
+from backend.utils.batching import MicroBatcher
+from backend.utils.prompts import SELF_REFLECTION_PROMPT
+
+
+async def check_response_with_llm(
+    query: str,
+    response: str,
+    source_nodes: list = (),
+    config: dict = BASE_CONFIG,
+    self_reflection_prompt=SELF_REFLECTION_PROMPT,
+) -> bool:
+    """Asks the generative model to judge the answer; costs a second LLM call"""
+    self_reflection_prompt = self_reflection_prompt.replace("\n{query}\n", query)
+    self_reflection_prompt = self_reflection_prompt.replace("\n{response}\n", response)
+    response = await get_llm().acomplete(prompt=self_reflection_prompt)
+    # Only a verdict that starts with "yes" passes; "No, yes..." does not
+    return re.match(r"\W*yes\b", str(response).lower()) is not None
+
+
+async def check_response_with_scores(
+    query: str, response: str, source_nodes: list = (), config: dict = BASE_CONFIG
+) -> bool:
+    """Reuses the reranker and retrieval scores already computed for the sources,
+    so no model is called
+    """
+    if not source_nodes:
+        return False
+    top_score = max(node.score or 0.0 for node in source_nodes)
+    top_retrieval_score = max(
+        node.metadata.get("retrieval_score", node.score or 0.0) for node in source_nodes
+    )
+    if config.get("rerank", False) and top_score < config.get("min_rerank_score", 0.0):
+        return False
+    return top_retrieval_score >= config.get("min_retrieval_score", 0.0)
+
+
+@lru_cache(maxsize=None)
+def get_answer_scorer():
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(ANSWER_SCORER_MODEL_NAME)
+
+
+@lru_cache(maxsize=None)
+def get_answer_scorer_batcher() -> MicroBatcher:
+    return MicroBatcher(
+        lambda pairs: get_answer_scorer().predict(pairs).tolist(),
+        MICRO_BATCH_MAX_SIZE,
+        MICRO_BATCH_MAX_WAIT,
+    )
+
+
+async def check_response_with_cross_encoder(
+    query: str, response: str, source_nodes: list = (), config: dict = BASE_CONFIG
+) -> bool:
+    """Scores the query/answer pair with a small cross-encoder"""
+    if MICRO_BATCHING:
+        score = await get_answer_scorer_batcher().submit((query, response))
+    else:
+        scores = await asyncio.to_thread(
+            get_answer_scorer().predict, [(query, response)]
+        )
+        score = scores[0]
+    return float(score) >= config.get("min_answer_score", 0.0)
+
+
+RELEVANCE_GATES = {
+    "llm": check_response_with_llm,
+    "score": check_response_with_scores,
+    "cross_encoder": check_response_with_cross_encoder,
+}
+
+
+async def is_relevant_response(
+    query: str, response: str, source_nodes: list = (), config: dict = BASE_CONFIG
+) -> bool:
+    """Runs the relevance gate selected by config["relevance_gate"]"""
+    gate = RELEVANCE_GATES[config.get("relevance_gate", "llm")]
+    return await gate(query, response, source_nodes, config)
@@ -0,0 +1,187 @@
+import asyncio
+import math
+from functools import lru_cache
+from typing import Any, List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.indices.postprocessor import SentenceTransformerRerank
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from backend.constants import (
+    EMBED_THREADS,
+    MICRO_BATCH_MAX_SIZE,
+    MICRO_BATCH_MAX_WAIT,
+    MICRO_BATCHING,
+    RERANK_MODEL_NAME,
+    RERANK_QUANTIZED_MODEL_FILE,
+    RERANK_QUANTIZED_MODEL_SOURCE,
+)
+from backend.utils.batching import BatchedSentenceTransformerRerank, MicroBatcher
+
+
+class CandidateLimit(BaseNodePostprocessor):
+    """Keeps the max_candidates best retrieved nodes, so the reranker scores a
+    bounded number of pairs whatever the retrieval settings
+    """
+
+    max_candidates: int = Field(description="Number of nodes passed on.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CandidateLimit"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        return sorted(nodes, key=lambda node: -(node.score or 0.0))[
+            : self.max_candidates
+        ]
+
+
+class FastEmbedRerank(BaseNodePostprocessor):
+    """Cross-encoder reranker running on ONNX Runtime through FastEmbed, so the
+    API does not load torch
+
+    Scores go through a sigmoid to match SentenceTransformerRerank, which keeps
+    the relevance thresholds in BASE_CONFIG valid for every backend.
+    """
+
+    model: str = Field(description="FastEmbed cross-encoder model name.")
+    top_n: int = Field(description="Number of nodes to return sorted by score.")
+    keep_retrieval_score: bool = Field(
+        default=False,
+        description="Whether to keep the retrieval score in metadata.",
+    )
+    _model: Any = PrivateAttr()
+    _pair_batcher: Optional[MicroBatcher] = PrivateAttr(default=None)
+
+    def __init__(
+        self,
+        top_n: int = 2,
+        model: str = RERANK_MODEL_NAME,
+        max_length: Optional[int] = None,
+        threads: Optional[int] = None,
+        keep_retrieval_score: bool = False,
+        pair_batcher: bool = False,
+    ):
+        from fastembed.rerank.cross_encoder import TextCrossEncoder
+
+        super().__init__(
+            top_n=top_n, model=model, keep_retrieval_score=keep_retrieval_score
+        )
+        self._model = TextCrossEncoder(model_name=model, threads=threads)
+        if max_length:
+            self._model.model.tokenizer.enable_truncation(max_length=max_length)
+        if pair_batcher:
+            self._pair_batcher = MicroBatcher(
+                self._predict_pairs, MICRO_BATCH_MAX_SIZE, MICRO_BATCH_MAX_WAIT
+            )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FastEmbedRerank"
+
+    def _predict_pairs(self, pairs: list) -> list:
+        return [1 / (1 + math.exp(-score)) for score in self._model.rerank_pairs(pairs)]
+
+    def _apply_scores(self, nodes: List[NodeWithScore], scores: list) -> list:
+        for node, score in zip(nodes, scores):
+            if self.keep_retrieval_score:
+                node.node.metadata["retrieval_score"] = node.score
+            node.score = score
+        return sorted(nodes, key=lambda node: -node.score)[: self.top_n]
+
+    def _pairs(self, nodes: List[NodeWithScore], query_bundle: QueryBundle) -> list:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        return [
+            (
+                query_bundle.query_str,
+                node.node.get_content(metadata_mode=MetadataMode.EMBED),
+            )
+            for node in nodes
+        ]
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if len(nodes) == 0:
+            return []
+        scores = self._predict_pairs(self._pairs(nodes, query_bundle))
+        return self._apply_scores(nodes, scores)
+
+    async def _apostprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if len(nodes) == 0:
+            return []
+        pairs = self._pairs(nodes, query_bundle)
+        if self._pair_batcher is not None:
+            scores = await self._pair_batcher.submit_many(pairs)
+        else:
+            scores = await asyncio.to_thread(self._predict_pairs, pairs)
+        return self._apply_scores(nodes, scores)
+
+
+def register_quantized_reranker() -> str:
+    """Makes the int8 ONNX export of the reranker known to FastEmbed"""
+    from fastembed.common.model_description import ModelSource
+    from fastembed.rerank.cross_encoder import TextCrossEncoder
+
+    model_name = f"{RERANK_MODEL_NAME}-int8"
+    supported = [model["model"] for model in TextCrossEncoder.list_supported_models()]
+    if model_name not in supported:
+        TextCrossEncoder.add_custom_model(
+            model=model_name,
+            sources=ModelSource(hf=RERANK_QUANTIZED_MODEL_SOURCE),
+            model_file=RERANK_QUANTIZED_MODEL_FILE,
+        )
+    return model_name
+
+
+@lru_cache(maxsize=None)
+def get_reranker(
+    backend="onnx", quantized: bool = False, max_length: Optional[int] = None
+) -> BaseNodePostprocessor:
+    """Loads the cross-encoder weights once per backend and shares them across
+    query engines
+
+    backend is "onnx" (FastEmbed, optionally int8) or "sentence_transformers";
+    True selects sentence_transformers for configs written before the choice
+    existed.
+    """
+    if backend == "onnx":
+        model = register_quantized_reranker() if quantized else RERANK_MODEL_NAME
+        return FastEmbedRerank(
+            top_n=2,
+            model=model,
+            max_length=max_length,
+            threads=int(EMBED_THREADS) if EMBED_THREADS else None,
+            keep_retrieval_score=True,
+            pair_batcher=MICRO_BATCHING,
+        )
+
+    if backend not in (True, "sentence_transformers"):
+        raise ValueError(f"Unknown reranker backend {backend!r}")
+    if MICRO_BATCHING:
+        reranker = BatchedSentenceTransformerRerank(
+            max_batch_size=MICRO_BATCH_MAX_SIZE,
+            max_wait=MICRO_BATCH_MAX_WAIT,
+            top_n=2,
+            model=RERANK_MODEL_NAME,
+            keep_retrieval_score=True,
+        )
+    else:
+        reranker = SentenceTransformerRerank(
+            top_n=2, model=RERANK_MODEL_NAME, keep_retrieval_score=True
+        )
+    if max_length:
+        reranker._model.max_length = max_length
+    return reranker
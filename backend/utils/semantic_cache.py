@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+import numpy as np
+
+from backend.constants import (
+    BASE_CONFIG,
+    SEMANTIC_CACHE_MAX_BYTES,
+    SEMANTIC_CACHE_MAX_ENTRIES,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL,
+)
+from backend.resources import get_embed_model
+from backend.utils.ingest import register_ingestion_hook
+
+
+class SemanticCache:
+    """Stores answers by query embedding so reworded questions reuse an earlier answer
+
+    Entries are evicted least-recently-used first once the cache holds more than
+    max_entries answers or max_bytes of embeddings and text, and expire after ttl seconds.
+    """
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl: int = SEMANTIC_CACHE_TTL,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        max_bytes: int = SEMANTIC_CACHE_MAX_BYTES,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_in_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._keys = count()
+        self._lock = threading.Lock()
+
+    def embed(self, query: str) -> np.ndarray:
+        """Returns the normalized query embedding used for lookups"""
+        embedding = np.asarray(
+            get_embed_model().get_query_embedding(query), dtype=np.float32
+        )
+        return embedding / np.linalg.norm(embedding)
+
+    async def aembed(self, query: str) -> np.ndarray:
+        embedding = np.asarray(
+            await get_embed_model().aget_query_embedding(query), dtype=np.float32
+        )
+        return embedding / np.linalg.norm(embedding)
+
+    def lookup(self, embedding: np.ndarray, config: dict = BASE_CONFIG):
+        """Returns the cached answer of the most similar earlier query, or None"""
+        namespace = json.dumps(config, sort_keys=True)
+        with self._lock:
+            self._drop_expired()
+            best_key, best_score = None, self.threshold
+            for key, entry in self.entries.items():
+                if entry["namespace"] != namespace:
+                    continue
+                score = float(np.dot(entry["embedding"], embedding))
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key]["answer"]
+
+    def store(
+        self, embedding: np.ndarray, query: str, answer: str, config: dict = BASE_CONFIG
+    ):
+        size = embedding.nbytes + len(query.encode()) + len(answer.encode())
+        entry = {
+            "namespace": json.dumps(config, sort_keys=True),
+            "embedding": embedding,
+            "query": query,
+            "answer": answer,
+            "created_at": time.monotonic(),
+            "size": size,
+        }
+        with self._lock:
+            self.entries[next(self._keys)] = entry
+            self.size_in_bytes += size
+            while self.entries and (
+                len(self.entries) > self.max_entries
+                or self.size_in_bytes > self.max_bytes
+            ):
+                self._evict(next(iter(self.entries)))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size_in_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "size_in_bytes": self.size_in_bytes,
+            }
+
+    def _drop_expired(self):
+        oldest_allowed = time.monotonic() - self.ttl
+        expired = [
+            key
+            for key, entry in self.entries.items()
+            if entry["created_at"] < oldest_allowed
+        ]
+        for key in expired:
+            self._evict(key)
+
+    def _evict(self, key):
+        entry = self.entries.pop(key)
+        self.size_in_bytes -= entry["size"]
+
+
+SEMANTIC_CACHE = SemanticCache()
+register_ingestion_hook(SEMANTIC_CACHE.clear)
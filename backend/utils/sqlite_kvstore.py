@@ -0,0 +1,93 @@
+import json
+import os
+import sqlite3
+import threading
+
+from llama_index.core.storage.kvstore.types import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_COLLECTION,
+    BaseKVStore,
+)
+
+
+class SQLiteKVStore(BaseKVStore):
+    """Key-value store kept in a local SQLite file
+
+    Backs the ingestion docstore and transformation cache, so their size on disk
+    grows with the corpus while only the rows being read are held in memory.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            # Every put is its own commit, so keep commits cheap
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "collection TEXT, key TEXT, value TEXT, PRIMARY KEY (collection, key))"
+            )
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put_all([(key, val)], collection=collection)
+
+    async def aput(
+        self, key: str, val: dict, collection: str = DEFAULT_COLLECTION
+    ) -> None:
+        self.put(key, val, collection=collection)
+
+    def put_all(
+        self,
+        kv_pairs,
+        collection: str = DEFAULT_COLLECTION,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                [(collection, key, json.dumps(val)) for key, val in kv_pairs],
+            )
+
+    async def aput_all(
+        self,
+        kv_pairs,
+        collection: str = DEFAULT_COLLECTION,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        self.put_all(kv_pairs, collection=collection, batch_size=batch_size)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM kv WHERE collection = ? AND key = ?",
+                (collection, key),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION):
+        return self.get(key, collection=collection)
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> dict:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, value FROM kv WHERE collection = ?", (collection,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> dict:
+        return self.get_all(collection=collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "DELETE FROM kv WHERE collection = ? AND key = ?", (collection, key)
+            )
+        return cursor.rowcount > 0
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection=collection)
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,59 @@
+"""Compares sequential HyDE with speculative HyDE on the style guide test set
+
+Sequential HyDE writes the hypothetical passage before retrieving. Speculative
+HyDE retrieves on the raw query meanwhile, and is run twice: with an empty
+passage cache and again with the passages cached. Needs Qdrant and Ollama:
+    python -m experiments.benchmark_hyde
+"""
+
+import asyncio
+import json
+import statistics
+import time
+
+
+from backend.constants import BASE_CONFIG
+from backend.utils.hyde import HYDE_PASSAGE_CACHE
+from backend.utils.query import get_query_engine
+from experiments.testsets import load_examples
+
+TESTSET_PATH = "data/testsets/style_guide_testset.json"
+
+
+async def time_queries(queries, config):
+    query_engine = get_query_engine(config=config)
+    latencies, stage_timings = [], {}
+    for query in queries:
+        start = time.perf_counter()
+        response = await query_engine.aquery(query)
+        latencies.append(time.perf_counter() - start)
+        for stage, seconds in (response.metadata or {}).get("timings", {}).items():
+            stage_timings.setdefault(stage, []).append(seconds)
+
+    return {
+        "median_latency": round(statistics.median(latencies), 3),
+        "mean_latency": round(statistics.mean(latencies), 3),
+        "median_stage_timings": {
+            stage: round(statistics.median(values), 3)
+            for stage, values in stage_timings.items()
+        },
+    }
+
+
+async def benchmark_hyde(queries):
+    HYDE_PASSAGE_CACHE.clear()
+    results = {
+        "sequential": await time_queries(queries, {**BASE_CONFIG, "hyde": True}),
+        "speculative_cold": await time_queries(
+            queries, {**BASE_CONFIG, "hyde": "speculative"}
+        ),
+        "speculative_cached": await time_queries(
+            queries, {**BASE_CONFIG, "hyde": "speculative"}
+        ),
+    }
+    return results
+
+
+if __name__ == "__main__":
+    queries = [example["query"] for example in load_examples(TESTSET_PATH)]
+    print(json.dumps(asyncio.run(benchmark_hyde(queries)), indent=2))
@@ -0,0 +1,84 @@
+"""Measures requests per second and latency of the /queries endpoint under load
+
+Start the API, then run for example:
+    python experiments/benchmark_load.py --requests 64 --concurrency 16
+
+Run it once against the sync handlers and once against the async ones
+(on a single uvicorn worker) to compare throughput. Set
+SEMANTIC_CACHE_THRESHOLD above 1 on the API so repeated queries are not
+answered from the cache.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+DEFAULT_QUERIES = [
+    "Should I use tabs or spaces to indent my code?",
+    "How long can a docstring be?",
+    "Should I use absolute imports or relative imports?",
+    "What are TODO comments?",
+]
+
+
+async def send_query(client, url, query, semaphore, latencies, failures):
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            response = await client.post(f"{url}/queries", json={"query": query})
+            response.raise_for_status()
+        except httpx.HTTPError:
+            failures.append(query)
+            return
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_load_test(url, queries, total_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, failures = [], []
+    async with httpx.AsyncClient(timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[
+                send_query(
+                    client,
+                    url,
+                    queries[i % len(queries)],
+                    semaphore,
+                    latencies,
+                    failures,
+                )
+                for i in range(total_requests)
+            ]
+        )
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total_requests,
+        "concurrency": concurrency,
+        "failures": len(failures),
+        "seconds": round(elapsed, 2),
+        "requests_per_second": round(len(latencies) / elapsed, 2),
+        "p50_latency": round(statistics.median(latencies), 3) if latencies else None,
+        "p99_latency": (
+            round(latencies[int(0.99 * (len(latencies) - 1))], 3) if latencies else None
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:7860")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run_load_test(args.url, DEFAULT_QUERIES, args.requests, args.concurrency)
+    )
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,96 @@
+"""Compares hybrid retrieval from Qdrant with the in-process local vector store
+
+The local store is built from data/style through the normal ingestion pipeline,
+reusing the cached extractions and embeddings of the Qdrant ingestion run, so
+both backends hold the same chunks. Query embeddings are computed once and
+shared, so latencies cover the search alone. Reports median and p95 latency,
+the rate at which a reference context is among the top 2 chunks, and how often
+both backends return the same top 2. Needs Qdrant with the collection already
+ingested, and VECTOR_STORE_BACKEND left at "qdrant":
+    python -m experiments.benchmark_local_store
+"""
+
+import statistics
+import time
+
+from llama_index.core.schema import QueryBundle
+
+from backend.constants import LOCAL_INDEX_DIR
+from backend.resources import get_embed_model, get_vector_store
+from backend.utils.ingest import (
+    create_vector_store_from_nodes,
+    iter_directory_documents,
+    retrieve_index,
+)
+from backend.utils.local_store import LocalHybridVectorStore
+from experiments.testsets import load_examples, matches_reference
+
+TESTSET_PATH = "data/testsets/style_guide_testset.json"
+QA_DATASET_PATH = "data/testsets/qa_dataset.json"
+REPEATS = 5
+
+
+def load_test_queries() -> list:
+    """(query, reference texts) pairs from both test sets"""
+    return [
+        (example["query"], example["reference_contexts"])
+        for path in (TESTSET_PATH, QA_DATASET_PATH)
+        for example in load_examples(path)
+    ]
+
+
+def benchmark_store(vector_store, test_queries: list, embeddings: list) -> dict:
+    retriever = retrieve_index(vector_store).as_retriever(
+        similarity_top_k=2, sparse_top_k=12, vector_store_query_mode="hybrid"
+    )
+    latencies, hits, results = [], [], []
+    for (query, references), embedding in zip(test_queries, embeddings):
+        query_bundle = QueryBundle(query, embedding=embedding)
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            nodes = retriever.retrieve(query_bundle)
+            latencies.append(time.perf_counter() - start)
+        hits.append(
+            any(
+                matches_reference(node.node.get_content(), references) for node in nodes
+            )
+        )
+        results.append([node.node.node_id for node in nodes])
+
+    latencies.sort()
+    return {
+        "median_latency_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_latency_ms": round(latencies[int(0.95 * len(latencies))] * 1000, 3),
+        "hit_rate_at_2": round(statistics.mean(hits), 3),
+    }, results
+
+
+if __name__ == "__main__":
+    local_store = LocalHybridVectorStore(persist_dir=LOCAL_INDEX_DIR)
+    create_vector_store_from_nodes(
+        local_store, iter_directory_documents("data/style"), docstore_namespace="local"
+    )
+
+    test_queries = load_test_queries()
+    embed_model = get_embed_model()
+    embeddings = [embed_model.get_query_embedding(query) for query, _ in test_queries]
+
+    qdrant, qdrant_results = benchmark_store(
+        get_vector_store(), test_queries, embeddings
+    )
+    local, local_results = benchmark_store(local_store, test_queries, embeddings)
+    same_top_2 = statistics.mean(
+        set(qdrant_ids) == set(local_ids)
+        for qdrant_ids, local_ids in zip(qdrant_results, local_results)
+    )
+    print(
+        json.dumps(
+            {
+                "queries": len(test_queries),
+                "qdrant": qdrant,
+                "local": local,
+                "same_top_2": round(same_top_2, 3),
+            },
+            indent=2,
+        )
+    )
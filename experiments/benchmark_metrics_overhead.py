@@ -0,0 +1,42 @@
+"""Measures the cost of recording one stage with timed_stage
+
+Prints the overhead per stage with and without a request breakdown. A query
+records around a dozen stages, so the per-query cost is about 12 times this.
+    python -m experiments.benchmark_metrics_overhead
+"""
+
+import json
+import time
+
+from backend.utils.metrics import start_request_stages, timed_stage
+
+ITERATIONS = 100_000
+
+
+def time_loop(record: bool) -> float:
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        if record:
+            with timed_stage("overhead"):
+                pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    baseline = time_loop(record=False)
+    without_breakdown = time_loop(record=True)
+    start_request_stages()
+    with_breakdown = time_loop(record=True)
+    print(
+        json.dumps(
+            {
+                "microseconds_per_stage": round(
+                    (without_breakdown - baseline) / ITERATIONS * 1e6, 2
+                ),
+                "microseconds_per_stage_with_breakdown": round(
+                    (with_breakdown - baseline) / ITERATIONS * 1e6, 2
+                ),
+            },
+            indent=2,
+        )
+    )
@@ -0,0 +1,110 @@
+"""Compares micro-batched and one-by-one query embedding and reranking under load
+
+Each simulated request embeds a query and reranks candidate passages from the
+style guides, like the retrieval part of /queries. Only the local models are
+needed (no Qdrant or Ollama):
+    python -m experiments.benchmark_micro_batching --requests 256 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from llama_index.core.postprocessor import SentenceTransformerRerank
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.embeddings.fastembed import FastEmbedEmbedding
+
+from backend.constants import (
+    EMBED_MODEL_NAME,
+    MICRO_BATCH_MAX_SIZE,
+    MICRO_BATCH_MAX_WAIT,
+)
+from backend.utils.batching import (
+    BatchedFastEmbedEmbedding,
+    BatchedSentenceTransformerRerank,
+)
+from experiments.testsets import load_examples
+
+TESTSET_PATH = "data/testsets/style_guide_testset.json"
+RERANK_MODEL_NAME = "BAAI/bge-reranker-base"
+CANDIDATES_PER_QUERY = 14
+
+
+async def handle_request(embed_model, reranker, query, passages, latencies):
+    start = time.perf_counter()
+    await embed_model.aget_query_embedding(query)
+    nodes = [NodeWithScore(node=TextNode(text=text), score=0.0) for text in passages]
+    await reranker.apostprocess_nodes(nodes, query_bundle=QueryBundle(query))
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_load_test(embed_model, reranker, examples, total_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def bounded(example):
+        async with semaphore:
+            await handle_request(
+                embed_model, reranker, example[0], example[1], latencies
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[bounded(examples[i % len(examples)]) for i in range(total_requests)]
+    )
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests_per_second": round(total_requests / elapsed, 2),
+        "p50_latency": round(statistics.median(latencies), 4),
+        "p99_latency": round(latencies[int(0.99 * (len(latencies) - 1))], 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    dataset = load_examples(TESTSET_PATH)
+    contexts = [text for example in dataset for text in example["reference_contexts"]]
+    examples = [
+        (
+            example["query"],
+            (contexts * CANDIDATES_PER_QUERY)[i : i + CANDIDATES_PER_QUERY],
+        )
+        for i, example in enumerate(dataset)
+    ]
+
+    variants = {
+        "one_by_one": (
+            FastEmbedEmbedding(model_name=EMBED_MODEL_NAME),
+            SentenceTransformerRerank(top_n=2, model=RERANK_MODEL_NAME),
+        ),
+        "micro_batched": (
+            BatchedFastEmbedEmbedding(
+                max_batch_size=MICRO_BATCH_MAX_SIZE,
+                max_wait=MICRO_BATCH_MAX_WAIT,
+                model_name=EMBED_MODEL_NAME,
+            ),
+            BatchedSentenceTransformerRerank(
+                max_batch_size=MICRO_BATCH_MAX_SIZE,
+                max_wait=MICRO_BATCH_MAX_WAIT,
+                top_n=2,
+                model=RERANK_MODEL_NAME,
+            ),
+        ),
+    }
+    results = {
+        name: asyncio.run(
+            run_load_test(
+                embed_model, reranker, examples, args.requests, args.concurrency
+            )
+        )
+        for name, (embed_model, reranker) in variants.items()
+    }
+    print(json.dumps(results, indent=2))
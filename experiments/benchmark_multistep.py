@@ -0,0 +1,56 @@
+"""Compares sequential and parallel multistep querying on the style guide test set
+
+Each query is answered with the step-by-step MultiStepQueryEngine and with the
+parallel sub-question engine; the per-request stage breakdown shows where the
+time goes. Needs Qdrant and Ollama (set OLLAMA_NUM_PARALLEL on the Ollama
+server so concurrent sub-questions are not queued behind each other):
+    python -m experiments.benchmark_multistep
+"""
+
+import asyncio
+import json
+import statistics
+import time
+
+
+from backend.constants import BASE_CONFIG
+from backend.utils.metrics import start_request_stages
+from backend.utils.query import get_query_engine
+from experiments.testsets import load_examples
+
+TESTSET_PATH = "data/testsets/style_guide_testset.json"
+
+
+async def time_queries(queries, config):
+    query_engine = get_query_engine(config=config)
+    latencies, stage_timings = [], {}
+    for query in queries:
+        stages = start_request_stages()
+        start = time.perf_counter()
+        await query_engine.aquery(query)
+        latencies.append(time.perf_counter() - start)
+        for stage, entry in stages.items():
+            stage_timings.setdefault(stage, []).append(entry["seconds"])
+
+    return {
+        "median_latency": round(statistics.median(latencies), 3),
+        "mean_latency": round(statistics.mean(latencies), 3),
+        "median_stage_timings": {
+            stage: round(statistics.median(values), 3)
+            for stage, values in stage_timings.items()
+        },
+    }
+
+
+async def benchmark_multistep(queries):
+    return {
+        "sequential": await time_queries(queries, {**BASE_CONFIG, "multistep": True}),
+        "parallel": await time_queries(
+            queries, {**BASE_CONFIG, "multistep": "parallel"}
+        ),
+    }
+
+
+if __name__ == "__main__":
+    queries = [example["query"] for example in load_examples(TESTSET_PATH)]
+    print(json.dumps(asyncio.run(benchmark_multistep(queries)), indent=2))
@@ -0,0 +1,214 @@
+"""Measures the memory, latency and recall of Qdrant collection settings
+
+The dense vectors of the ingested collection are copied into one scratch
+collection per variant: quantization with and without rescoring, on-disk
+vectors, and HNSW m and ef_construct. With --copies, each vector is repeated
+with small perturbations, since a style guide alone is too small for the
+settings to matter. The graph is built regardless of size (indexing threshold
+0), and every test set query is searched at several query-time ef values.
+
+Recall@10 is measured against exact search on the original vectors. Memory is
+given two ways: the RAM each variant is expected to hold (vectors kept in RAM,
+quantized vectors and HNSW links), and the change in Qdrant's resident memory
+from its /metrics endpoint, which is noisy but includes everything. Needs Qdrant
+with the collection already ingested:
+    python -m experiments.benchmark_qdrant_collection --copies 50
+"""
+
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+
+import numpy as np
+from qdrant_client.http import models as rest
+
+from backend.constants import QDRANT_HOST, QDRANT_PORT
+from backend.resources import get_embed_model, get_qdrant_client, get_vector_store
+from backend.utils.qdrant_collections import (
+    GUIDE_KEY,
+    dense_vector_config,
+    hnsw_config,
+    quantization_config,
+    search_params,
+)
+from experiments.benchmark_local_store import load_test_queries
+
+VARIANTS = {
+    "baseline": {"quantization": "none", "on_disk": False},
+    "scalar": {"quantization": "scalar", "on_disk": False},
+    "scalar_on_disk": {"quantization": "scalar", "on_disk": True},
+    "scalar_no_rescore": {"quantization": "scalar", "on_disk": True, "rescore": False},
+    "binary_on_disk": {"quantization": "binary", "on_disk": True, "oversampling": 3.0},
+    "scalar_on_disk_m8": {
+        "quantization": "scalar",
+        "on_disk": True,
+        "m": 8,
+        "ef_construct": 64,
+    },
+}
+SEARCH_EFS = (16, 64, 128, 256)
+TOP_K = 10
+NOISE = 0.02
+
+
+def qdrant_resident_bytes() -> float:
+    url = f"http://{QDRANT_HOST}:{QDRANT_PORT}/metrics"
+    with urllib.request.urlopen(url, timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("memory_resident_bytes"):
+                return float(line.split()[-1])
+    return float("nan")
+
+
+def load_source_points(copies: int, seed: int = 0) -> tuple:
+    """Normalized dense vectors and guide names of the ingested collection,
+    repeated copies times with Gaussian noise
+    """
+    vector_store = get_vector_store()
+    points, offset = [], None
+    while True:
+        batch, offset = get_qdrant_client().scroll(
+            vector_store.collection_name,
+            limit=256,
+            offset=offset,
+            with_payload=[GUIDE_KEY],
+            with_vectors=[vector_store.dense_vector_name],
+        )
+        points.extend(batch)
+        if offset is None:
+            break
+    vectors = np.array(
+        [point.vector[vector_store.dense_vector_name] for point in points],
+        dtype=np.float32,
+    )
+    guides = [point.payload.get(GUIDE_KEY) for point in points]
+
+    rng = np.random.default_rng(seed)
+    copied = [vectors] + [
+        vectors + rng.normal(0, NOISE, vectors.shape).astype(np.float32)
+        for _ in range(copies - 1)
+    ]
+    vectors = np.vstack(copied)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors, guides * copies
+
+
+def expected_ram_bytes(variant: dict, count: int, dimension: int) -> int:
+    ram = 0 if variant["on_disk"] else count * dimension * 4
+    if variant["quantization"] == "scalar":
+        ram += count * dimension
+    elif variant["quantization"] == "binary":
+        ram += count * dimension // 8
+    # Layer 0 of the graph dominates, with up to 2m four-byte links per point
+    return ram + count * 2 * variant.get("m", 16) * 4
+
+
+def create_variant_collection(name: str, variant: dict, vectors, guides):
+    client = get_qdrant_client()
+    if client.collection_exists(name):
+        client.delete_collection(name)
+    client.create_collection(
+        name,
+        vectors_config=dense_vector_config(
+            vectors.shape[1],
+            on_disk=variant["on_disk"],
+            hnsw=hnsw_config(variant.get("m", 16), variant.get("ef_construct", 100)),
+        ),
+        quantization_config=quantization_config(variant["quantization"]),
+        optimizers_config=rest.OptimizersConfigDiff(indexing_threshold=0),
+    )
+    client.create_payload_index(name, GUIDE_KEY, rest.PayloadSchemaType.KEYWORD)
+    client.upload_collection(
+        name,
+        vectors=vectors,
+        payload=[{GUIDE_KEY: guide} for guide in guides],
+        ids=range(len(vectors)),
+        batch_size=256,
+    )
+    while client.get_collection(name).status != rest.CollectionStatus.GREEN:
+        time.sleep(0.5)
+
+
+def benchmark_variant(name: str, variant: dict, vectors, guides, embeddings) -> dict:
+    client = get_qdrant_client()
+    memory_before = qdrant_resident_bytes()
+    start = time.perf_counter()
+    create_variant_collection(name, variant, vectors, guides)
+    result = {
+        "build_seconds": round(time.perf_counter() - start, 2),
+        "expected_ram_mb": round(
+            expected_ram_bytes(variant, *vectors.shape) / 2**20, 2
+        ),
+        "qdrant_resident_change_mb": round(
+            (qdrant_resident_bytes() - memory_before) / 2**20, 2
+        ),
+    }
+
+    exact_ids = [
+        set(np.argsort(-(vectors @ embedding))[:TOP_K].tolist())
+        for embedding in embeddings
+    ]
+    for ef in SEARCH_EFS:
+        params = search_params(
+            ef,
+            variant["quantization"],
+            variant.get("rescore", True),
+            variant.get("oversampling", 2.0),
+        )
+        latencies, recalls = [], []
+        for embedding, expected in zip(embeddings, exact_ids):
+            query_start = time.perf_counter()
+            points = client.query_points(
+                name, query=embedding.tolist(), limit=TOP_K, search_params=params
+            ).points
+            latencies.append(time.perf_counter() - query_start)
+            recalls.append(len({point.id for point in points} & expected) / TOP_K)
+        latencies.sort()
+        result[f"ef_{ef}"] = {
+            "median_latency_ms": round(statistics.median(latencies) * 1000, 3),
+            "p95_latency_ms": round(latencies[int(0.95 * len(latencies))] * 1000, 3),
+            "recall_at_10": round(statistics.mean(recalls), 3),
+        }
+
+    # Searching one guide of the shared collection through its payload index
+    guide = max(set(guides), key=guides.count)
+    guide_filter = rest.Filter(
+        must=[rest.FieldCondition(key=GUIDE_KEY, match=rest.MatchValue(value=guide))]
+    )
+    latencies = []
+    for embedding in embeddings:
+        query_start = time.perf_counter()
+        client.query_points(
+            name, query=embedding.tolist(), limit=TOP_K, query_filter=guide_filter
+        )
+        latencies.append(time.perf_counter() - query_start)
+    result["filtered_median_latency_ms"] = round(statistics.median(latencies) * 1000, 3)
+    client.delete_collection(name)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, default=1)
+    args = parser.parse_args()
+
+    vectors, guides = load_source_points(args.copies)
+    embed_model = get_embed_model()
+    embeddings = [
+        np.asarray(embed_model.get_query_embedding(query), dtype=np.float32)
+        for query, _ in load_test_queries()
+    ]
+    embeddings = [embedding / np.linalg.norm(embedding) for embedding in embeddings]
+    results = {
+        name: benchmark_variant(
+            f"benchmark_{name}", variant, vectors, guides, embeddings
+        )
+        for name, variant in VARIANTS.items()
+    }
+    print(
+        json.dumps(
+            {"points": len(vectors), "queries": len(embeddings), **results}, indent=2
+        )
+    )
@@ -0,0 +1,63 @@
+"""Compares the latency and agreement of the relevance gates
+
+Runs each test set query (plus off-topic queries that should be rejected)
+through the query engine once, then times every gate on the same answer and
+sources. Agreement is measured against the LLM judge.
+
+    python -m experiments.benchmark_relevance_gate
+"""
+
+import asyncio
+import json
+import statistics
+import time
+
+
+from backend.constants import BASE_CONFIG
+from backend.utils.query import get_query_engine
+from backend.utils.relevance import RELEVANCE_GATES
+from experiments.testsets import load_examples
+
+TESTSET_PATH = "data/testsets/style_guide_testset.json"
+OFF_TOPIC_QUERIES = [
+    "What is the capital of France?",
+    "How long should I bake sourdough bread?",
+    "Who won the football world cup in 2018?",
+    "What is a good name for a cat?",
+]
+
+
+async def benchmark_relevance_gates(queries, config=BASE_CONFIG):
+    query_engine = get_query_engine(config=config)
+    latencies = {gate: [] for gate in RELEVANCE_GATES}
+    verdicts = {gate: [] for gate in RELEVANCE_GATES}
+
+    for query in queries:
+        response = await query_engine.aquery(query)
+        for gate, check in RELEVANCE_GATES.items():
+            start = time.perf_counter()
+            verdict = await check(query, str(response), response.source_nodes, config)
+            latencies[gate].append(time.perf_counter() - start)
+            verdicts[gate].append(verdict)
+
+    results = {}
+    for gate in RELEVANCE_GATES:
+        agreement = statistics.mean(
+            verdict == reference
+            for verdict, reference in zip(verdicts[gate], verdicts["llm"])
+        )
+        results[gate] = {
+            "median_latency": round(statistics.median(latencies[gate]), 4),
+            "max_latency": round(max(latencies[gate]), 4),
+            "pass_rate": round(statistics.mean(verdicts[gate]), 3),
+            "agreement_with_llm": round(agreement, 3),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    queries = [
+        example["query"] for example in load_examples(TESTSET_PATH)
+    ] + OFF_TOPIC_QUERIES
+    results = asyncio.run(benchmark_relevance_gates(queries))
+    print(json.dumps(results, indent=2))
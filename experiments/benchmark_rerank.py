@@ -0,0 +1,97 @@
+"""Compares reranker backends on the style guide test set
+
+For every test query, the reference contexts of all queries are reranked and
+the query's own contexts should come out on top. Reports hit rate and MRR in
+the top 2, median rerank latency and the peak RSS of a process that loaded the
+backend. Each backend runs in its own process so its memory is measured alone:
+    python -m experiments.benchmark_rerank
+"""
+
+import argparse
+import json
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from backend.constants import BASE_CONFIG
+from backend.utils.query import set_node_postprocessors
+from experiments.testsets import load_examples
+
+TESTSET_PATH = "data/testsets/style_guide_testset.json"
+VARIANTS = {
+    "none": {"rerank": False},
+    "sentence_transformers": {"rerank": "sentence_transformers"},
+    "onnx": {"rerank": "onnx", "rerank_quantized": False},
+    "onnx_int8": {"rerank": "onnx", "rerank_quantized": True},
+}
+
+
+def benchmark_variant(name: str) -> dict:
+    dataset = load_examples(TESTSET_PATH)
+    contexts = sorted(
+        {text for example in dataset for text in example["reference_contexts"]}
+    )
+    node_postprocessors = set_node_postprocessors({**BASE_CONFIG, **VARIANTS[name]})
+
+    hits, reciprocal_ranks, latencies = [], [], []
+    for i, example in enumerate(dataset):
+        # Shuffled so "none" shows the quality of an arbitrary retrieval order
+        candidates = random.Random(i).sample(contexts, len(contexts))
+        nodes = [
+            NodeWithScore(node=TextNode(text=text), score=0.0) for text in candidates
+        ]
+        start = time.perf_counter()
+        for node_postprocessor in node_postprocessors:
+            nodes = node_postprocessor.postprocess_nodes(
+                nodes, query_bundle=QueryBundle(example["query"])
+            )
+        latencies.append(time.perf_counter() - start)
+
+        ranked = [node.node.get_content() for node in nodes][:2]
+        ranks = [
+            rank
+            for rank, text in enumerate(ranked, start=1)
+            if text in example["reference_contexts"]
+        ]
+        hits.append(bool(ranks))
+        reciprocal_ranks.append(1 / ranks[0] if ranks else 0.0)
+
+    return {
+        "hit_rate_at_2": round(statistics.mean(hits), 3),
+        "mrr_at_2": round(statistics.mean(reciprocal_ranks), 3),
+        "median_latency": round(statistics.median(latencies), 4),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--variant", choices=VARIANTS)
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(benchmark_variant(args.variant)))
+    else:
+        results = {}
+        for name in VARIANTS:
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "experiments.benchmark_rerank",
+                    "--variant",
+                    name,
+                ],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+            results[name] = json.loads(output.strip().splitlines()[-1])
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,75 @@
+"""Measures how long the backend takes to import and to come up
+
+Each module is imported in a fresh interpreter, so the times include every
+dependency it pulls in. With --serve, the API is also started with uvicorn and
+the script reports when /health/live and /health/ready first answer; readiness
+needs Qdrant and the models, so run it next to the compose services.
+    python -m experiments.benchmark_startup
+    python -m experiments.benchmark_startup --serve
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import requests
+
+MODULES = [
+    "backend.constants",
+    "backend.utils.models",
+    "backend.utils.ingest",
+    "backend.main",
+]
+PORT = 7861
+
+
+def time_import(module: str) -> float:
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def time_serve(timeout: float = 600.0) -> dict:
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(PORT)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    results = {}
+    try:
+        while "ready" not in results and time.perf_counter() - start < timeout:
+            for check in ("live", "ready"):
+                if check in results:
+                    continue
+                try:
+                    response = requests.get(
+                        f"http://localhost:{PORT}/health/{check}", timeout=1
+                    )
+                except requests.ConnectionError:
+                    continue
+                if response.ok:
+                    results[check] = time.perf_counter() - start
+            time.sleep(0.1)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", action="store_true")
+    args = parser.parse_args()
+
+    results = {"import": {module: time_import(module) for module in MODULES}}
+    if args.serve:
+        results["serve"] = time_serve()
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,424 @@
+"""Runs the query pipeline over a test set and reports answer quality together
+with per-stage latency percentiles and throughput
+
+Examples run concurrently through the real query_vector_store with BASE_CONFIG
+(or a named mode) plus any --config overrides. Each prediction is saved in
+data/evaluation_cache under a key made from the config, the example, the
+generative and embedding model names, the prompts and the indexed content, so
+a re-run only queries what changed; --refresh ignores the saved predictions.
+
+Quality metrics need no judge model: retrieval hit rate and MRR against the
+reference contexts, token F1 against the reference answer, the share of answer
+tokens found in the sources, and the rate of fallback answers. --judge adds
+LlamaIndex correctness and faithfulness scores from the generative model.
+Latency percentiles cover every prediction, cached ones included; throughput
+covers the examples queried in this run, from the first prediction starting to
+the last one finishing, so setup and judging are left out.
+
+Needs Qdrant with the collection ingested and Ollama:
+    python -m experiments.evaluate_pipeline --dataset data/testsets/qa_dataset.json --config '{"hyde": false}'
+or, with --offline, neither: data/style is ingested into an in-memory Qdrant
+and answers come from a deterministic stub LLM that quotes the retrieved context:
+    python -m experiments.evaluate_pipeline --offline
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import tempfile
+import time
+from collections import Counter
+from hashlib import sha256
+
+from llama_index.core.llms import CompletionResponse, MockLLM
+
+from backend.constants import (
+    BASE_CONFIG,
+    BATCH_CONCURRENCY,
+    EMBED_MODEL_NAME,
+    FALLBACK_RESPONSE,
+    GENERATIVE_MODEL_NAME,
+    QDRANT_COLLECTION_NAME,
+    STYLE_GUIDE_DIR,
+    VECTOR_STORE_BACKEND,
+)
+from backend.utils.metrics import start_request_stages, timed_stage
+from backend.utils.planner import RETRIEVED_NODES, mode_config
+from backend.utils.query import query_vector_store
+from backend.utils.sqlite_kvstore import SQLiteKVStore
+from experiments.testsets import load_examples, matches_reference
+
+CACHE_PATH = "data/evaluation_cache/predictions.sqlite"
+PERCENTILES = (50, 95, 99)
+
+
+class StubLLM(MockLLM):
+    """Deterministic stand-in for Ollama
+
+    Answers a question with the opening words of the first context chunk,
+    keeps the existing answer when asked to refine, passes every self-reflection
+    check and answers anything else (HyDE passages, query decomposition,
+    metadata extraction) with "None".
+    """
+
+    answer_words: int = 40
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubLLM"
+
+    def _respond(self, prompt: str) -> str:
+        context = re.search(r"-{5,}\n(.*?)\n-{5,}", prompt, re.DOTALL)
+        if "We have provided an existing answer:" in prompt:
+            existing = re.search(r"existing answer: (.*?)\n", prompt, re.DOTALL)
+            return existing.group(1) if existing else "None"
+        if context is not None:
+            chunks = context.group(1).split("\n\n")
+            # A chunk starts with its metadata lines when it has any
+            if len(chunks) > 1 and all(
+                re.match(r"^\w+: ", line) for line in chunks[0].splitlines()
+            ):
+                chunks = chunks[1:]
+            return " ".join(chunks[0].split()[: self.answer_words])
+        if 'respond "Yes"' in prompt:
+            return "Yes"
+        return "None"
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs):
+        return CompletionResponse(text=self._respond(prompt))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs):
+        text = self._respond(prompt)
+        yield CompletionResponse(text=text, delta=text)
+
+
+def use_offline_llm():
+    """Points the providers at the stub LLM, so no run with --offline reaches
+    Ollama, even one whose predictions are all cached
+    """
+    from llama_index.core import Settings
+
+    from backend.resources import get_llm
+
+    llm = StubLLM()
+    get_llm.override(llm)
+    Settings.llm = llm
+
+
+def use_offline_index(input_dir: str = STYLE_GUIDE_DIR):
+    """Points the providers at an in-memory Qdrant holding input_dir;
+    embeddings still come from the local FastEmbed model
+    """
+    from llama_index.vector_stores.qdrant import QdrantVectorStore
+    from qdrant_client import QdrantClient
+
+    from backend.resources import get_qdrant_client, get_vector_store
+    from backend.utils.ingest import (
+        create_vector_store_from_nodes,
+        iter_directory_documents,
+    )
+    from backend.utils.qdrant_collections import vector_store_settings
+
+    class InMemoryQdrantVectorStore(QdrantVectorStore):
+        # An in-memory async client would hold a separate, empty collection
+        async def aquery(self, query, **kwargs):
+            return await asyncio.to_thread(self.query, query, **kwargs)
+
+    client = QdrantClient(location=":memory:")
+    get_qdrant_client.override(client)
+    vector_store = InMemoryQdrantVectorStore(
+        client=client,
+        collection_name=QDRANT_COLLECTION_NAME,
+        enable_hybrid=True,
+        **vector_store_settings(),
+    )
+    get_vector_store.override(vector_store)
+    # The collection starts empty, so the record of ingested chunks must too
+    with tempfile.TemporaryDirectory() as storage_dir:
+        create_vector_store_from_nodes(
+            vector_store, iter_directory_documents(input_dir), storage_dir=storage_dir
+        )
+
+
+def prompts_hash() -> str:
+    """Changes with any prompt the pipeline sends: ours, and the llama-index
+    defaults that synthesis uses
+    """
+    from llama_index.core.prompts import default_prompts
+
+    from backend.utils import prompts
+
+    texts = []
+    for module in (prompts, default_prompts):
+        for name, value in sorted(vars(module).items()):
+            text = getattr(value, "template", value)
+            if not name.startswith("_") and isinstance(text, str):
+                texts.append(f"{module.__name__}.{name}={text}")
+    return sha256("\n".join(texts).encode()).hexdigest()
+
+
+def index_version(input_dir: str = None) -> str:
+    """Identifies the indexed content: the files of input_dir when it is
+    ingested for this run, otherwise the document hashes of the last ingestion
+    """
+    from backend.utils.ingest import iter_guide_files, load_ingestion_storage
+
+    if input_dir is not None:
+        hashes = {}
+        for file_path in iter_guide_files(input_dir):
+            with open(file_path, "rb") as file:
+                hashes[os.path.basename(file_path)] = sha256(file.read()).hexdigest()
+    else:
+        docstore, _ = load_ingestion_storage()
+        hashes = docstore.get_all_document_hashes()
+    return sha256(json.dumps(hashes, sort_keys=True).encode()).hexdigest()
+
+
+def pipeline_identity(offline: bool = False, input_dir: str = STYLE_GUIDE_DIR) -> dict:
+    """Everything besides the config and the example that a prediction
+    depends on, so changing a model, a prompt or the index re-runs it
+    """
+    return {
+        "llm": StubLLM.class_name() if offline else GENERATIVE_MODEL_NAME,
+        "embed_model": EMBED_MODEL_NAME,
+        "prompts": prompts_hash(),
+        "vector_store": (
+            "memory" if offline else f"{VECTOR_STORE_BACKEND}:{QDRANT_COLLECTION_NAME}"
+        ),
+        "index": index_version(input_dir if offline else None),
+    }
+
+
+def prediction_key(config: dict, example: dict, pipeline: dict) -> str:
+    return sha256(
+        json.dumps([pipeline, config, example["id"]], sort_keys=True).encode()
+    ).hexdigest()
+
+
+def tokens(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+
+def token_f1(answer: str, reference: str) -> float:
+    answer_tokens, reference_tokens = tokens(answer), tokens(reference)
+    common = sum((Counter(answer_tokens) & Counter(reference_tokens)).values())
+    if common == 0:
+        return 0.0
+    precision = common / len(answer_tokens)
+    recall = common / len(reference_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def context_overlap(answer: str, sources: list) -> float:
+    """Share of the answer's words that appear in its sources"""
+    answer_tokens = tokens(answer)
+    source_tokens = set(tokens(" ".join(sources)))
+    if not answer_tokens:
+        return 0.0
+    return sum(token in source_tokens for token in answer_tokens) / len(answer_tokens)
+
+
+async def predict(example: dict, config: dict) -> dict:
+    """Answers one example and keeps its sources, even when the relevance gate
+    replaced the answer with the fallback
+    """
+    stages = start_request_stages()
+    retrieved_nodes = []
+    RETRIEVED_NODES.set(retrieved_nodes)
+    with timed_stage("total"):
+        response = await query_vector_store(example["query"], config=config)
+    source_nodes = getattr(response, "source_nodes", None) or retrieved_nodes
+    return {
+        "answer": str(response),
+        "sources": [node.node.get_content() for node in source_nodes],
+        "stages": {stage: entry["seconds"] for stage, entry in stages.items()},
+    }
+
+
+async def judge(example: dict, prediction: dict) -> dict:
+    from llama_index.core.evaluation import CorrectnessEvaluator, FaithfulnessEvaluator
+
+    from backend.resources import get_llm
+
+    scores = {}
+    if example["reference_answer"]:
+        correctness = await CorrectnessEvaluator(llm=get_llm()).aevaluate(
+            query=example["query"],
+            response=prediction["answer"],
+            reference=example["reference_answer"],
+        )
+        scores["correctness"] = correctness.score
+    faithfulness = await FaithfulnessEvaluator(llm=get_llm()).aevaluate(
+        query=example["query"],
+        response=prediction["answer"],
+        contexts=prediction["sources"],
+    )
+    scores["faithfulness"] = float(faithfulness.passing)
+    return scores
+
+
+def score_prediction(example: dict, prediction: dict) -> dict:
+    ranks = [
+        rank
+        for rank, source in enumerate(prediction["sources"], start=1)
+        if matches_reference(source, example["reference_contexts"])
+    ]
+    scores = {
+        "hit_rate": float(bool(ranks)),
+        "mrr": 1 / ranks[0] if ranks else 0.0,
+        "fallback_rate": float(prediction["answer"] == FALLBACK_RESPONSE),
+        "context_overlap": context_overlap(prediction["answer"], prediction["sources"]),
+    }
+    if example["reference_answer"]:
+        scores["answer_f1"] = token_f1(
+            prediction["answer"], example["reference_answer"]
+        )
+    return {**scores, **prediction.get("judge", {})}
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+    return {
+        f"p{percentile}": round(values[int(percentile / 100 * (len(values) - 1))], 3)
+        for percentile in PERCENTILES
+    }
+
+
+async def evaluate(
+    examples: list,
+    config: dict,
+    cache: SQLiteKVStore,
+    concurrency: int = BATCH_CONCURRENCY,
+    refresh: bool = False,
+    with_judge: bool = False,
+    prepare=None,
+    pipeline: dict = None,
+) -> tuple:
+    """Returns the prediction of every example, how many were made in this run
+    and the seconds spent predicting them; prepare runs once before the first
+    example that is not cached, and judging starts once every prediction is made
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    prepared = asyncio.Lock()
+    fresh = []
+    predict_spans = []
+
+    async def run(example: dict) -> tuple:
+        key = prediction_key(config, example, pipeline or {})
+        prediction = None if refresh else cache.get(key)
+        if prediction is None:
+            async with prepared:
+                if prepare is not None and not fresh:
+                    await asyncio.to_thread(prepare)
+                fresh.append(key)
+            async with semaphore:
+                start = time.perf_counter()
+                prediction = await predict(example, config)
+                predict_spans.append((start, time.perf_counter()))
+            cache.put(key, prediction)
+        return key, prediction
+
+    async def run_judge(key: str, example: dict, prediction: dict):
+        if "judge" not in prediction:
+            async with semaphore:
+                prediction["judge"] = await judge(example, prediction)
+            cache.put(key, prediction)
+
+    results = await asyncio.gather(*(run(example) for example in examples))
+    if with_judge:
+        await asyncio.gather(
+            *(
+                run_judge(key, example, prediction)
+                for example, (key, prediction) in zip(examples, results)
+            )
+        )
+    seconds = 0.0
+    if predict_spans:
+        starts, ends = zip(*predict_spans)
+        seconds = max(ends) - min(starts)
+    return [prediction for _, prediction in results], len(fresh), seconds
+
+
+def report(examples: list, predictions: list, fresh: int, seconds: float) -> dict:
+    scores = [
+        score_prediction(example, prediction)
+        for example, prediction in zip(examples, predictions)
+    ]
+    metric_names = sorted(
+        {name for score in scores for name, value in score.items() if value is not None}
+    )
+    stage_names = sorted({stage for p in predictions for stage in p["stages"]})
+    return {
+        "examples": len(examples),
+        "queried": fresh,
+        "quality": {
+            name: round(
+                statistics.mean(
+                    score[name] for score in scores if score.get(name) is not None
+                ),
+                3,
+            )
+            for name in metric_names
+        },
+        "stage_latency_seconds": {
+            stage: percentiles(
+                [p["stages"][stage] for p in predictions if stage in p["stages"]]
+            )
+            for stage in stage_names
+        },
+        "throughput_queries_per_second": (
+            round(fresh / seconds, 3) if fresh and seconds else None
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default="data/testsets/style_guide_testset.json")
+    parser.add_argument("--mode", choices=["fast", "balanced", "thorough"])
+    parser.add_argument(
+        "--config", default="{}", help="JSON overrides of the BASE_CONFIG settings"
+    )
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--refresh", action="store_true")
+    parser.add_argument("--judge", action="store_true")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--input-dir", default=STYLE_GUIDE_DIR, help="used --offline")
+    parser.add_argument("--output", help="file for the per-example predictions")
+    args = parser.parse_args()
+
+    config = mode_config(args.mode) if args.mode else dict(BASE_CONFIG)
+    config.update(json.loads(args.config))
+    examples = load_examples(args.dataset)
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    if args.offline:
+        # The index is only built if an example is not cached
+        use_offline_llm()
+
+    predictions, fresh, seconds = asyncio.run(
+        evaluate(
+            examples,
+            config,
+            SQLiteKVStore(CACHE_PATH),
+            args.concurrency,
+            args.refresh,
+            args.judge,
+            prepare=(
+                (lambda: use_offline_index(args.input_dir)) if args.offline else None
+            ),
+            pipeline=pipeline_identity(args.offline, args.input_dir),
+        )
+    )
+    if args.output:
+        with open(args.output, "w") as file:
+            for example, prediction in zip(examples, predictions):
+                file.write(json.dumps({**example, **prediction}) + "\n")
+    print(
+        json.dumps(
+            {"config": config, **report(examples, predictions, fresh, seconds)},
+            indent=2,
+        )
+    )
@@ -0,0 +1,73 @@
+"""Readers for the test sets in data/testsets and the check of retrieved chunks
+against their reference contexts, shared by the evaluation and the benchmarks
+
+The test sets are read as plain JSON or CSV, so scripts need nothing from
+llama_index.core.llama_dataset, which recent llama-index-core releases no
+longer ship.
+"""
+
+import csv
+import json
+from hashlib import sha256
+
+
+def load_examples(path: str) -> list:
+    """Examples with an id, query, reference contexts and (where the test set
+    has one) reference answer, from a LabelledRagDataset JSON file, a
+    retrieval QA dataset JSON file or a CSV file with the same columns as the
+    labelled dataset
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="") as file:
+            rows = [
+                {
+                    "query": row["query"],
+                    "reference_contexts": [row["reference_contexts"]],
+                    "reference_answer": row.get("reference_answer"),
+                }
+                for row in csv.DictReader(file)
+            ]
+    else:
+        with open(path) as file:
+            dataset = json.load(file)
+        if "examples" in dataset:
+            rows = [
+                {
+                    "query": example["query"],
+                    "reference_contexts": example.get("reference_contexts") or [],
+                    "reference_answer": example.get("reference_answer"),
+                }
+                for example in dataset["examples"]
+            ]
+        else:
+            rows = [
+                {
+                    "query": query,
+                    "reference_contexts": [
+                        dataset["corpus"][doc_id]
+                        for doc_id in dataset["relevant_docs"][query_id]
+                    ],
+                    "reference_answer": None,
+                }
+                for query_id, query in dataset["queries"].items()
+            ]
+    for row in rows:
+        row["id"] = sha256(
+            json.dumps([row["query"], row["reference_contexts"]]).encode()
+        ).hexdigest()
+    return rows
+
+
+def matches_reference(text: str, references: list) -> bool:
+    """A chunk matches when it holds most of the words of a reference context,
+    since the test sets were not cut with the current chunking
+    """
+    words = set(text.lower().split())
+    for reference in references:
+        reference_words = set(reference.lower().split())
+        if (
+            reference_words
+            and len(words & reference_words) / len(reference_words) >= 0.5
+        ):
+            return True
+    return False
@@ -2,11 +2,31 @@ import streamlit as st
 import requests
 import uuid
 import os
+import json
 
 API_HOST = os.environ.get("API_HOST", "localhost")
 
 st.title("Rag-nificent Styles")
 
+# Faster modes skip the more expensive retrieval and answer checks
+mode = st.sidebar.radio("Answer mode", ["fast", "balanced", "thorough"], index=1)
+
+
+def read_answer_events(prompt):
+    """Yields (event, data) pairs from the API's server-sent event stream"""
+    with requests.post(
+        url=f"http://{API_HOST}:7860/queries/stream",
+        json={"query": prompt, "mode": mode},
+        stream=True,
+    ) as response:
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line.removeprefix("event: ")
+            elif line.startswith("data: "):
+                yield event, json.loads(line.removeprefix("data: "))
+
+
 # Initialize chat history
 if "response" not in st.session_state:
     st.session_state.response = ""
@@ -35,17 +55,46 @@ if prompt := st.chat_input("What style-related question can I help you with?"):
 
     # Display assistant response in chat message container
     with st.chat_message("assistant"):
-        response = requests.post(
-            url=f"http://{API_HOST}:7860/queries",
-            json={"query": prompt},
-        ).json()
-
-        answer = response["answer"]
-        st.session_state.query_id = response.get("query_id", 1)
+        placeholder = st.empty()
+        answer = ""
+        degraded = False
+        done = False
+        sources = []
+        st.session_state.query_id = None
+        for event, data in read_answer_events(prompt):
+            if event == "sources":
+                sources = data["sources"]
+            elif event == "token":
+                answer += data["token"]
+                placeholder.markdown(answer + "▌")
+            elif event == "done":
+                # Swaps in the fallback response if the relevance check failed
+                answer = data["answer"]
+                st.session_state.query_id = data.get("query_id", 1)
+                degraded = data.get("degraded", False)
+                # Sources are not shown next to the fallback response
+                if not data.get("is_relevant", True):
+                    sources = []
+                done = True
+            elif event == "error":
+                break
 
-        st.write(answer)
-        st.session_state.response = answer
-    st.session_state.messages.append({"role": "assistant", "content": answer})
+        if done:
+            placeholder.markdown(answer)
+            if degraded:
+                st.caption("Some checks were skipped to answer in time.")
+            if sources:
+                guides = dict.fromkeys(source["guide"] for source in sources)
+                st.caption("Sources: " + ", ".join(filter(None, guides)))
+            st.session_state.response = answer
+        else:
+            # The answer failed part way, so the tokens shown so far are dropped
+            # and there is nothing to rate
+            answer = ""
+            placeholder.error("Something went wrong while answering, please try again.")
+            st.session_state.response = None
+    if answer:
+        st.session_state.messages.append({"role": "assistant", "content": answer})
 
 
 if st.session_state.response:
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from backend.utils.admission import BATCH, INTERACTIVE, PipelineLimiter
+
+
+async def run(limiter, priority, name, started, release):
+    async with limiter.slot(priority):
+        started.append(name)
+        await release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_batch_queries_leave_the_reserved_slots_free():
+    async def main():
+        limiter = PipelineLimiter(capacity=3, interactive_reserve=1)
+        started, release = [], asyncio.Event()
+        tasks = [
+            asyncio.create_task(run(limiter, BATCH, f"batch{i}", started, release))
+            for i in range(4)
+        ]
+        await settle()
+        assert started == ["batch0", "batch1"]
+
+        tasks.append(
+            asyncio.create_task(run(limiter, INTERACTIVE, "user", started, release))
+        )
+        await settle()
+        assert started == ["batch0", "batch1", "user"]
+        assert limiter.stats() == {
+            "running": {INTERACTIVE: 1, BATCH: 2},
+            "waiting": {INTERACTIVE: 0, BATCH: 2},
+        }
+        release.set()
+        await asyncio.gather(*tasks)
+        assert sorted(started) == ["batch0", "batch1", "batch2", "batch3", "user"]
+        assert limiter.stats()["running"] == {INTERACTIVE: 0, BATCH: 0}
+
+    asyncio.run(main())
+
+
+def test_waiting_interactive_requests_go_before_waiting_batch_queries():
+    async def main():
+        limiter = PipelineLimiter(capacity=1, interactive_reserve=0)
+        started, releases = [], [asyncio.Event() for _ in range(4)]
+        names = [(BATCH, "batch0"), (BATCH, "batch1"), (INTERACTIVE, "user")]
+        tasks = []
+        for (priority, name), release in zip(names, releases):
+            tasks.append(
+                asyncio.create_task(run(limiter, priority, name, started, release))
+            )
+            await settle()
+        for release in releases:
+            release.set()
+            await settle()
+        await asyncio.gather(*tasks)
+        assert started == ["batch0", "user", "batch1"]
+
+    asyncio.run(main())
+
+
+def test_cancelled_waits_give_up_their_place():
+    async def main():
+        limiter = PipelineLimiter(capacity=1, interactive_reserve=0)
+        started, release = [], asyncio.Event()
+        first = asyncio.create_task(
+            run(limiter, INTERACTIVE, "first", started, release)
+        )
+        await settle()
+        waiting = asyncio.create_task(
+            run(limiter, INTERACTIVE, "cancelled", started, release)
+        )
+        await settle()
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert limiter.stats()["waiting"][INTERACTIVE] == 0
+
+        release.set()
+        await first
+        await run(limiter, BATCH, "last", started, release)
+        assert started == ["first", "last"]
+        assert limiter.stats()["running"] == {INTERACTIVE: 0, BATCH: 0}
+
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+import asyncio
+
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryMode
+from qdrant_client import AsyncQdrantClient
+
+from backend.utils.batching import BatchedQdrantVectorStore
+
+EMBEDDINGS = [[1.0, 0.0], [0.0, 1.0], [0.7, 0.7]]
+
+
+def sparse_encoder(calls: list):
+    def encode(texts):
+        calls.append(list(texts))
+        return [[len(text)] for text in texts], [[1.0] for _ in texts]
+
+    return encode
+
+
+def hybrid_query(query_str: str) -> VectorStoreQuery:
+    return VectorStoreQuery(
+        query_embedding=[1.0, 0.1],
+        query_str=query_str,
+        similarity_top_k=2,
+        mode=VectorStoreQueryMode.HYBRID,
+    )
+
+
+def query_concurrently(query_batcher: bool, queries: list) -> tuple:
+    calls = []
+
+    async def run():
+        vector_store = BatchedQdrantVectorStore(
+            aclient=AsyncQdrantClient(location=":memory:"),
+            collection_name="test",
+            enable_hybrid=True,
+            sparse_doc_fn=sparse_encoder([]),
+            sparse_query_fn=sparse_encoder(calls),
+            query_batcher=query_batcher,
+            max_wait=0.01,
+        )
+        await vector_store.async_add(
+            [
+                TextNode(text=f"node {index}", embedding=embedding)
+                for index, embedding in enumerate(EMBEDDINGS)
+            ]
+        )
+        return await asyncio.gather(
+            *(vector_store.aquery(hybrid_query(query)) for query in queries)
+        )
+
+    return asyncio.run(run()), calls
+
+
+def test_concurrent_sparse_queries_are_encoded_in_one_batch():
+    results, calls = query_concurrently(True, ["a", "bb", "ccc"])
+
+    assert calls == [["a", "bb", "ccc"]]
+    assert all(len(result.ids) == 2 for result in results)
+
+
+def test_sparse_queries_are_encoded_once_without_batching():
+    results, calls = query_concurrently(False, ["a", "bb"])
+
+    assert sorted(calls) == [["a"], ["bb"]]
+    assert results[0].ids == results[1].ids
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from backend.utils.sqlite_kvstore import SQLiteKVStore
+from experiments import evaluate_pipeline
+from experiments.evaluate_pipeline import evaluate, pipeline_identity, prediction_key
+from experiments.testsets import load_examples, matches_reference
+
+EXAMPLES = [
+    {"id": "1", "query": "Tabs?", "reference_contexts": [], "reference_answer": None},
+    {"id": "2", "query": "Names?", "reference_contexts": [], "reference_answer": None},
+]
+
+
+def test_test_sets_load_without_llama_dataset():
+    examples = load_examples("data/testsets/style_guide_testset.json")
+
+    assert examples and all(example["query"] for example in examples)
+    reference = examples[0]["reference_contexts"][0]
+    assert matches_reference(f"Preamble. {reference}", [reference])
+    assert not matches_reference("Unrelated text", [reference])
+
+
+def test_predictions_are_keyed_on_the_models_prompts_and_index(tmp_path):
+    (tmp_path / "pyguide.md").write_text("Use 4 spaces")
+    identity = pipeline_identity(offline=True, input_dir=str(tmp_path))
+    key = prediction_key({"hyde": False}, EXAMPLES[0], identity)
+
+    assert identity["llm"] == "StubLLM" and identity["embed_model"]
+    for name in identity:
+        changed = {**identity, name: "changed"}
+        assert prediction_key({"hyde": False}, EXAMPLES[0], changed) != key
+
+    (tmp_path / "pyguide.md").write_text("Use 2 spaces")
+    edited = pipeline_identity(offline=True, input_dir=str(tmp_path))
+    assert edited["index"] != identity["index"]
+    assert edited["prompts"] == identity["prompts"]
+
+
+def test_throughput_only_times_the_predictions(monkeypatch, tmp_path):
+    async def predict(example, config):
+        await asyncio.sleep(0.05)
+        return {"answer": "Use 4 spaces", "sources": [], "stages": {}}
+
+    async def judge(example, prediction):
+        await asyncio.sleep(0.3)
+        return {"faithfulness": 1.0}
+
+    monkeypatch.setattr(evaluate_pipeline, "predict", predict)
+    monkeypatch.setattr(evaluate_pipeline, "judge", judge)
+    cache = SQLiteKVStore(str(tmp_path / "predictions.sqlite"))
+
+    predictions, fresh, seconds = asyncio.run(
+        evaluate(EXAMPLES, {}, cache, with_judge=True, prepare=lambda: time.sleep(0.3))
+    )
+    assert fresh == 2
+    assert 0.05 <= seconds < 0.2
+    assert [prediction["judge"] for prediction in predictions] == [
+        {"faithfulness": 1.0}
+    ] * 2
+
+    _, fresh, seconds = asyncio.run(evaluate(EXAMPLES, {}, cache))
+    assert (fresh, seconds) == (0, 0.0)
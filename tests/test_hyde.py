@@ -0,0 +1,79 @@
+import asyncio
+
+from llama_index.core.callbacks import CallbackManager, LlamaDebugHandler
+from llama_index.core.callbacks.schema import CBEventType
+from llama_index.core.llms import MockLLM
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.response_synthesizers import get_response_synthesizer
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from backend.utils import hyde
+from backend.utils.hyde import (
+    HyDEPassageCache,
+    SpeculativeHyDEQueryEngine,
+    merge_candidates,
+)
+
+
+class SlowLLM:
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def apredict(self, prompt, **kwargs):
+        await asyncio.sleep(self.delay)
+        return "A hypothetical passage"
+
+
+class FixedRetriever(BaseRetriever):
+    def _retrieve(self, query_bundle):
+        return [NodeWithScore(node=TextNode(text="Use 4 spaces", id_="a"), score=0.5)]
+
+
+def speculative_engine(deadline: float, passage_cache: HyDEPassageCache):
+    debug_handler = LlamaDebugHandler()
+    callback_manager = CallbackManager([debug_handler])
+    query_engine = RetrieverQueryEngine(
+        retriever=FixedRetriever(),
+        response_synthesizer=get_response_synthesizer(
+            llm=MockLLM(), callback_manager=callback_manager
+        ),
+        callback_manager=callback_manager,
+    )
+    engine = SpeculativeHyDEQueryEngine(
+        query_engine, deadline=deadline, passage_cache=passage_cache
+    )
+    return engine, debug_handler
+
+
+def test_late_passages_are_cached_for_the_next_query(monkeypatch):
+    monkeypatch.setattr(hyde, "get_llm", lambda: SlowLLM(0.2))
+    passage_cache = HyDEPassageCache()
+    engine, debug_handler = speculative_engine(0.01, passage_cache)
+
+    async def run():
+        first = await engine.aquery("Tabs or spaces?")
+        await asyncio.sleep(0.3)
+        second = await engine.aquery("tabs or spaces")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.metadata["timings"]["hyde_used"] is False
+    assert passage_cache.get("Tabs or spaces?") == "A hypothetical passage"
+    assert second.metadata["timings"]["hyde_cache_hit"] is True
+    assert second.metadata["timings"]["hyde_used"] is True
+    assert len(debug_handler.get_event_pairs(CBEventType.QUERY)) == 2
+
+
+def test_merged_candidates_keep_the_best_score():
+    nodes = [
+        NodeWithScore(node=TextNode(text="a", id_="a"), score=0.2),
+        NodeWithScore(node=TextNode(text="b", id_="b"), score=0.5),
+    ]
+    hyde_nodes = [NodeWithScore(node=TextNode(text="a", id_="a"), score=0.9)]
+
+    merged = merge_candidates(nodes, hyde_nodes)
+    assert [(node.node.node_id, node.score) for node in merged] == [
+        ("a", 0.9),
+        ("b", 0.5),
+    ]
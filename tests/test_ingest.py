@@ -0,0 +1,249 @@
+import asyncio
+import urllib.error
+import urllib.request
+
+import pytest
+from llama_index.core import Document
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+
+from backend.utils import ingest
+from backend.utils.ingest import (
+    IngestionStats,
+    create_vector_store_from_nodes,
+    read_document_batches,
+)
+from backend.utils.local_store import LocalHybridVectorStore
+
+
+class LoopBoundLLM(MockLLM):
+    """Like Ollama, keeps one async HTTP client, which only works on the event
+    loop it first ran on
+    """
+
+    _loops: list = PrivateAttr(default_factory=list)
+
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self._loops and self._loops[0] is not loop:
+            raise RuntimeError("Event loop is closed")
+        self._loops.append(loop)
+        return await super().acomplete(prompt, formatted=formatted, **kwargs)
+
+
+@pytest.fixture
+def offline_models(monkeypatch):
+    """Stub LLM and embeddings, no retries or backoff, and no query engines"""
+    llm = LoopBoundLLM()
+    monkeypatch.setattr(ingest, "get_llm", lambda: llm)
+    monkeypatch.setattr(ingest, "get_embed_model", lambda: MockEmbedding(embed_dim=4))
+    monkeypatch.setattr(ingest, "retrieve_index", lambda vector_store: vector_store)
+    monkeypatch.setattr(ingest, "EXTRACTION_BACKOFF", 0)
+    monkeypatch.setattr(ingest, "INGESTION_HOOKS", [])
+    return llm
+
+
+def test_documents_are_read_in_batches_as_they_are_needed():
+    consumed = []
+
+    def documents():
+        for i in range(5):
+            consumed.append(i)
+            yield i
+
+    batches = read_document_batches(documents(), IngestionStats(), batch_size=2)
+    assert next(batches) == [0, 1]
+    assert consumed == [0, 1]
+    assert list(batches) == [[2, 3], [4]]
+
+
+def test_every_batch_extracts_on_the_same_event_loop(tmp_path, offline_models):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path / "index"))
+    documents = [
+        Document(text=f"# Rule {i}\n\nStyle rule number {i}.", doc_id=f"guide{i}.md")
+        for i in range(4)
+    ]
+
+    create_vector_store_from_nodes(
+        store, documents, storage_dir=str(tmp_path / "storage"), batch_size=1
+    )
+
+    assert len(store._refresh().corpus) == 4
+    assert len(offline_models._loops) == 4
+    assert len(set(map(id, offline_models._loops))) == 1
+
+
+def guide(name: str, text: str) -> Document:
+    return Document(text=text, doc_id=name)
+
+
+def stored_texts(store) -> list:
+    index = store._refresh()
+    return [] if index is None else sorted(node.text for node in index.nodes())
+
+
+def test_runs_only_write_what_changed(tmp_path, offline_models, monkeypatch, capsys):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path / "index"))
+    storage_dir = str(tmp_path / "storage")
+    refreshes, extractions = [], []
+    ingest.register_ingestion_hook(lambda: refreshes.append(1))
+
+    def run(*documents) -> str:
+        # Each run is its own process with its own LLM client
+        llm = LoopBoundLLM()
+        monkeypatch.setattr(ingest, "get_llm", lambda: llm)
+        create_vector_store_from_nodes(store, documents, storage_dir=storage_dir)
+        extractions.append(len(llm._loops))
+        return capsys.readouterr().out.splitlines()[-1]
+
+    tabs = guide("tabs.md", "Indent with 4 spaces.")
+    names = guide("names.md", "Use snake_case names.")
+    quotes = guide("quotes.md", "Prefer double quotes.")
+
+    # Without a record of earlier runs the store is rebuilt
+    store.add([Document(text="left over", embedding=[1.0, 0.0, 0.0, 0.0])])
+    assert run(tabs, names, quotes) == "Ingested 3 new chunks, removed 0 stale chunks"
+    assert stored_texts(store) == sorted([tabs.text, names.text, quotes.text])
+
+    # Unchanged content hashes are skipped without calling the LLM
+    assert run(tabs, names, quotes) == "Ingested 0 new chunks, removed 0 stale chunks"
+    assert extractions == [3, 0]
+    assert refreshes == [1]
+
+    # An edited file replaces its chunk
+    edited = guide("quotes.md", "Prefer single quotes.")
+    assert run(tabs, names, edited) == "Ingested 1 new chunks, removed 1 stale chunks"
+    assert stored_texts(store) == sorted([tabs.text, names.text, edited.text])
+
+    # A removed file loses its chunks
+    assert run(tabs, edited) == "Ingested 0 new chunks, removed 1 stale chunks"
+    assert stored_texts(store) == sorted([tabs.text, edited.text])
+    assert extractions == [3, 0, 1, 0]
+    assert refreshes == [1, 1, 1]
+
+
+class FailingLLM(LoopBoundLLM):
+    """Raises error on its first `fail_first` calls and on every call after the
+    first `fail_after`, and counts the calls made
+    """
+
+    _fail_first: int = PrivateAttr()
+    _fail_after: int = PrivateAttr()
+    _error: BaseException = PrivateAttr()
+    _calls: int = PrivateAttr(default=0)
+
+    def __init__(
+        self, fail_first=0, fail_after=None, error=ConnectionError("Ollama is down")
+    ):
+        super().__init__()
+        self._fail_first, self._fail_after, self._error = fail_first, fail_after, error
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        self._calls += 1
+        if self._calls <= self._fail_first or (
+            self._fail_after is not None and self._calls > self._fail_after
+        ):
+            raise self._error
+        return await super().acomplete(prompt, formatted=formatted, **kwargs)
+
+
+class Crash(BaseException):
+    """Stops a run the way a killed process would, past every retry"""
+
+
+def dead_letters(storage_dir) -> dict:
+    _, cache = ingest.load_ingestion_storage(storage_dir)
+    return cache.cache.get_all(collection=ingest.DEAD_LETTER_COLLECTION)
+
+
+def test_failed_extractions_are_retried(tmp_path, offline_models, monkeypatch):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path / "index"))
+    llm = FailingLLM(fail_first=2)
+    monkeypatch.setattr(ingest, "get_llm", lambda: llm)
+
+    create_vector_store_from_nodes(
+        store, [guide("tabs.md", "Indent with 4 spaces.")], str(tmp_path / "storage")
+    )
+
+    assert llm.calls == 3
+    assert stored_texts(store) == ["Indent with 4 spaces."]
+
+
+def test_a_crashed_run_resumes_where_it_stopped(tmp_path, offline_models, monkeypatch):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path / "index"))
+    storage_dir = str(tmp_path / "storage")
+    documents = [guide(f"rule{i}.md", f"Style rule number {i}.") for i in range(5)]
+    crashing_llm = FailingLLM(fail_after=2, error=Crash())
+    monkeypatch.setattr(ingest, "get_llm", lambda: crashing_llm)
+
+    with pytest.raises(Crash):
+        create_vector_store_from_nodes(store, documents, storage_dir)
+
+    llm = FailingLLM()
+    monkeypatch.setattr(ingest, "get_llm", lambda: llm)
+    create_vector_store_from_nodes(store, documents, storage_dir)
+
+    # Only the chunks the crashed run had not extracted are sent to the LLM
+    assert llm.calls == 3
+    assert stored_texts(store) == sorted(document.text for document in documents)
+
+
+def test_chunks_that_keep_failing_are_dead_lettered(
+    tmp_path, offline_models, monkeypatch, capsys
+):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path / "index"))
+    storage_dir = str(tmp_path / "storage")
+    tabs = guide("tabs.md", "Indent with 4 spaces.")
+    names = guide("names.md", "Use snake_case names.")
+    llm = FailingLLM(fail_after=1)
+    monkeypatch.setattr(ingest, "get_llm", lambda: llm)
+
+    create_vector_store_from_nodes(store, [tabs, names], storage_dir)
+
+    # The run finishes without the chunk that failed every attempt
+    assert llm.calls == 1 + ingest.EXTRACTION_MAX_RETRIES + 1
+    assert len(stored_texts(store)) == 1
+    (failed_doc_id,) = [
+        dead_letter["ref_doc_id"] for dead_letter in dead_letters(storage_dir).values()
+    ]
+    assert "Ollama is down" in capsys.readouterr().out
+
+    # The next run extracts it again and clears its dead letter
+    llm = FailingLLM()
+    monkeypatch.setattr(ingest, "get_llm", lambda: llm)
+    create_vector_store_from_nodes(store, [tabs, names], storage_dir)
+
+    assert llm.calls == 1
+    assert failed_doc_id in ("tabs.md", "names.md")
+    assert stored_texts(store) == sorted([tabs.text, names.text])
+    assert dead_letters(storage_dir) == {}
+
+
+@pytest.mark.parametrize(
+    "error, message",
+    [
+        (
+            urllib.error.HTTPError("url", 403, "Forbidden", {}, None),
+            "refused the index refresh (403); set the same INDEX_REFRESH_TOKEN",
+        ),
+        (
+            urllib.error.HTTPError("url", 500, "Server Error", {}, None),
+            "failed to refresh its index (500)",
+        ),
+        (urllib.error.URLError("Connection refused"), "Could not reach the API"),
+    ],
+)
+def test_failed_index_refreshes_say_why(monkeypatch, capsys, error, message):
+    def urlopen(request, timeout):
+        raise error
+
+    monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+
+    ingest.notify_api_of_ingestion("http://api:7860")
+
+    assert message in capsys.readouterr().out
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+)
+
+from backend.utils import local_store
+from backend.utils.local_store import CURRENT_FILE, LocalHybridVectorStore
+
+
+def make_node(node_id, text, embedding, file_name="pyguide.md", document="doc"):
+    return TextNode(
+        id_=node_id,
+        text=text,
+        embedding=embedding,
+        metadata={"file_name": file_name},
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=document)},
+    )
+
+
+NODES = [
+    make_node("tabs", "Indent with 4 spaces, never tabs", [1.0, 0.0]),
+    make_node("names", "Use snake_case for function names", [0.0, 1.0]),
+    make_node(
+        "quotes", "Prefer single quotes", [0.7, 0.7], "jsguide.md", document="js"
+    ),
+]
+
+
+def dense_ids(store, embedding, **query_kwargs) -> list:
+    query = VectorStoreQuery(
+        query_embedding=embedding, similarity_top_k=3, **query_kwargs
+    )
+    return store.query(query).ids
+
+
+def versions(store) -> set:
+    return {entry.name for entry in os.scandir(store.persist_dir) if entry.is_dir()}
+
+
+def test_add_replaces_nodes_with_the_same_id(tmp_path):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    store.add(NODES)
+    store.add([make_node("tabs", "Indent with tabs", [0.0, 1.0])])
+
+    assert dense_ids(store, [0.0, 1.0]) == ["names", "tabs", "quotes"]
+    result = store.query(VectorStoreQuery(query_embedding=[1.0, 0.0]))
+    assert [node.text for node in result.nodes] == ["Prefer single quotes"]
+    assert [node.text for node in store._refresh().nodes()] == [
+        "Use snake_case for function names",
+        "Prefer single quotes",
+        "Indent with tabs",
+    ]
+
+
+def test_delete_by_document_and_by_filter(tmp_path):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    store.add(NODES)
+
+    store.delete("js")
+    assert dense_ids(store, [1.0, 0.0]) == ["tabs", "names"]
+
+    store.delete_nodes(
+        filters=MetadataFilters(filters=[MetadataFilter(key="file_name", value="x")])
+    )
+    assert dense_ids(store, [1.0, 0.0]) == ["tabs", "names"]
+
+    store.delete_nodes(node_ids=["tabs"])
+    assert dense_ids(store, [1.0, 0.0]) == ["names"]
+
+
+def test_queries_only_return_nodes_matching_the_filters(tmp_path):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    store.add(NODES)
+    js_or_names = MetadataFilters(
+        filters=[
+            MetadataFilter(key="file_name", value="jsguide.md"),
+            MetadataFilters(filters=[MetadataFilter(key="file_name", value="x")]),
+        ],
+        condition=FilterCondition.OR,
+    )
+
+    assert dense_ids(store, [1.0, 0.0], filters=js_or_names) == ["quotes"]
+    sparse = VectorStoreQuery(
+        query_str="quotes tabs",
+        similarity_top_k=3,
+        mode=VectorStoreQueryMode.SPARSE,
+        filters=js_or_names,
+    )
+    assert store.query(sparse).ids == ["quotes"]
+
+
+def test_deferred_writes_are_saved_as_one_version(tmp_path):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    with store.deferred_writes():
+        for node in NODES:
+            store.add([node])
+        store.delete_nodes(node_ids=["names"])
+        # Queries see the last saved version until the block ends
+        assert dense_ids(store, [1.0, 0.0]) == []
+
+    assert len(versions(store)) == 1
+    assert dense_ids(store, [1.0, 0.0]) == ["tabs", "quotes"]
+
+
+def test_deferred_writes_are_saved_when_the_run_fails(tmp_path):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        with store.deferred_writes():
+            store.add(NODES[:1])
+            raise RuntimeError("extraction failed")
+
+    assert dense_ids(store, [1.0, 0.0]) == ["tabs"]
+
+
+def test_replaced_versions_are_kept_for_the_grace_period(tmp_path, monkeypatch):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    store.add(NODES[:1])
+    store.add(NODES[1:])
+    assert len(versions(store)) == 2
+
+    monkeypatch.setattr(local_store, "LOCAL_INDEX_VERSION_GRACE", -1)
+    store.add(NODES[:1])
+    assert versions(store) == {store._version}
+
+
+def test_readers_load_the_newer_version_when_theirs_is_removed(tmp_path):
+    reader = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    writer = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    writer.add(NODES[:1])
+    removed = writer._version
+    writer.add(NODES)
+    current = writer._version
+
+    # CURRENT was read just before the writer replaced and removed that version
+    os.rename(os.path.join(tmp_path, removed), os.path.join(tmp_path, "gone"))
+    with open(os.path.join(tmp_path, CURRENT_FILE), "w") as file:
+        file.write(removed)
+    reads = iter([removed, current])
+    reader._current_version = lambda: next(reads, current)
+
+    assert dense_ids(reader, [0.0, 1.0]) == ["names", "quotes", "tabs"]
+
+
+def test_filtered_queries_only_build_the_nodes_they_return(tmp_path, monkeypatch):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    store.add(NODES)
+    built = []
+    to_node = local_store.metadata_dict_to_node
+
+    def metadata_dict_to_node(entry):
+        built.append(entry)
+        return to_node(entry)
+
+    monkeypatch.setattr(local_store, "metadata_dict_to_node", metadata_dict_to_node)
+    pyguide = MetadataFilters(
+        filters=[MetadataFilter(key="file_name", value="pyguide.md")]
+    )
+    query = VectorStoreQuery(
+        query_embedding=[1.0, 0.0], similarity_top_k=1, filters=pyguide
+    )
+
+    assert store.query(query).ids == ["tabs"]
+    assert len(built) == 1
+
+
+def test_async_queries_search_off_the_event_loop(tmp_path, monkeypatch):
+    store = LocalHybridVectorStore(persist_dir=str(tmp_path))
+    store.add(NODES)
+    threads = []
+    search = LocalHybridVectorStore.query
+
+    def query(self, query, **kwargs):
+        threads.append(threading.current_thread())
+        return search(self, query, **kwargs)
+
+    monkeypatch.setattr(LocalHybridVectorStore, "query", query)
+    result = asyncio.run(
+        store.aquery(VectorStoreQuery(query_embedding=[0.0, 1.0], similarity_top_k=1))
+    )
+
+    assert result.ids == ["names"]
+    assert threads and threads[0] is not threading.main_thread()
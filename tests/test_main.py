@@ -0,0 +1,277 @@
+import asyncio
+import json
+
+import time
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from backend import main
+from backend.constants import QUERY_MODES
+from backend.utils import query
+from backend.utils.ingest import available_guides
+from backend.utils.planner import plan_query
+from backend.utils.query import describe_sources
+from backend.utils.semantic_cache import SemanticCache
+
+# Without the lifespan, so no models are loaded
+client = TestClient(main.app)
+
+
+@pytest.fixture
+def ready(monkeypatch):
+    monkeypatch.setattr(main.app.state, "ready", True, raising=False)
+
+
+def test_index_refresh_needs_the_token_when_one_is_set(monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(main, "INDEX_REFRESH_TOKEN", "secret")
+    monkeypatch.setattr(main, "run_ingestion_hooks", lambda: refreshes.append(1))
+
+    assert client.post("/index/refresh").status_code == 401
+    response = client.post("/index/refresh", headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 401
+    response = client.post("/index/refresh", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 204
+    assert refreshes == [1]
+
+
+def test_index_refresh_is_local_only_without_a_token(monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(main, "INDEX_REFRESH_TOKEN", None)
+    monkeypatch.setattr(main, "run_ingestion_hooks", lambda: refreshes.append(1))
+
+    assert client.post("/index/refresh").status_code == 403
+    local_client = TestClient(main.app, client=("127.0.0.1", 50000))
+    assert local_client.post("/index/refresh").status_code == 204
+    assert refreshes == [1]
+
+
+def test_cached_answers_are_kept_apart_per_mode(monkeypatch):
+    cache = SemanticCache(threshold=0.9)
+    monkeypatch.setattr(main, "SEMANTIC_CACHE", cache)
+
+    async def embed(query):
+        return np.ones(2, dtype=np.float32) / np.sqrt(2)
+
+    async def answer(query, plan):
+        return f"answer with hyde={plan.config['hyde']}"
+
+    monkeypatch.setattr(cache, "aembed", embed)
+    monkeypatch.setattr(main, "query_vector_store", answer)
+
+    def ask(mode):
+        plan = plan_query(mode, 1000.0, main.BASE_CONFIG)
+        return asyncio.run(main.answer_query("Tabs or spaces?", plan))
+
+    assert ask("fast") == "answer with hyde=False"
+    assert ask("balanced") == "answer with hyde=speculative"
+    assert ask("fast") == "answer with hyde=False"
+    assert cache.stats()["hits"] == 1
+
+
+def test_queries_for_unknown_guides_are_rejected(monkeypatch, tmp_path, ready):
+    (tmp_path / "pyguide.md").write_text("# Python Style Guide")
+    monkeypatch.setattr(main, "available_guides", lambda: available_guides(tmp_path))
+    configs = []
+
+    async def answer(query, plan):
+        configs.append(plan.config)
+        return "Use 4 spaces"
+
+    logged = []
+    monkeypatch.setattr(main, "answer_query", answer)
+    monkeypatch.setattr(main, "log_message", lambda query: logged.append(query) or 1)
+    monkeypatch.setattr(main, "log_messages", lambda queries: logged.extend(queries))
+    monkeypatch.setattr(main, "log_answer", lambda query_id, answer: None)
+
+    for path in ("/queries", "/queries/stream"):
+        response = client.post(path, json={"query": "Tabs?", "guide": "jsguide.md"})
+        assert response.status_code == 422
+    response = client.post(
+        "/queries/batch", json={"queries": ["Tabs?"], "guide": "../secrets"}
+    )
+    assert response.status_code == 422
+    assert configs == []
+    # Rejected queries are not logged
+    assert logged == []
+
+    response = client.post("/queries", json={"query": "Tabs?", "guide": "pyguide.md"})
+    assert response.status_code == 200
+    assert [config["guide"] for config in configs] == ["pyguide.md"]
+    assert logged == ["Tabs?"]
+
+
+def test_batches_answer_repeated_queries_once_for_every_position(monkeypatch, ready):
+    asked = []
+
+    async def answer(query, plan, priority):
+        asked.append((query, priority))
+        # Later queries finish first, so results arrive out of order
+        await asyncio.sleep(0.01 * (3 - len(asked)))
+        return f"answer to {query}"
+
+    monkeypatch.setattr(main, "answer_query", answer)
+    monkeypatch.setattr(main, "log_messages", lambda queries: [10, 11])
+    monkeypatch.setattr(main, "log_answer", lambda query_id, answer: None)
+
+    response = client.post(
+        "/queries/batch", json={"queries": ["Tabs?", "Names? ", "Tabs?", "Names?"]}
+    )
+
+    assert response.status_code == 200
+    assert sorted(asked) == [("Names?", "batch"), ("Tabs?", "batch")]
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(
+        (result["index"], result["query_id"], result["answer"]) for result in results
+    ) == [
+        (0, 10, "answer to Tabs?"),
+        (1, 11, "answer to Names?"),
+        (2, 10, "answer to Tabs?"),
+        (3, 11, "answer to Names?"),
+    ]
+
+
+def test_queries_get_a_503_until_the_warm_up_is_done(monkeypatch):
+    monkeypatch.setattr(main.app.state, "ready", False, raising=False)
+
+    for path, payload in (
+        ("/queries", {"query": "Tabs?"}),
+        ("/queries/stream", {"query": "Tabs?"}),
+        ("/queries/batch", {"queries": ["Tabs?"]}),
+    ):
+        response = client.post(path, json=payload)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"]
+    assert client.get("/health/live").status_code == 200
+
+
+class IdleLogger:
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+def test_startup_warm_up_builds_the_engines_then_reports_ready(monkeypatch):
+    monkeypatch.setattr(main, "INTERACTION_LOGGER", IdleLogger())
+    monkeypatch.setattr(query, "QUERY_ENGINES", query.OrderedDict())
+    monkeypatch.setattr(query, "select_vector_store", lambda config: "shared")
+    monkeypatch.setattr(query, "set_node_postprocessors", lambda config: [])
+    monkeypatch.setattr(query, "get_embed_model", lambda: MockEmbedding(embed_dim=4))
+
+    def build(vector_store):
+        # Slow enough that the first readiness check sees the warm-up running
+        time.sleep(0.2)
+        return vector_store
+
+    monkeypatch.setattr(query, "retrieve_index", build)
+    monkeypatch.setattr(
+        query, "create_query_engine", lambda index, postprocessors, config: config
+    )
+
+    with TestClient(main.app) as lifespan_client:
+        assert lifespan_client.get("/health/ready").status_code == 503
+        assert lifespan_client.get("/health/live").status_code == 200
+        for _ in range(100):
+            if lifespan_client.get("/health/ready").status_code == 200:
+                break
+            time.sleep(0.05)
+        assert lifespan_client.get("/health/ready").json() == {"status": "ready"}
+
+    assert len(query.QUERY_ENGINES) == len(QUERY_MODES)
+
+
+def read_events(response) -> list:
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append(
+            (event.removeprefix("event: "), json.loads(data.removeprefix("data: ")))
+        )
+    return events
+
+
+@pytest.fixture
+def stream_client(monkeypatch, ready):
+    """Client whose streamed queries are never cached and log under query_id 7"""
+    cache = SemanticCache(threshold=1.1)
+    answers = []
+
+    async def embed(query):
+        return np.ones(2, dtype=np.float32) / np.sqrt(2)
+
+    monkeypatch.setattr(cache, "aembed", embed)
+    monkeypatch.setattr(main, "SEMANTIC_CACHE", cache)
+    monkeypatch.setattr(main, "log_message", lambda query: 7)
+    monkeypatch.setattr(main, "log_answer", lambda *args: answers.append(args))
+    return answers
+
+
+def test_streamed_answers_send_sources_tokens_and_a_final_event(
+    monkeypatch, stream_client
+):
+    source = NodeWithScore(
+        node=TextNode(text="Use 4 spaces.", metadata={"file_name": "pyguide.md"}),
+        score=0.8,
+    )
+
+    async def stream(query, plan):
+        yield "sources", describe_sources([source])
+        for token in ("Use ", "4 ", "spaces"):
+            yield "token", token
+        yield "done", {"answer": "Use 4 spaces", "is_relevant": True}
+
+    monkeypatch.setattr(main, "stream_vector_store", stream)
+
+    response = client.post("/queries/stream", json={"query": "Tabs?"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = read_events(response)
+    assert events[0] == (
+        "sources",
+        {
+            "sources": [
+                {"guide": "pyguide.md", "score": 0.8, "excerpt": "Use 4 spaces."}
+            ]
+        },
+    )
+    assert [data["token"] for event, data in events if event == "token"] == [
+        "Use ",
+        "4 ",
+        "spaces",
+    ]
+    assert events[-1] == (
+        "done",
+        {
+            "query_id": 7,
+            "is_relevant": True,
+            "answer": "Use 4 spaces",
+            "degraded": False,
+            "degraded_stages": [],
+        },
+    )
+    assert stream_client == [(7, "Use 4 spaces")]
+
+
+def test_streams_that_fail_part_way_end_with_an_error_event(monkeypatch, stream_client):
+    async def stream(query, plan):
+        yield "token", "Use "
+        raise ConnectionError("Ollama went away")
+
+    monkeypatch.setattr(main, "stream_vector_store", stream)
+
+    response = client.post("/queries/stream", json={"query": "Tabs?"})
+
+    events = read_events(response)
+    assert events == [
+        ("token", {"token": "Use "}),
+        ("error", {"query_id": 7, "error": "ConnectionError('Ollama went away')"}),
+    ]
+    assert stream_client == []
+    assert main.PIPELINE_LIMITER.stats()["running"] == {"interactive": 0, "batch": 0}
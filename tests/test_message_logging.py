@@ -0,0 +1,160 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from backend.utils import message_logging
+from backend.utils.message_logging import InteractionLogger
+from backend.utils.models import Answer, Base, Feedback, Query
+
+
+def create_engine(tmp_path):
+    async def create():
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{tmp_path / 'logs.db'}", poolclass=NullPool
+        )
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        return engine
+
+    return asyncio.run(create())
+
+
+class UnreachableEngine:
+    dialect = SimpleNamespace(name="postgresql")
+
+    def begin(self):
+        raise OperationalError("connect", {}, ConnectionRefusedError())
+
+
+def make_logger(tmp_path, engine, **kwargs) -> InteractionLogger:
+    return InteractionLogger(
+        engine=engine,
+        spool_path=str(tmp_path / "spool.jsonl"),
+        dead_letter_path=str(tmp_path / "dead_letter.jsonl"),
+        **kwargs,
+    )
+
+
+def count_rows(engine, model) -> int:
+    async def count():
+        async with engine.connect() as connection:
+            return (await connection.execute(select(func.count(model.id)))).scalar()
+
+    return asyncio.run(count())
+
+
+def read_lines(path) -> list:
+    if not path.exists():
+        return []
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_rows_are_spooled_while_the_database_is_unreachable(tmp_path):
+    logger = make_logger(tmp_path, UnreachableEngine())
+    query_id = logger.log_message("How long can a line be?")
+    logger.log_answer(query_id, "79 characters")
+    asyncio.run(logger.flush())
+
+    assert len(read_lines(tmp_path / "spool.jsonl")) == 2
+
+    logger.engine = create_engine(tmp_path)
+    logger.log_feedback(query_id, 1)
+    asyncio.run(logger.flush())
+
+    assert not (tmp_path / "spool.jsonl").exists()
+    assert count_rows(logger.engine, Query) == 1
+    assert count_rows(logger.engine, Answer) == 1
+    assert count_rows(logger.engine, Feedback) == 1
+
+
+def test_spooled_rows_that_were_already_written_are_skipped(tmp_path):
+    logger = make_logger(tmp_path, create_engine(tmp_path))
+    logger.log_message("Tabs or spaces?")
+    rows = logger._take_pending()
+    logger.pending = {table: list(table_rows) for table, table_rows in rows.items()}
+    asyncio.run(logger.flush())
+    # As if the process stopped after the commit but before the spool was removed
+    logger._write_spool(rows)
+    asyncio.run(logger.flush())
+
+    assert count_rows(logger.engine, Query) == 1
+    assert not (tmp_path / "spool.jsonl").exists()
+    assert not (tmp_path / "dead_letter.jsonl").exists()
+
+
+def test_rejected_rows_go_to_the_dead_letter_file(tmp_path):
+    logger = make_logger(tmp_path, create_engine(tmp_path))
+    logger.log_message("What are TODO comments?")
+    logger.log_message(None)
+    logger.log_message("How long can a docstring be?")
+    asyncio.run(logger.flush())
+
+    assert count_rows(logger.engine, Query) == 2
+    dead_letters = read_lines(tmp_path / "dead_letter.jsonl")
+    assert [record["row"]["content"] for record in dead_letters] == [None]
+    assert not (tmp_path / "spool.jsonl").exists()
+
+    logger.log_message("Should I use absolute imports?")
+    asyncio.run(logger.flush())
+    assert count_rows(logger.engine, Query) == 3
+
+
+def test_spool_keeps_the_newest_rows(tmp_path):
+    logger = make_logger(tmp_path, UnreachableEngine(), spool_max_rows=2)
+    for content in ("first", "second", "third"):
+        logger.log_message(content)
+        asyncio.run(logger.flush())
+
+    spooled = read_lines(tmp_path / "spool.jsonl")
+    assert [record["row"]["content"] for record in spooled] == ["second", "third"]
+
+
+def test_corrupt_spool_lines_are_moved_aside(tmp_path):
+    logger = make_logger(tmp_path, create_engine(tmp_path))
+    logger.log_message("Tabs or spaces?")
+    logger._write_spool(logger._take_pending())
+    with open(tmp_path / "spool.jsonl", "a") as spool:
+        spool.write('{"table": "queries", "row": \n')
+    asyncio.run(logger.flush())
+
+    assert count_rows(logger.engine, Query) == 1
+    assert len(read_lines(tmp_path / "dead_letter.jsonl")) == 1
+
+
+def test_worker_keeps_flushing_after_a_failed_flush(tmp_path):
+    logger = make_logger(tmp_path, create_engine(tmp_path), flush_interval=0.01)
+    write_batch = logger._write_batch
+    calls = []
+
+    async def fail_once(rows, spooled_rows):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError("unexpected")
+        return await write_batch(rows, spooled_rows)
+
+    logger._write_batch = fail_once
+
+    async def run():
+        await logger.start()
+        logger.log_message("lost with the failed flush")
+        await asyncio.sleep(0.1)
+        logger.log_message("written by a later flush")
+        await asyncio.sleep(0.1)
+        await logger.stop()
+
+    asyncio.run(run())
+    assert len(calls) >= 2
+    assert count_rows(logger.engine, Query) == 1
+
+
+def test_workers_of_one_host_get_distinct_nodes(monkeypatch):
+    nodes = set()
+    for pid in range(1000, 1016):
+        monkeypatch.setattr(message_logging.os, "getpid", lambda: pid)
+        nodes.add(message_logging.default_id_node())
+    assert len(nodes) == 16
@@ -0,0 +1,112 @@
+import numpy as np
+from fastapi.testclient import TestClient
+from llama_index.core.base.llms.types import CompletionResponse
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+from backend import main
+from backend.utils import metrics
+from backend.utils.metrics import start_request_stages, timed_stage
+from backend.utils.planner import StageEstimates
+from backend.utils.semantic_cache import SemanticCache
+
+client = TestClient(main.app)
+
+
+class TokenCountingLLM(MockLLM):
+    """Answers like Ollama, with the prompt and completion token counts in raw"""
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        return CompletionResponse(
+            text="Use 4 spaces", raw={"prompt_eval_count": 12, "eval_count": 3}
+        )
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        return CompletionResponse(
+            text="Use 4 spaces", raw={"prompt_eval_count": 12, "eval_count": 3}
+        )
+
+
+def test_tokens_and_embeddings_are_attributed_to_the_running_stage(monkeypatch):
+    estimates = StageEstimates(priors={})
+    monkeypatch.setattr(metrics, "STAGE_ESTIMATES", estimates)
+    stages = start_request_stages()
+
+    with timed_stage("retrieval"):
+        MockEmbedding(embed_dim=4).get_query_embedding("Tabs or spaces?")
+    with timed_stage("synthesis"):
+        TokenCountingLLM().complete("Tabs or spaces?")
+
+    assert stages["synthesis"]["prompt_tokens"] == 12
+    assert stages["synthesis"]["completion_tokens"] == 3
+    assert "prompt_tokens" not in stages["retrieval"]
+    # The query embedding is part of retrieval, so only retrieval is estimated
+    assert stages["embedding"]["seconds"] <= stages["retrieval"]["seconds"]
+    assert set(estimates.estimates) == {"retrieval", "synthesis"}
+
+
+def test_metrics_are_served_in_prometheus_format():
+    with timed_stage("synthesis"):
+        TokenCountingLLM().complete("Tabs or spaces?")
+    try:
+        with timed_stage("rerank"):
+            raise ValueError("reranker failed")
+    except ValueError:
+        pass
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert 'rag_stage_duration_seconds_count{stage="synthesis"}' in " ".join(lines)
+    assert any(
+        line.startswith('rag_llm_tokens_total{kind="prompt",stage="synthesis"}')
+        for line in lines
+    )
+    assert any(
+        line.startswith('rag_stage_errors_total{stage="rerank"}') for line in lines
+    )
+
+
+def test_debug_header_returns_the_stage_breakdown(monkeypatch):
+    monkeypatch.setattr(main.app.state, "ready", True, raising=False)
+    # Never matches, so both queries run the pipeline
+    cache = SemanticCache(threshold=1.1)
+    monkeypatch.setattr(main, "SEMANTIC_CACHE", cache)
+    monkeypatch.setattr(main, "log_message", lambda query: 7)
+    monkeypatch.setattr(main, "log_answer", lambda query_id, answer: None)
+
+    async def embed(query):
+        return np.ones(2, dtype=np.float32) / np.sqrt(2)
+
+    async def answer(query, plan):
+        with timed_stage("retrieval"):
+            await MockEmbedding(embed_dim=4).aget_query_embedding(query)
+        with timed_stage("synthesis"):
+            await TokenCountingLLM().acomplete(query)
+        return "Use 4 spaces"
+
+    monkeypatch.setattr(cache, "aembed", embed)
+    monkeypatch.setattr(main, "query_vector_store", answer)
+
+    response = client.post("/queries", json={"query": "Tabs?"})
+    assert "stages" not in response.json()
+
+    response = client.post(
+        "/queries", json={"query": "Names?"}, headers={"X-Debug-Timings": "true"}
+    )
+    stages = response.json()["stages"]
+    assert set(stages) == {
+        "total",
+        "semantic_cache",
+        "retrieval",
+        "embedding",
+        "synthesis",
+    }
+    assert stages["synthesis"]["prompt_tokens"] == 12
+    assert stages["synthesis"]["completion_tokens"] == 3
+    assert stages["total"]["seconds"] >= stages["synthesis"]["seconds"]
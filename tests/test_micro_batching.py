@@ -0,0 +1,55 @@
+import asyncio
+
+from backend.utils.batching import MicroBatcher
+
+
+def recording_batcher(batches: list, **kwargs) -> MicroBatcher:
+    def process_batch(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    return MicroBatcher(process_batch, **kwargs)
+
+
+def test_concurrent_items_share_a_batch():
+    batches = []
+    batcher = recording_batcher(batches, max_wait=0.01)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(item) for item in range(5)))
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8]
+    assert batches == [[0, 1, 2, 3, 4]]
+
+
+def test_batches_never_exceed_the_maximum_size():
+    batches = []
+    batcher = recording_batcher(batches, max_batch_size=3, max_wait=0.01)
+
+    async def run():
+        return await batcher.submit_many(list(range(7)))
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8, 10, 12]
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+
+def test_a_failed_batch_fails_each_of_its_items():
+    def process_batch(items):
+        raise ValueError("model failed")
+
+    batcher = MicroBatcher(process_batch, max_wait=0.01)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.submit(1), batcher.submit(2), return_exceptions=True
+        )
+
+    assert [type(result) for result in asyncio.run(run())] == [ValueError] * 2
+
+
+def test_batcher_follows_a_new_event_loop():
+    batches = []
+    batcher = recording_batcher(batches, max_wait=0.0)
+
+    assert asyncio.run(batcher.submit(1)) == 2
+    assert asyncio.run(batcher.submit(2)) == 4
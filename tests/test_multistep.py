@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+from llama_index.core import Settings
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.base.response.schema import Response
+from llama_index.core.llms import MockLLM
+
+from backend.utils import multistep
+from backend.utils.multistep import ParallelMultiStepQueryEngine, parse_sub_questions
+
+
+def test_sub_questions_are_read_from_the_model_output():
+    text = 'Sure: {"independent": true, "questions": ["A?", " B? ", "A?", ""]}'
+
+    assert parse_sub_questions(text, 4) == (["A?", "B?"], True)
+    assert parse_sub_questions(text, 1) == (["A?"], True)
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("no json here", None),
+        ('{"questions": ["A?", "B?"', None),
+        ('{"independent": true, "questions": []}', None),
+        ('{"questions": ["A?", "B?"]}', (["A?", "B?"], None)),
+        ('{"independent": "yes", "questions": ["A?"]}', (["A?"], None)),
+        ('{"independent": false, "questions": ["A?"]}', (["A?"], False)),
+    ],
+)
+def test_unreadable_decompositions(text, expected):
+    assert parse_sub_questions(text, 4) == expected
+
+
+class NamedQueryEngine:
+    callback_manager = CallbackManager()
+
+    def __init__(self, name):
+        self.name = name
+
+    async def aquery(self, query_bundle):
+        return Response(self.name)
+
+
+class DecompositionLLM:
+    def __init__(self, text):
+        self.text = text
+
+    async def apredict(self, prompt, **kwargs):
+        return self.text
+
+
+@pytest.mark.parametrize(
+    "decomposition, engine",
+    [
+        ("I cannot split this question", "single"),
+        ('{"questions": ["A?", "B?"]}', "single"),
+        ('{"independent": true, "questions": ["A?"]}', "single"),
+        ('{"independent": false, "questions": ["A?", "B?"]}', "sequential"),
+    ],
+)
+def test_queries_that_are_not_split_go_to_one_engine(
+    monkeypatch, decomposition, engine
+):
+    monkeypatch.setattr(Settings, "_llm", MockLLM())
+    monkeypatch.setattr(multistep, "get_llm", lambda: DecompositionLLM(decomposition))
+    query_engine = ParallelMultiStepQueryEngine(
+        NamedQueryEngine("single"), NamedQueryEngine("sequential")
+    )
+
+    assert str(asyncio.run(query_engine.aquery("Tabs or spaces?"))) == engine
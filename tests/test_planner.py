@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from backend.constants import DEGRADED_RESPONSE
+from backend.utils import metrics, query
+from backend.utils.planner import (
+    STAGE_PRIORS,
+    QueryPlan,
+    StageEstimates,
+    mode_config,
+    plan_query,
+    remember_nodes,
+)
+
+
+def estimates(**seconds) -> StageEstimates:
+    return StageEstimates(smoothing=0.5, priors={**STAGE_PRIORS, **seconds})
+
+
+def test_stages_are_dropped_most_expensive_first():
+    plan = plan_query("thorough", 1.0, estimates=estimates(synthesis=0.5, rerank=1.0))
+
+    assert plan.degraded_stages == ["multistep", "hyde", "self_reflection", "rerank"]
+    assert plan.config["multistep"] is False
+    assert plan.config["hyde"] is False
+    assert plan.config["relevance_gate"] == "score"
+    assert plan.config["rerank"] is False
+    # Answers are still cached under the mode that was asked for
+    assert plan.mode_config == mode_config("thorough")
+
+
+def test_plans_within_budget_keep_every_stage():
+    plan = plan_query("balanced", 1000.0, estimates=estimates())
+
+    assert not plan.degraded
+    assert plan.config == mode_config("balanced")
+
+
+def test_hyde_gets_a_shorter_deadline_before_it_is_dropped():
+    stage_estimates = estimates(
+        **{"hyde": 4.0, "synthesis": 1.0, "self_reflection:llm": 0.0}
+    )
+    plan = plan_query("thorough", 5.0, estimates=stage_estimates)
+
+    assert plan.config["hyde"] == "speculative"
+    assert 0 < plan.config["hyde_deadline"] < mode_config("thorough")["hyde_deadline"]
+    assert "hyde" in plan.degraded_stages
+
+
+def test_partial_stage_timings_do_not_feed_the_estimates(monkeypatch):
+    stage_estimates = estimates(synthesis=1.0)
+    monkeypatch.setattr(metrics, "STAGE_ESTIMATES", stage_estimates)
+
+    with metrics.timed_stage("synthesis", estimate=False):
+        pass
+
+    async def cancelled():
+        with metrics.timed_stage("synthesis"):
+            await asyncio.sleep(1)
+
+    async def run():
+        task = asyncio.create_task(cancelled())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert stage_estimates.estimate("synthesis") == 1.0
+
+    with metrics.timed_stage("synthesis"):
+        pass
+    assert stage_estimates.estimate("synthesis") < 1.0
+
+
+class StalledQueryEngine:
+    async def aquery(self, query_str):
+        remember_nodes(
+            [NodeWithScore(node=TextNode(text="Use 4 spaces per level"), score=0.8)]
+        )
+        await asyncio.sleep(10)
+
+
+def test_streaming_answers_from_the_sources_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(query, "get_query_engine", lambda *args: StalledQueryEngine())
+    plan = QueryPlan({"rerank": False, "relevance_gate": "score"}, 0.05, [])
+
+    async def run():
+        return [event async for event in query.stream_vector_store("Tabs?", plan=plan)]
+
+    events = asyncio.run(run())
+    answer = f"{DEGRADED_RESPONSE}\n- style guide: Use 4 spaces per level"
+    assert events == [
+        (
+            "sources",
+            [{"guide": None, "score": 0.8, "excerpt": "Use 4 spaces per level"}],
+        ),
+        ("token", answer),
+        ("done", {"answer": answer, "is_relevant": True}),
+    ]
+    assert plan.degraded_stages == ["synthesis"]
@@ -0,0 +1,14 @@
+from backend.utils.qdrant_collections import guide_collection_name
+
+
+def test_guides_with_similar_names_get_their_own_collections():
+    names = {
+        guide_collection_name(guide, "style")
+        for guide in ("a.b.md", "a_b.md", "a b.md", "a_b.txt")
+    }
+
+    assert len(names) == 4
+    assert all(name.startswith("style_a_b_") for name in names)
+    assert guide_collection_name("a.b.md", "style") == guide_collection_name(
+        "a.b.md", "style"
+    )
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+
+import pytest
+from llama_index.core.base.response.schema import Response
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from backend.constants import DEGRADED_RESPONSE
+from backend.utils import query
+
+
+class FakeIndex:
+    def __init__(self, vector_store):
+        self.vector_store = vector_store
+
+
+def build_engines(monkeypatch, max_entries):
+    monkeypatch.setattr(query, "QUERY_ENGINES", query.OrderedDict())
+    monkeypatch.setattr(query, "QUERY_ENGINES_MAX_ENTRIES", max_entries)
+    monkeypatch.setattr(query, "retrieve_index", FakeIndex)
+    monkeypatch.setattr(query, "set_node_postprocessors", lambda config: [])
+    monkeypatch.setattr(
+        query,
+        "create_query_engine",
+        lambda index, node_postprocessors, config: (index.vector_store, config),
+    )
+
+
+def test_least_recently_used_engines_are_dropped(monkeypatch):
+    build_engines(monkeypatch, max_entries=2)
+    monkeypatch.setattr(query, "select_vector_store", lambda config: "shared")
+
+    fast, balanced = {"hyde": False}, {"hyde": "speculative"}
+    engine = query.get_query_engine(config=fast)
+    query.get_query_engine(config=balanced)
+    assert query.get_query_engine(config=fast) is engine
+    query.get_query_engine(config={"hyde": True})
+
+    assert len(query.QUERY_ENGINES) == 2
+    assert query.get_query_engine(config=fast) is engine
+    assert query.get_query_engine(config=balanced) is not None
+    assert len(query.QUERY_ENGINES) == 2
+
+
+def test_guide_queries_move_to_the_guide_collection_once_it_exists(monkeypatch):
+    build_engines(monkeypatch, max_entries=8)
+    collections = set()
+    monkeypatch.setattr(query, "VECTOR_STORE_BACKEND", "qdrant")
+    monkeypatch.setattr(query, "get_vector_store", lambda: "shared")
+    monkeypatch.setattr(query, "get_collection_vector_store", lambda name: name)
+    monkeypatch.setattr(
+        query,
+        "collection_exists",
+        query.lru_cache(maxsize=None)(lambda name: name in collections),
+    )
+    config = {"guide": "pyguide.md"}
+
+    assert query.get_query_engine(config=config)[0] == "shared"
+    collections.add(query.guide_collection_name("pyguide.md"))
+    assert query.get_query_engine(config=config)[0] == "shared"
+
+    query.clear_query_engines()
+    assert query.get_query_engine(config=config)[0] == query.guide_collection_name(
+        "pyguide.md"
+    )
+
+
+def test_answers_cut_short_list_their_sources():
+    sources = [
+        NodeWithScore(
+            node=TextNode(text="Use snake_case.", metadata={"file_name": "pyguide.md"}),
+            score=0.7,
+        ),
+        NodeWithScore(node=TextNode(text="Indent with 4 spaces. " * 20), score=0.9),
+    ]
+
+    answer = asyncio.run(
+        query.answer_from_sources("Tabs?", sources, {"relevance_gate": "score"})
+    )
+
+    first, second, third = answer.split("\n")
+    assert first == DEGRADED_RESPONSE
+    assert second.startswith("- style guide: Indent with 4 spaces.")
+    assert len(second) < 250
+    assert third == "- pyguide.md: Use snake_case."
+
+
+class BlockingStepEngine:
+    """Answers each multistep step once the test releases it"""
+
+    callback_manager = CallbackManager()
+
+    def __init__(self):
+        self.steps = []
+        self.release = threading.Event()
+
+    def query(self, query_bundle):
+        self.steps.append(query_bundle.query_str)
+        self.release.wait(5)
+        return Response(f"answer {len(self.steps)}")
+
+
+class RecordingSynthesizer:
+    def __init__(self):
+        self.calls = 0
+
+    def synthesize(self, **kwargs):
+        self.calls += 1
+        return Response("final answer")
+
+
+def test_cancelled_multistep_queries_stop_before_their_next_step():
+    step_engine = BlockingStepEngine()
+    synthesizer = RecordingSynthesizer()
+    query_engine = query.ThreadedMultiStepQueryEngine(
+        query_engine=step_engine,
+        query_transform=lambda query_bundle, metadata: QueryBundle(
+            f"step after {len(step_engine.steps)}"
+        ),
+        response_synthesizer=synthesizer,
+        num_steps=3,
+    )
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(query_engine.aquery("Tabs?"), 0.05)
+        step_engine.release.set()
+
+    # asyncio.run waits for the thread, whose step in flight runs to the end,
+    # but no further step or synthesis does
+    asyncio.run(run())
+    assert step_engine.steps == ["step after 0"]
+    assert synthesizer.calls == 0
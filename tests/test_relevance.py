@@ -0,0 +1,32 @@
+import asyncio
+
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from backend.utils.relevance import check_response_with_scores
+
+
+def source(score: float, retrieval_score: float = None) -> NodeWithScore:
+    metadata = {} if retrieval_score is None else {"retrieval_score": retrieval_score}
+    return NodeWithScore(node=TextNode(text="text", metadata=metadata), score=score)
+
+
+def passes(sources: list, config: dict) -> bool:
+    return asyncio.run(check_response_with_scores("query", "answer", sources, config))
+
+
+def test_score_gate_rejects_answers_without_sources():
+    assert not passes([], {"rerank": "onnx"})
+
+
+def test_score_gate_uses_the_best_rerank_score():
+    config = {"rerank": "onnx", "min_rerank_score": 0.5}
+
+    assert passes([source(0.2, 0.9), source(0.6, 0.1)], config)
+    assert not passes([source(0.2, 0.9), source(0.4, 0.8)], config)
+
+
+def test_score_gate_checks_retrieval_scores_without_a_reranker():
+    config = {"rerank": False, "min_rerank_score": 0.5, "min_retrieval_score": 0.3}
+
+    assert passes([source(0.35)], config)
+    assert not passes([source(0.25)], config)
@@ -0,0 +1,19 @@
+import pytest
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from backend.utils.rerank import CandidateLimit, get_reranker
+
+
+def test_candidate_limit_keeps_the_best_retrieved_nodes():
+    nodes = [
+        NodeWithScore(node=TextNode(text=text), score=score)
+        for text, score in (("a", 0.1), ("b", None), ("c", 0.9), ("d", 0.5))
+    ]
+
+    kept = CandidateLimit(max_candidates=2).postprocess_nodes(nodes)
+    assert [node.node.text for node in kept] == ["c", "d"]
+
+
+def test_unknown_reranker_backends_are_rejected():
+    with pytest.raises(ValueError):
+        get_reranker("torchscript")
@@ -0,0 +1,49 @@
+import numpy as np
+
+from backend.utils.semantic_cache import SemanticCache
+
+
+def unit(*values) -> np.ndarray:
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_similar_queries_share_an_answer():
+    cache = SemanticCache(threshold=0.9)
+    cache.store(unit(1, 0), "Tabs or spaces?", "Spaces.")
+
+    assert cache.lookup(unit(1, 0.1)) == "Spaces."
+    assert cache.lookup(unit(0, 1)) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_answers_are_kept_apart_per_config():
+    cache = SemanticCache(threshold=0.9)
+    fast, thorough = {"hyde": False}, {"hyde": True}
+    cache.store(unit(1, 0), "Tabs or spaces?", "Spaces.", fast)
+
+    assert cache.lookup(unit(1, 0), fast) == "Spaces."
+    assert cache.lookup(unit(1, 0), thorough) is None
+    # Key order does not split a namespace
+    assert cache.lookup(unit(1, 0), {**thorough, "hyde": False}) == "Spaces."
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = SemanticCache(threshold=0.99, max_entries=2)
+    cache.store(unit(1, 0), "first", "1")
+    cache.store(unit(0, 1), "second", "2")
+    cache.lookup(unit(1, 0))
+    cache.store(unit(1, 1), "third", "3")
+
+    assert cache.lookup(unit(1, 0)) == "1"
+    assert cache.lookup(unit(0, 1)) is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_entries_expire_after_the_ttl():
+    cache = SemanticCache(threshold=0.9, ttl=-1)
+    cache.store(unit(1, 0), "Tabs or spaces?", "Spaces.")
+
+    assert cache.lookup(unit(1, 0)) is None
+    assert cache.stats()["size_in_bytes"] == 0
@@ -0,0 +1,30 @@
+from backend.utils.sqlite_kvstore import SQLiteKVStore
+
+
+def test_put_get_and_delete(tmp_path):
+    store = SQLiteKVStore(str(tmp_path / "kv.sqlite"))
+    store.put("a", {"value": 1})
+    store.put_all([("b", {"value": 2}), ("a", {"value": 3})])
+    store.put("a", {"value": 4}, collection="other")
+
+    assert store.get("a") == {"value": 3}
+    assert store.get("missing") is None
+    assert store.get_all() == {"a": {"value": 3}, "b": {"value": 2}}
+    assert store.get_all(collection="other") == {"a": {"value": 4}}
+
+    assert store.delete("a") is True
+    assert store.delete("a") is False
+    assert store.get_all() == {"b": {"value": 2}}
+    assert store.get("a", collection="other") == {"value": 4}
+
+
+def test_writes_survive_reopening(tmp_path):
+    path = str(tmp_path / "nested" / "kv.sqlite")
+    store = SQLiteKVStore(path)
+    store.put("a", {"value": [1, 2]})
+    store.put("b", {"value": None})
+    store.delete("b")
+    store.close()
+
+    reopened = SQLiteKVStore(path)
+    assert reopened.get_all() == {"a": {"value": [1, 2]}}